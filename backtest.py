@@ -0,0 +1,462 @@
+"""Офлайн-backtest і grid sweep параметрів ризику ParsiBot.
+
+Записані webhook-сигнали (JSONL: «голі» payload-и або записи рекордера) програються проти локальних
+klines. Логіка та сама, що в живому шляху bot.py: розмір позиції (risk_qty + округлення інструменту),
+валідація TP/SL з fallback TP і обрізанням SL, trailing, скасування попереднього захисту новим сигналом.
+
+python backtest.py fetch-klines --symbol BTCUSDT --interval 1 --start 2025-01-01 --end 2025-02-01
+python backtest.py run --signals signals.jsonl --trades-out trades_bt.csv
+python backtest.py run --signals signals.jsonl --grid max_sl_distance=0.03,0.05,0.07 --grid risk_percent=0.1,0.2 \
+    --grid callback=0.5,0.75,1.0 --workers 8 --out sweep.csv
+
+Формат klines: <dir>/<SYMBOL>.npy — структурований масив KLINE_DTYPE (відсортований за ts, мс),
+який читається через mmap і ділиться між процесами; <dir>/instruments.json — сирі записи instruments-info.
+
+Спрощення моделі:
+- вхід — open першої свічки з ts >= часу сигналу; SL/TP перевіряються по high/low свічок,
+  якщо в одній свічці зачеплено обидва — рахуємо SL (песимістично);
+- trailing, як і в живому шляху, — відстань у ціні (Bybit trailingStop), активна одразу; стоп
+  підтягується за high/low попередніх свічок;
+- новий прийнятий сигнал по символу скасовує TP/SL і закриває попередню позицію по ринку (exit_reason=replaced).
+"""
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bot
+
+KLINE_DTYPE = np.dtype([
+    ("ts", "<i8"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("volume", "<f8"),
+])
+DEFAULT_KLINES_DIR = os.path.join(bot.DATA_DIR, "klines")
+
+# Параметри, які можна свіпати (--grid name=v1,v2,...), і їх значення за замовчуванням з bot.py
+DEFAULT_PARAMS = {
+    "max_sl_distance": bot.MAX_SL_DISTANCE_PERC,
+    "fallback_tp_pct": bot.FALLBACK_TP_PCT,
+    "risk_percent": bot.RISK_PERCENT,
+    "callback": None,  # None — callback із сигналу
+}
+
+SUMMARY_FIELDS = ["trades", "wins", "losses", "win_rate", "expectancy", "profit_factor",
+                  "total_pnl", "max_drawdown", "avg_runtime_sec", "skipped", "final_balance"]
+
+
+# 📦 Klines
+
+def klines_path(klines_dir, symbol):
+    return os.path.join(klines_dir, f"{symbol}.npy")
+
+
+def save_klines(klines_dir, symbol, rows):
+    os.makedirs(klines_dir, exist_ok=True)
+    bars = np.array([tuple(r) for r in rows], dtype=KLINE_DTYPE)
+    bars = np.sort(bars, order="ts")
+    _, unique = np.unique(bars["ts"], return_index=True)
+    bars = bars[unique]
+    np.save(klines_path(klines_dir, symbol), bars)
+    return bars
+
+
+def load_klines(klines_dir, symbols):
+    klines = {}
+    for symbol in symbols:
+        path = klines_path(klines_dir, symbol)
+        if os.path.exists(path):
+            klines[symbol] = np.load(path, mmap_mode="r")
+    return klines
+
+
+def load_instruments(klines_dir, symbols):
+    """Сідуємо кеш інструментів bot.py, щоб normalize_qty/normalize_price не ходили в мережу."""
+    raw = {}
+    path = os.path.join(klines_dir, "instruments.json")
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    for symbol in symbols:
+        bot._instruments[symbol] = bot._parse_instrument(raw.get(symbol) or {})
+
+
+def fetch_klines(symbol, interval, start_ms, end_ms, klines_dir):
+    rows = []
+    end = end_ms
+    while end > start_ms:
+        data = bot.bybit_get("/v5/market/kline", {
+            "category": "linear",
+            "symbol": symbol,
+            "interval": interval,
+            "start": start_ms,
+            "end": end,
+            "limit": 1000
+        }, signed=False)
+        if data.get("retCode") != 0:
+            raise ValueError(f"kline error: {data.get('retMsg')}")
+        batch = (data.get("result") or {}).get("list") or []
+        if not batch:
+            break
+        # Bybit віддає від новіших до старіших: [startTime, open, high, low, close, volume, turnover]
+        rows.extend((int(k[0]), float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])) for k in batch)
+        oldest = min(int(k[0]) for k in batch)
+        if oldest <= start_ms or len(batch) < 1000:
+            break
+        end = oldest - 1
+    bars = save_klines(klines_dir, symbol, [r for r in rows if start_ms <= r[0] <= end_ms])
+
+    info = bot.bybit_get("/v5/market/instruments-info", {"category": "linear", "symbol": symbol}, signed=False)
+    items = (info.get("result") or {}).get("list") or []
+    if items:
+        path = os.path.join(klines_dir, "instruments.json")
+        instruments = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                instruments = json.load(f)
+        instruments[symbol] = items[0]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(instruments, f, indent=2)
+    return len(bars)
+
+
+def import_klines_csv(path, symbol, klines_dir):
+    """CSV з колонками ts,open,high,low,close[,volume] (ts — мс або секунди)."""
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            ts = float(row["ts"])
+            rows.append((int(ts * 1000 if ts < 1e11 else ts), float(row["open"]), float(row["high"]),
+                         float(row["low"]), float(row["close"]), float(row.get("volume") or 0)))
+    return len(save_klines(klines_dir, symbol, rows))
+
+
+# 📥 Сигнали
+
+def parse_time_ms(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) or str(value).replace(".", "", 1).isdigit():
+        ts = float(value)
+        return int(ts if ts > 1e11 else ts * 1000)
+    text = str(value).replace("Z", "")
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", bot.TIMESTAMP_FORMAT, "%Y-%m-%d"):
+        try:
+            return int((datetime.strptime(text, fmt) - datetime(1970, 1, 1)).total_seconds() * 1000)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid time: {value}")
+
+
+def load_signals(path):
+    signals = []
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            payload = record.get("payload", record)
+            if not isinstance(payload, dict) or bot.validate_signal(payload):
+                continue
+            ts = parse_time_ms(payload.get("bar_time") or payload.get("time") or payload.get("timenow")
+                               or record.get("received_at") or record.get("ts"))
+            if ts is None:
+                continue
+            signals.append((ts, payload))
+    signals.sort(key=lambda item: item[0])
+    return signals
+
+
+# 🧮 Симуляція
+
+def simulate_exit(bars, start, side, entry, tp, sl, trail_distance):
+    """Перший вихід після входу на свічці start. Повертає (index, exit_price, exit_reason, mae_pct)."""
+    high = np.asarray(bars["high"][start:])
+    low = np.asarray(bars["low"][start:])
+    open_ = np.asarray(bars["open"][start:])
+    n = len(high)
+    buy = side == "Buy"
+
+    stop = np.full(n, sl)
+    if trail_distance:
+        # Стоп по екстремумах попередніх свічок: у межах поточної порядок high/low невідомий
+        if buy:
+            extreme = np.maximum.accumulate(np.concatenate(([entry], high[:-1])))
+            stop = np.maximum(stop, extreme - trail_distance)
+        else:
+            extreme = np.minimum.accumulate(np.concatenate(([entry], low[:-1])))
+            stop = np.minimum(stop, extreme + trail_distance)
+
+    stop_hits = low <= stop if buy else high >= stop
+    tp_hits = high >= tp if buy else low <= tp
+    i_stop = int(np.argmax(stop_hits)) if stop_hits.any() else n
+    i_tp = int(np.argmax(tp_hits)) if tp_hits.any() else n
+
+    if i_stop < n and i_stop <= i_tp:
+        i = i_stop
+        # Геп через стоп — виконання по open
+        price = min(stop[i], open_[i]) if buy else max(stop[i], open_[i])
+        reason = "sl_hit" if stop[i] == sl else "trailing_stop"
+    elif i_tp < n:
+        i = i_tp
+        price = max(tp, open_[i]) if buy else min(tp, open_[i])
+        reason = "tp_hit"
+    else:
+        i = n - 1
+        price = float(bars["close"][start + i])
+        reason = "end_of_data"
+
+    adverse = entry - low[:i + 1].min() if buy else high[:i + 1].max() - entry
+    return start + i, float(price), reason, max(0.0, float(adverse) / entry * 100)
+
+
+def _close(trade, exit_index, exit_price, exit_reason, bars, fee_pct):
+    direction = 1 if trade["side"] == "Buy" else -1
+    qty = trade["qty"]
+    fees = (trade["entry_price"] + exit_price) * qty * fee_pct / 100
+    trade["exit_price"] = exit_price
+    trade["exit_reason"] = exit_reason
+    trade["tp_hit"] = exit_reason == "tp_hit"
+    trade["sl_hit"] = exit_reason in ("sl_hit", "trailing_stop")
+    trade["pnl"] = round((exit_price - trade["entry_price"]) * qty * direction - fees, 6)
+    trade["_exit_ts"] = int(bars["ts"][exit_index])
+    trade["runtime_sec"] = round((trade["_exit_ts"] - trade["_entry_ts"]) / 1000, 1)
+    trade["result"] = "closed"
+
+
+def run_backtest(signals, klines, params, balance=1000.0, fee_pct=0.055, keep_trades=False):
+    params = dict(DEFAULT_PARAMS, **params)
+    realized = balance
+    open_by_symbol = {}
+    trades, skipped = [], 0
+    aggregate = bot._empty_aggregate()
+
+    def realize(trade):
+        nonlocal realized
+        realized += trade["pnl"]
+        bot._add_to_aggregate(aggregate, trade["pnl"], trade["runtime_sec"], trade["exit_reason"])
+
+    for n, (ts, data) in enumerate(signals):
+        symbol = data.get("symbol", bot.default_symbol)
+        bars = klines.get(symbol)
+        if bars is None:
+            skipped += 1
+            continue
+        start = int(np.searchsorted(bars["ts"], ts, side="left"))
+        if start >= len(bars):
+            skipped += 1
+            continue
+        entry_ts = int(bars["ts"][start])
+
+        # Угоди, що закрились до цього сигналу, — у баланс
+        for other in list(open_by_symbol):
+            if open_by_symbol[other]["_exit_ts"] <= entry_ts:
+                realize(open_by_symbol.pop(other))
+
+        side = data["side"]
+        price = float(bars["open"][start])
+        tp = float(data["tp"])
+        sl = float(data["sl"])
+
+        # 📐 Розмір позиції — як calculate_dynamic_qty (по сирому SL із сигналу)
+        in_use = sum(t["qty"] * t["entry_price"] for s, t in open_by_symbol.items() if s != symbol)
+        qty, _ = bot.risk_qty(realized, price, sl, side, params["risk_percent"])
+        if qty > 0:
+            qty = bot.normalize_qty(symbol, max(qty, bot.min_order_qty(symbol, price)), market=True)
+        if qty <= 0 or qty * price > realized - in_use:
+            skipped += 1
+            continue
+
+        # 🧹 cancel: попередній захист скасовано — позицію закриваємо по ринку
+        previous = open_by_symbol.pop(symbol, None)
+        if previous is not None:
+            if previous["_exit_ts"] > entry_ts:
+                _close(previous, start, price, "replaced", bars, fee_pct)
+            realize(previous)
+
+        # 🛡 TP/SL — та сама валідація, що й у живому шляху
+        tp_rejected = not bot.is_tp_direction_valid(tp, price, side)
+        if tp_rejected:
+            tp = bot.normalize_price(symbol, bot.fallback_tp_price(price, side, params["fallback_tp_pct"]))
+        sl_auto_adjusted = not bot.is_sl_valid(sl, price, params["max_sl_distance"])
+        if sl_auto_adjusted:
+            sl = bot.normalize_price(symbol, bot.clamp_sl_price(price, side, params["max_sl_distance"]))
+
+        use_trailing = bool(data.get("trailing", False))
+        callback = params["callback"] if params["callback"] is not None else float(data.get("callback", 0.75))
+        exit_index, exit_price, exit_reason, mae_pct = simulate_exit(
+            bars, start, side, price, tp, sl, callback if use_trailing else 0
+        )
+
+        trade = {
+            "timestamp": datetime.utcfromtimestamp(entry_ts / 1000).strftime(bot.TIMESTAMP_FORMAT),
+            "symbol": symbol,
+            "side": side,
+            "qty": qty,
+            "entry_price": price,
+            "tp": tp,
+            "sl": sl,
+            "trailing": use_trailing,
+            "order_id": f"bt-{n}",
+            "result": "pending",
+            "pnl": "",
+            "exit_price": None,
+            "exit_reason": None,
+            "tp_hit": None,
+            "sl_hit": None,
+            "runtime_sec": None,
+            "sl_auto_adjusted": sl_auto_adjusted,
+            "tp_rejected": tp_rejected,
+            "drawdown_pct": round(mae_pct, 4),
+            "risk_reward": round(abs(tp - price) / abs(sl - price), 2) if tp and sl and sl != price else None,
+            "strategy_tag": data.get("strategy_tag", "tv_default"),
+            "signal_source": "backtest",
+            "order_type": "Market",
+            "_entry_ts": entry_ts,
+        }
+        _close(trade, exit_index, exit_price, exit_reason, bars, fee_pct)
+        open_by_symbol[symbol] = trade
+        trades.append(trade)
+
+    for trade in sorted(open_by_symbol.values(), key=lambda t: t["_exit_ts"]):
+        realize(trade)
+
+    summary = dict(params)
+    summary.update(bot._summarize_aggregate(aggregate))
+    summary["exit_reasons"] = json.dumps(summary["exit_reasons"], sort_keys=True)
+    summary["skipped"] = skipped
+    summary["final_balance"] = round(realized, 4)
+    return summary, (trades if keep_trades else None)
+
+
+# 🧵 Пул процесів: klines відкриваються через mmap один раз на воркер
+
+_worker_state = {}
+
+
+def _init_worker(klines_dir, signals, balance, fee_pct):
+    symbols = sorted({data.get("symbol", bot.default_symbol) for _, data in signals})
+    load_instruments(klines_dir, symbols)
+    _worker_state.update(signals=signals, klines=load_klines(klines_dir, symbols), balance=balance, fee_pct=fee_pct)
+
+
+def _run_combo(params):
+    summary, _ = run_backtest(_worker_state["signals"], _worker_state["klines"], params,
+                              _worker_state["balance"], _worker_state["fee_pct"])
+    return summary
+
+
+def parse_grid(items):
+    grid = {}
+    for item in items:
+        name, _, values = item.partition("=")
+        if name not in DEFAULT_PARAMS:
+            raise SystemExit(f"Невідомий параметр {name}; доступні: {', '.join(DEFAULT_PARAMS)}")
+        grid[name] = [float(v) for v in values.split(",") if v.strip()]
+    names = list(grid)
+    return [dict(zip(names, combo)) for combo in itertools.product(*(grid[n] for n in names))] or [{}]
+
+
+def write_trades(path, trades):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=bot.TRADE_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(trades)
+
+
+def cmd_run(args):
+    signals = load_signals(args.signals)
+    if not signals:
+        raise SystemExit(f"У {args.signals} немає валідних сигналів із часом бару")
+    combos = parse_grid(args.grid)
+    started = time.perf_counter()
+
+    if len(combos) == 1 or args.workers == 1:
+        _init_worker(args.klines_dir, signals, args.balance, args.fee_pct)
+        results = [_run_combo(params) for params in combos]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(args.klines_dir, signals, args.balance, args.fee_pct)) as pool:
+            results = list(pool.map(_run_combo, combos, chunksize=max(1, len(combos) // (args.workers * 4))))
+
+    results.sort(key=lambda r: (r.get(args.sort_by) is not None, r.get(args.sort_by) or 0), reverse=True)
+    print(f"🧪 {len(signals)} сигналів × {len(combos)} комбінацій за {time.perf_counter() - started:.2f} с")
+    for r in results[:args.top]:
+        params = ", ".join(f"{k}={r[k]}" for k in DEFAULT_PARAMS)
+        print(f"  {params} | trades={r['trades']} win_rate={r['win_rate']} pf={r['profit_factor']} "
+              f"pnl={r['total_pnl']} dd={r['max_drawdown']} skipped={r['skipped']}")
+
+    if args.out:
+        with open(args.out, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(DEFAULT_PARAMS) + SUMMARY_FIELDS + ["exit_reasons"], extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+
+    if args.trades_out:
+        # Угоди найкращої комбінації — у колонках trades.csv
+        best = {k: results[0][k] for k in DEFAULT_PARAMS}
+        if not _worker_state:
+            _init_worker(args.klines_dir, signals, args.balance, args.fee_pct)
+        _, trades = run_backtest(signals, _worker_state["klines"], best, args.balance, args.fee_pct, keep_trades=True)
+        write_trades(args.trades_out, trades)
+        print(f"📄 {len(trades)} угод → {args.trades_out}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backtest і grid sweep параметрів ризику ParsiBot")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    fetch = sub.add_parser("fetch-klines", help="завантажити klines з Bybit у локальний .npy")
+    fetch.add_argument("--symbol", required=True)
+    fetch.add_argument("--interval", default="1")
+    fetch.add_argument("--start", required=True)
+    fetch.add_argument("--end", required=True)
+    fetch.add_argument("--klines-dir", default=DEFAULT_KLINES_DIR)
+
+    imp = sub.add_parser("import-klines", help="конвертувати CSV ts,open,high,low,close у .npy")
+    imp.add_argument("--symbol", required=True)
+    imp.add_argument("--csv", required=True)
+    imp.add_argument("--klines-dir", default=DEFAULT_KLINES_DIR)
+
+    run = sub.add_parser("run", help="програти сигнали; з --grid — sweep у пулі процесів")
+    run.add_argument("--signals", required=True, help="JSONL webhook payload-ів або записів рекордера")
+    run.add_argument("--klines-dir", default=DEFAULT_KLINES_DIR)
+    run.add_argument("--grid", action="append", default=[], metavar="NAME=V1,V2",
+                     help=f"параметр для sweep: {', '.join(DEFAULT_PARAMS)}")
+    run.add_argument("--balance", type=float, default=1000.0)
+    run.add_argument("--fee-pct", type=float, default=0.055, help="taker-комісія на сторону, %%")
+    run.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    run.add_argument("--sort-by", default="total_pnl", choices=SUMMARY_FIELDS)
+    run.add_argument("--top", type=int, default=10)
+    run.add_argument("--out", help="CSV з підсумком по кожній комбінації")
+    run.add_argument("--trades-out", help="CSV угод найкращої комбінації (колонки trades.csv)")
+
+    args = parser.parse_args(argv)
+    if args.command == "fetch-klines":
+        count = fetch_klines(args.symbol, args.interval, parse_time_ms(args.start), parse_time_ms(args.end), args.klines_dir)
+        print(f"📦 {args.symbol}: {count} свічок → {klines_path(args.klines_dir, args.symbol)}")
+        return 0
+    if args.command == "import-klines":
+        count = import_klines_csv(args.csv, args.symbol, args.klines_dir)
+        print(f"📦 {args.symbol}: {count} свічок → {klines_path(args.klines_dir, args.symbol)}")
+        return 0
+    return cmd_run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,587 @@
+"""Офлайн-бенчмарк ParsiBot: локальні заглушки Bybit v5 + Telegram, залп сигналів на /webhook.
+
+python benchmark.py --signals 200 --concurrency 20 --latency-ms 30 --failure-rate 0.01
+python benchmark.py --max-ack-p99-ms 50 --max-e2e-p99-ms 1500 --max-requests-per-signal 8   # CI-режим
+"""
+import argparse
+import gzip
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+SAMPLE_SIGNAL = {
+    "password": "12345",
+    "side": "Buy",
+    "symbol": "BTCUSDT",
+    "tp": 103000,
+    "sl": 98000,
+    "trailing": True,
+    "callback": 0.75,
+    "strategy_tag": "bench"
+}
+
+# UID-ліміти Bybit v5 (linear), запитів за секунду
+UID_LIMITS = {
+    "/v5/order/create": 10,
+    "/v5/order/create-batch": 10,
+    "/v5/order/cancel": 10,
+    "/v5/order/cancel-all": 10,
+    "/v5/position/trading-stop": 10,
+    "/v5/order/realtime": 50,
+    "/v5/order/history": 50,
+    "/v5/execution/list": 50,
+    "/v5/account/wallet-balance": 50,
+    "/v5/position/closed-pnl": 50,
+}
+
+
+# 🧪 Заглушка Bybit v5 + Telegram з налаштовуваною латентністю і часткою помилок
+
+class MockExchange:
+    def __init__(self, latency_ms=20.0, jitter_ms=5.0, failure_rate=0.0, endpoint_latency=None, prices=None,
+                 lost_response_rate=0.0, clock_skew_ms=0.0, close_after_sec=None, sl_rate=0.3, on_close=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.lost_response_rate = lost_response_rate  # запит виконано, але відповідь загублено (504)
+        self.clock_skew_ms = clock_skew_ms
+        self.orders_by_link = {}
+        # Життєвий цикл позиції: через close_after_sec спрацьовує TP або SL (з імовірністю sl_rate)
+        self.close_after_sec = close_after_sec
+        self.sl_rate = sl_rate
+        self.on_close = on_close
+        self.positions = []
+        self.closed_pnl = []
+        self.close_orders = []
+        self.endpoint_latency = endpoint_latency or {}
+        self.prices = prices or {}
+        self.hits = Counter()
+        self.failures = Counter()
+        self.lock = threading.Lock()
+        self.order_ids = itertools.count(1)
+        self.windows = {}
+        self.server = None
+
+    def delay(self, path):
+        base = self.endpoint_latency.get(path, self.latency_ms)
+        time.sleep(max(0.0, random.gauss(base, self.jitter_ms)) / 1000)
+
+    def take_limit(self, path):
+        """Емуляція UID-лімітів Bybit: вікно 1 с на endpoint; повертає заголовки або None при 10006."""
+        limit = UID_LIMITS.get(path)
+        if limit is None:
+            return {}, True
+        now = time.time()
+        with self.lock:
+            window_start, used = self.windows.get(path, (now, 0))
+            if now - window_start >= 1:
+                window_start, used = now, 0
+            allowed = used < limit
+            if allowed:
+                used += 1
+            self.windows[path] = (window_start, used)
+        headers = {
+            "X-Bapi-Limit": str(limit),
+            "X-Bapi-Limit-Status": str(limit - used),
+            "X-Bapi-Limit-Reset-Timestamp": str(int((window_start + 1) * 1000)),
+        }
+        return headers, allowed
+
+    def price(self, symbol):
+        return self.prices.get(symbol, 100000.0)
+
+    def create_order(self, leg):
+        link = leg.get("orderLinkId", "")
+        with self.lock:
+            if link and link in self.orders_by_link:
+                return None
+            order_id = f"bench-{next(self.order_ids)}"
+            if link:
+                self.orders_by_link[link] = order_id
+            self.track_position(order_id, leg)
+        return {"orderId": order_id, "orderLinkId": link}
+
+    def track_position(self, order_id, leg):
+        if self.close_after_sec is None:
+            return
+        symbol = leg.get("symbol", "BTCUSDT")
+        if not leg.get("reduceOnly"):
+            if leg.get("orderType") == "Market":
+                opened_ms = time.time() * 1000
+                self.positions.append({
+                    "symbol": symbol, "side": leg["side"], "qty": float(leg["qty"]), "entry": self.price(symbol),
+                    "tp": float(leg.get("takeProfit") or 0), "sl": float(leg.get("stopLoss") or 0),
+                    "order_id": order_id, "close_at_ms": opened_ms + self.close_after_sec * 1000, "closed": False
+                })
+            return
+        # Захисна нога з create-batch: limit — TP, умовний — SL останньої позиції символу
+        for position in reversed(self.positions):
+            if position["symbol"] == symbol and not position["closed"]:
+                if leg.get("triggerPrice"):
+                    position["sl"] = position["sl"] or float(leg["triggerPrice"])
+                elif leg.get("price"):
+                    position["tp"] = position["tp"] or float(leg["price"])
+                return
+
+    def close_due_positions(self):
+        now_ms = time.time() * 1000
+        closed = []
+        with self.lock:
+            for position in self.positions:
+                if position["closed"] or position["close_at_ms"] > now_ms:
+                    continue
+                position["closed"] = True
+                hit_sl = bool(position["sl"]) and (random.random() < self.sl_rate or not position["tp"])
+                exit_price = position["sl"] if hit_sl else position["tp"] or position["entry"]
+                direction = 1 if position["side"] == "Buy" else -1
+                fees = (position["entry"] + exit_price) * position["qty"] * 0.00055
+                close_side = "Sell" if position["side"] == "Buy" else "Buy"
+                created = str(int(position["close_at_ms"] + self.clock_skew_ms))
+                close_id = f"bench-{next(self.order_ids)}"
+                self.closed_pnl.append({
+                    "symbol": position["symbol"], "orderId": close_id, "side": close_side,
+                    "qty": str(position["qty"]), "closedSize": str(position["qty"]), "orderType": "Market",
+                    "avgEntryPrice": str(position["entry"]), "avgExitPrice": str(exit_price),
+                    "closedPnl": str(round((exit_price - position["entry"]) * direction * position["qty"] - fees, 8)),
+                    "createdTime": created, "updatedTime": created
+                })
+                close_order = {
+                    "symbol": position["symbol"], "orderId": close_id, "side": close_side, "orderType": "Market",
+                    "orderStatus": "Filled", "reduceOnly": True, "stopOrderType": "StopLoss" if hit_sl else "TakeProfit",
+                    "avgPrice": str(exit_price), "qty": str(position["qty"]), "cumExecQty": str(position["qty"]),
+                    "createdTime": created, "updatedTime": created
+                }
+                self.close_orders.append(close_order)
+                closed.append((position, close_order))
+        for position, close_order in closed:
+            if self.on_close:
+                self.on_close(position, close_order)
+
+    def _closer(self):
+        while True:
+            time.sleep(0.05)
+            self.close_due_positions()
+
+    def history_page(self, records, query):
+        """Вибірка з фільтром startTime/endTime і курсором-зсувом, від новіших до старіших."""
+        start = int(query.get("startTime") or 0)
+        end = int(query.get("endTime") or 2 ** 62)
+        symbol = query.get("symbol")
+        with self.lock:
+            rows = [r for r in records if (not symbol or r["symbol"] == symbol) and start <= int(r["createdTime"]) <= end]
+        rows.sort(key=lambda r: int(r["createdTime"]), reverse=True)
+        offset = int(query.get("cursor") or 0)
+        limit = int(query.get("limit") or 50)
+        page = rows[offset:offset + limit]
+        cursor = str(offset + limit) if offset + limit < len(rows) else ""
+        return _ok({"list": page, "nextPageCursor": cursor})
+
+    def route(self, method, path, query, body):
+        now_ms = int(time.time() * 1000 + self.clock_skew_ms)
+        symbol = query.get("symbol") or body.get("symbol") or "BTCUSDT"
+        price = self.price(symbol)
+
+        if "/sendMessage" in path:
+            return {"ok": True, "result": {}}
+        if path == "/v5/market/tickers":
+            return _ok({"list": [{"symbol": symbol, "lastPrice": str(price), "bid1Price": str(price * 0.9999), "ask1Price": str(price * 1.0001)}]})
+        if path == "/v5/market/time":
+            return _ok({"timeSecond": str(now_ms // 1000), "timeNano": str(now_ms * 1000000)})
+        if path == "/v5/market/instruments-info":
+            symbols = [query["symbol"]] if query.get("symbol") else list(self.prices) or ["BTCUSDT"]
+            return _ok({"list": [_instrument(s) for s in symbols], "nextPageCursor": ""})
+        if path == "/v5/market/orderbook":
+            return _ok({"s": symbol, "b": [[str(price * (1 - i / 10000)), "50"] for i in range(1, 51)],
+                        "a": [[str(price * (1 + i / 10000)), "50"] for i in range(1, 51)], "ts": now_ms, "u": 1, "seq": 1})
+        if path == "/v5/account/wallet-balance":
+            return _ok({"list": [{"accountType": "UNIFIED", "totalEquity": "100000", "totalAvailableBalance": "100000",
+                                  "coin": [{"coin": "USDT", "equity": "100000", "walletBalance": "100000"}]}]})
+        if path in ("/v5/order/list", "/v5/order/realtime"):
+            order_id = self.orders_by_link.get(query.get("orderLinkId"))
+            orders = [{"orderId": order_id, "orderLinkId": query["orderLinkId"], "orderStatus": "Filled"}] if order_id else []
+            return _ok({"list": orders, "nextPageCursor": ""})
+        if path == "/v5/order/cancel":
+            return _ok({"orderId": body.get("orderId"), "orderLinkId": ""})
+        if path == "/v5/order/cancel-all":
+            return _ok({"list": [], "success": "1"})
+        if path == "/v5/order/create":
+            order = self.create_order(body)
+            if order is None:
+                return {"retCode": 110072, "retMsg": "OrderLinkedID is duplicate", "result": {}, "retExtInfo": {}, "time": now_ms}
+            return _ok(order)
+        if path == "/v5/order/create-batch":
+            orders = [self.create_order(leg) for leg in body.get("request", [])]
+            return _ok({"list": [order or {"orderId": "", "orderLinkId": ""} for order in orders]},
+                       {"list": [{"code": 0, "msg": "OK"} if order else {"code": 110072, "msg": "OrderLinkedID is duplicate"}
+                                 for order in orders]})
+        if path == "/v5/position/trading-stop":
+            return _ok({})
+        if path == "/v5/execution/list":
+            return _ok({"list": [{"orderId": query.get("orderId"), "execPrice": str(price), "execQty": "1",
+                                  "execTime": str(now_ms), "execType": "Trade"}], "nextPageCursor": ""})
+        if path == "/v5/order/history":
+            return self.history_page(self.close_orders, query)
+        if path == "/v5/position/closed-pnl":
+            return self.history_page(self.closed_pnl, query)
+        return None
+
+    def handler(self):
+        exchange = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw or b"{}")
+                except ValueError:
+                    body = {}
+
+                path = url.path
+                key = "telegram/sendMessage" if "/sendMessage" in path else path
+                with exchange.lock:
+                    exchange.hits[key] += 1
+                exchange.delay(key)
+
+                if random.random() < exchange.failure_rate:
+                    with exchange.lock:
+                        exchange.failures[key] += 1
+                    return self._send(503, {"retCode": 10016, "retMsg": "Service unavailable (mock)"})
+
+                if "X-BAPI-TIMESTAMP" in self.headers:
+                    skew = abs(int(self.headers["X-BAPI-TIMESTAMP"]) - (time.time() * 1000 + exchange.clock_skew_ms))
+                    if skew > int(self.headers.get("X-BAPI-RECV-WINDOW") or 5000):
+                        with exchange.lock:
+                            exchange.failures[f"{key} (10002)"] += 1
+                        return self._send(200, {"retCode": 10002, "retMsg": "invalid request, please check your server timestamp or recv_window param"})
+
+                limit_headers, allowed = exchange.take_limit(path)
+                if not allowed:
+                    with exchange.lock:
+                        exchange.failures[f"{key} (10006)"] += 1
+                    return self._send(200, {"retCode": 10006, "retMsg": "Too many visits!"}, limit_headers)
+
+                payload = exchange.route(method, path, query, body)
+                if payload is None:
+                    return self._send(404, {"retCode": 404, "retMsg": f"Unknown endpoint {path}"})
+                if key != "telegram/sendMessage" and random.random() < exchange.lost_response_rate:
+                    with exchange.lock:
+                        exchange.failures[f"{key} (lost)"] += 1
+                    return self._send(504, {"retCode": 10000, "retMsg": "Server Timeout (mock)"})
+                self._send(200, payload, limit_headers)
+
+            def _send(self, status, payload, extra_headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (extra_headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        return Handler
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.close_after_sec is not None:
+            threading.Thread(target=self._closer, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.hits), Counter(self.failures)
+
+
+def _ok(result, ext=None):
+    return {"retCode": 0, "retMsg": "OK", "result": result, "retExtInfo": ext or {}, "time": int(time.time() * 1000)}
+
+
+def _instrument(symbol):
+    return {
+        "symbol": symbol,
+        "status": "Trading",
+        "lotSizeFilter": {"qtyStep": "0.001", "minOrderQty": "0.001", "maxOrderQty": "1000",
+                          "maxMktOrderQty": "500", "minNotionalValue": "5"},
+        "priceFilter": {"tickSize": "0.1"}
+    }
+
+
+# 🚀 Бот у цьому ж процесі, спрямований на заглушки
+
+def start_bot(mock_url, workdir, password, protection_mode="separate"):
+    os.environ.update({
+        "protection_mode": protection_mode,
+        "api_key": "bench-key",
+        "api_secret": "bench-secret",
+        "webhook_password": password,
+        "telegram_token": "bench",
+        "telegram_chat_id": "1",
+        "env": "test",
+        "ws_enabled": "False",
+        "bybit_base_url": mock_url,
+        "telegram_api_url": mock_url,
+        "data_dir": workdir,
+    })
+    os.environ.pop("GOOGLE_SERVICE_JSON", None)
+    os.chdir(workdir)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    app = bot.create_app(wait_warmup=True)
+
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return bot, f"http://127.0.0.1:{server.server_port}"
+
+
+def load_signals(path):
+    if not path:
+        return [dict(SAMPLE_SIGNAL)]
+    signals = []
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            # Підтримуємо і «голі» payload-и, і записи рекордера ({"payload": {...}})
+            payload = record.get("payload", record)
+            if isinstance(payload, dict) and payload.get("side"):
+                signals.append(payload)
+    if not signals:
+        raise SystemExit(f"У {path} немає webhook-сигналів")
+    return signals
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_burst(bot_url, signals, count, concurrency, symbols, password, job_timeout):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency * 2)
+    session.mount("http://", adapter)
+
+    def fire(i):
+        payload = dict(signals[i % len(signals)])
+        payload["password"] = password
+        if symbols:
+            payload["symbol"] = symbols[i % len(symbols)]
+        payload.setdefault("order_link_id", f"bench-{i}-{time.time_ns()}")
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{bot_url}/webhook", json=payload, timeout=30)
+        except requests.RequestException as e:
+            return {"ack": None, "e2e": None, "ok": False, "error": str(e)}
+        ack = time.perf_counter() - started
+        body = response.json() if response.content else {}
+        job_id = body.get("job_id")
+        if response.status_code not in (200, 202) or not job_id:
+            return {"ack": ack, "e2e": ack if response.status_code == 200 else None,
+                    "ok": response.status_code == 200, "error": body.get("error")}
+
+        # ⏳ Чекаємо завершення задачі через /jobs/<id>
+        deadline = started + job_timeout
+        while time.perf_counter() < deadline:
+            job = session.get(f"{bot_url}/jobs/{job_id}", timeout=10).json()
+            if job.get("status") in ("done", "failed"):
+                return {"ack": ack, "e2e": time.perf_counter() - started,
+                        "ok": job["status"] == "done", "error": (job.get("result") or {}).get("error")}
+            time.sleep(0.005)
+        return {"ack": ack, "e2e": None, "ok": False, "error": "job timeout"}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fire, range(count)))
+    return results, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк ParsiBot з заглушками Bybit і Telegram")
+    parser.add_argument("--signals", type=int, default=100, help="кількість сигналів у залпі")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--bursts", type=int, default=1)
+    parser.add_argument("--signals-file", help="JSONL з webhook payload-ами (за замовчуванням — вбудований приклад)")
+    parser.add_argument("--symbols", default="BTCUSDT,SOLUSDT,ETHUSDT", help="символи, по яких розкидаються сигнали")
+    parser.add_argument("--price", type=float, default=100000.0, help="ціна заглушки (tp/sl сигналів мають їй відповідати)")
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--lost-response-rate", type=float, default=0.0,
+                        help="частка запитів, виконаних біржею, але з загубленою відповіддю (504)")
+    parser.add_argument("--clock-skew-ms", type=float, default=0.0, help="зсув годинника біржі відносно локального")
+    parser.add_argument("--endpoint-latency", action="append", default=[], metavar="PATH=MS",
+                        help="латентність для окремого endpoint, напр. /v5/order/create=80")
+    parser.add_argument("--protection-mode", choices=("separate", "attached"), default="separate",
+                        help="TP/SL окремими ордерами чи прикріплені до маркет-ордера")
+    parser.add_argument("--job-timeout", type=float, default=30.0)
+    parser.add_argument("--close-after-sec", type=float, default=1.0,
+                        help="через скільки секунд після входу біржа закриває позицію по TP/SL (-1 — ніколи)")
+    parser.add_argument("--sl-rate", type=float, default=0.3, help="частка позицій, закритих по SL")
+    parser.add_argument("--close-wait-sec", type=float, default=30.0, help="скільки чекати, поки трекер побачить закриття")
+    parser.add_argument("--json", action="store_true", help="вивести звіт у JSON")
+    parser.add_argument("--max-ack-p99-ms", type=float)
+    parser.add_argument("--max-e2e-p99-ms", type=float)
+    parser.add_argument("--max-requests-per-signal", type=float)
+    parser.add_argument("--min-success-rate", type=float)
+    args = parser.parse_args(argv)
+
+    endpoint_latency = {}
+    for item in args.endpoint_latency:
+        path, _, ms = item.partition("=")
+        endpoint_latency[path] = float(ms)
+
+    symbols = [s.strip() for s in args.symbols.split(",") if s.strip()]
+    closes = {}  # order_id входу -> perf_counter закриття на біржі
+
+    def on_close(position, close_order):
+        closes[position["order_id"]] = time.perf_counter()
+        # ws у бенчмарку вимкнено — подію приватного стріму доставляємо напряму, як це зробив би pybit
+        bot._on_order({"topic": "order", "data": [close_order]})
+
+    close_after = None if args.close_after_sec < 0 else args.close_after_sec
+    mock = MockExchange(args.latency_ms, args.jitter_ms, args.failure_rate, endpoint_latency,
+                        prices={s: args.price for s in symbols}, lost_response_rate=args.lost_response_rate,
+                        clock_skew_ms=args.clock_skew_ms, close_after_sec=close_after, sl_rate=args.sl_rate,
+                        on_close=on_close)
+    mock_url = mock.start()
+
+    password = "bench-password"
+    workdir = tempfile.mkdtemp(prefix="parsibot-bench-")
+    bot, bot_url = start_bot(mock_url, workdir, password, args.protection_mode)
+    signals = load_signals(args.signals_file)
+
+    # 🔥 Прогрів: кеш інструментів, баланс, з'єднання
+    run_burst(bot_url, signals, min(len(symbols), 3) or 1, 1, symbols, password, args.job_timeout)
+    warm_hits, _ = mock.snapshot()
+
+    results, elapsed = [], 0.0
+    for _ in range(args.bursts):
+        burst, burst_elapsed = run_burst(bot_url, signals, args.signals, args.concurrency, symbols, password, args.job_timeout)
+        results.extend(burst)
+        elapsed += burst_elapsed
+
+    hits, failures = mock.snapshot()
+    hits.subtract(warm_hits)
+
+    # 🏁 Закриття: чекаємо, поки трекер побачить закриті біржею позиції
+    detected = {}
+    if close_after is not None:
+        deadline = time.perf_counter() + args.close_wait_sec + close_after
+        expected = {p["order_id"] for p in mock.positions}
+        while time.perf_counter() < deadline:
+            still_open = {t["order_id"] for t in bot.get_open_trades()}
+            now = time.perf_counter()
+            for order_id in expected - still_open - set(detected):
+                if order_id in closes:
+                    detected[order_id] = now - closes[order_id]
+            if len(detected) == len(expected):
+                break
+            time.sleep(0.02)
+    close_hits, _ = mock.snapshot()
+    close_hits.subtract(warm_hits)
+    close_hits.subtract(hits)
+    result_col, pnl_col = bot.TRADE_FIELDS.index("result"), bot.TRADE_FIELDS.index("pnl")
+    pnls = [float(row[pnl_col]) for row in bot.query_trades() if row[result_col] == "closed" and row[pnl_col] not in (None, "")]
+    bybit_requests = sum(v for k, v in hits.items() if k.startswith("/v5/"))
+    telegram_requests = hits.get("telegram/sendMessage", 0)
+    total = len(results)
+    ack = [r["ack"] * 1000 for r in results if r["ack"] is not None]
+    e2e = [r["e2e"] * 1000 for r in results if r["e2e"] is not None]
+    ok = sum(1 for r in results if r["ok"])
+
+    report = {
+        "signals": total,
+        "success_rate": ok / total if total else 0.0,
+        "throughput_signals_per_sec": total / elapsed if elapsed else 0.0,
+        "ack_ms": {"p50": percentile(ack, 50), "p99": percentile(ack, 99), "mean": statistics.fmean(ack) if ack else 0.0},
+        "e2e_ms": {"p50": percentile(e2e, 50), "p99": percentile(e2e, 99), "mean": statistics.fmean(e2e) if e2e else 0.0},
+        "bybit_requests_per_signal": bybit_requests / total if total else 0.0,
+        "telegram_requests_per_signal": telegram_requests / total if total else 0.0,
+        "requests_by_endpoint": {k: v for k, v in sorted(hits.items()) if v},
+        "injected_failures": dict(failures),
+        "errors": dict(Counter(r["error"] for r in results if r["error"]).most_common(5)),
+        "closes": {
+            "positions": len(mock.positions),
+            "closed_by_exchange": len(closes),
+            "detected": len(detected),
+            "detect_ms": {"p50": percentile([v * 1000 for v in detected.values()], 50),
+                          "p99": percentile([v * 1000 for v in detected.values()], 99)},
+            "tracker_requests": {k: v for k, v in sorted(close_hits.items()) if v and k.startswith("/v5/")},
+            "losing_trades": sum(1 for pnl in pnls if pnl < 0),
+            "winning_trades": sum(1 for pnl in pnls if pnl > 0),
+        },
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print(f"📊 Сигналів: {total}, успішно: {report['success_rate']:.1%}, throughput: {report['throughput_signals_per_sec']:.1f}/s")
+        print(f"⚡ ACK  p50={report['ack_ms']['p50']:.1f} ms  p99={report['ack_ms']['p99']:.1f} ms")
+        print(f"🏁 E2E  p50={report['e2e_ms']['p50']:.1f} ms  p99={report['e2e_ms']['p99']:.1f} ms")
+        print(f"🔁 Bybit запитів/сигнал: {report['bybit_requests_per_signal']:.2f}, Telegram: {report['telegram_requests_per_signal']:.2f}")
+        for endpoint, count in report["requests_by_endpoint"].items():
+            print(f"   {endpoint}: {count}")
+        if report["errors"]:
+            print(f"⚠️ Помилки: {report['errors']}")
+        if close_after is not None:
+            closes_report = report["closes"]
+            print(f"🏁 Закрито біржею: {closes_report['closed_by_exchange']}/{closes_report['positions']}, трекер побачив: "
+                  f"{closes_report['detected']} (p50={closes_report['detect_ms']['p50']:.0f} ms p99={closes_report['detect_ms']['p99']:.0f} ms), "
+                  f"TP/SL: {closes_report['winning_trades']}/{closes_report['losing_trades']}, запити трекера: {closes_report['tracker_requests']}")
+
+    # 🚦 Пороги для CI
+    violations = []
+    if args.max_ack_p99_ms is not None and report["ack_ms"]["p99"] > args.max_ack_p99_ms:
+        violations.append(f"ack p99 {report['ack_ms']['p99']:.1f} ms > {args.max_ack_p99_ms}")
+    if args.max_e2e_p99_ms is not None and report["e2e_ms"]["p99"] > args.max_e2e_p99_ms:
+        violations.append(f"e2e p99 {report['e2e_ms']['p99']:.1f} ms > {args.max_e2e_p99_ms}")
+    if args.max_requests_per_signal is not None and report["bybit_requests_per_signal"] > args.max_requests_per_signal:
+        violations.append(f"requests/signal {report['bybit_requests_per_signal']:.2f} > {args.max_requests_per_signal}")
+    if args.min_success_rate is not None and report["success_rate"] < args.min_success_rate:
+        violations.append(f"success rate {report['success_rate']:.1%} < {args.min_success_rate:.1%}")
+    for violation in violations:
+        print(f"❌ {violation}", file=sys.stderr)
+
+    bot.flush_telegram(timeout=2)
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,49 +4,289 @@ import hmac
 import json
 import csv
 import hashlib
+import sqlite3
+import zlib
+import queue
+import atexit
+import threading
+import uuid
+import random
+import bisect
+import heapq
+from array import array
+from contextlib import contextmanager
 import requests
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from flask import Flask, request, send_file
+from requests.adapters import HTTPAdapter
+from flask import Blueprint, Flask, Response, request
+from werkzeug.http import http_date
 from dotenv import load_dotenv
 from datetime import datetime
+from decimal import Decimal, ROUND_DOWN, ROUND_HALF_UP, ROUND_UP
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 import io
 
+try:
+    import fcntl
+except ImportError:  # Windows: міжпроцесних локів немає, працюємо як один процес
+    fcntl = None
+
 load_dotenv("bot.env")
 
-api_key = os.environ["api_key"]
-api_secret = os.environ["api_secret"]
+# Обов'язкові змінні перевіряються в create_app(), щоб імпорт модуля не падав і не мав побічних ефектів
+REQUIRED_ENV = ("api_key", "api_secret", "webhook_password", "telegram_token", "telegram_chat_id")
+
+api_key = os.environ.get("api_key", "")
+api_secret = os.environ.get("api_secret", "")
 default_symbol = os.environ.get("symbol", "BTCUSDT")
 default_base_qty = float(os.environ.get("base_qty", 0.01))
-webhook_password = os.environ["webhook_password"]
-telegram_token = os.environ["telegram_token"]
-telegram_chat_id = os.environ["telegram_chat_id"]
+webhook_password = os.environ.get("webhook_password", "")
+telegram_token = os.environ.get("telegram_token", "")
+telegram_chat_id = os.environ.get("telegram_chat_id", "")
 env = os.environ.get("env", "live")
 debug_responses = os.environ.get("debug_responses", "False").lower() == "true"
-base_url = "https://api-testnet.bybit.com" if env == "test" else "https://api.bybit.com"
+base_url = os.environ.get("bybit_base_url") or ("https://api-testnet.bybit.com" if env == "test" else "https://api.bybit.com")
+telegram_api_url = os.environ.get("telegram_api_url", "https://api.telegram.org")
+recv_window = os.environ.get("recv_window", "5000")
+ws_enabled = os.environ.get("ws_enabled", "True").lower() == "true"
+tracked_symbols = [s.strip() for s in os.environ.get("symbols", default_symbol).split(",") if s.strip()]
 
     
 MAX_SL_DISTANCE_PERC = 0.07
+FALLBACK_TP_PCT = 0.02
+RISK_PERCENT = 0.2
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CSV_LOG_PATH = os.path.join(BASE_DIR, "trades.csv")
+DATA_DIR = os.environ.get("data_dir", BASE_DIR)  # стан бота (БД, spool, локи) — на спільному диску для всіх воркерів
+CSV_LOG_PATH = os.path.join(DATA_DIR, "trades.csv")
+TRADES_DB_PATH = os.path.join(DATA_DIR, "trades.db")
 
-app = Flask(__name__)
+bp = Blueprint("parsibot", __name__)
 
-# ... всі імпорти + os.environ ...
-env = os.environ.get("env", "live")
-base_url = "https://api-testnet.bybit.com" if env == "test" else "https://api.bybit.com"
 
-app = Flask(__name__)
+# 🔒 Міжпроцесний лок на файл стану: кілька WSGI-воркерів пишуть у ті самі журнали
+
+@contextmanager
+def file_lock(path):
+    with open(f"{path}.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# 📈 Метрики: гістограми латентності + лічильники помилок, формат Prometheus (/metrics)
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_histograms = {}  # (name, labels) -> [counts по бакетах + overflow, sum, count]
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> value
+_metrics_lock = threading.Lock()
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(METRIC_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc(name.replace("_seconds", "_errors_total"), **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_metrics():
+    with _metrics_lock:
+        histograms = {k: (list(v[0]), v[1], v[2]) for k, v in _histograms.items()}
+        counters = dict(_counters)
+    gauges = dict(_gauges)
+
+    lines = []
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        seen = set()
+        for (name, labels), value in sorted(series.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} {kind}")
+                seen.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    seen = set()
+    for (name, labels), (counts, total, count) in sorted(histograms.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} histogram")
+            seen.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(METRIC_BUCKETS, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
 
 # 🟢 ТЕПЕР функція send_telegram_message
-def send_telegram_message(message):
-    url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
-    data = {"chat_id": telegram_chat_id, "text": message}
+# 📨 Неблокуючий нотифікатор: обмежена черга + фоновий потік, який склеює
+# повідомлення за коротке вікно в один пост і тримає ліміт Telegram на чат
+
+TG_DEBUG, TG_INFO, TG_WARNING, TG_ERROR = 10, 20, 30, 40
+TG_LEVELS = {"debug": TG_DEBUG, "info": TG_INFO, "warning": TG_WARNING, "error": TG_ERROR}
+
+telegram_min_level = TG_LEVELS.get(os.environ.get("telegram_level", "debug").lower(), TG_DEBUG)
+TELEGRAM_QUEUE_SIZE = int(os.environ.get("telegram_queue_size", 500))
+TELEGRAM_COALESCE_SEC = float(os.environ.get("telegram_coalesce_sec", 0.5))
+TELEGRAM_MIN_INTERVAL_SEC = 1.05  # Telegram: не частіше ~1 повідомлення/сек в один чат
+TELEGRAM_MAX_LEN = 4096
+TELEGRAM_DEBUG_DROP_AT = TELEGRAM_QUEUE_SIZE // 2  # під навантаженням debug-дампи відкидаються
+
+telegram_session = requests.Session()
+_telegram_queue = queue.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+_telegram_thread = None
+_telegram_lock = threading.Lock()
+telegram_dropped = 0
+
+
+def send_telegram_message(message, level=TG_INFO):
+    global telegram_dropped
+    if level < telegram_min_level:
+        return
+    if level < TG_INFO and _telegram_queue.qsize() >= TELEGRAM_DEBUG_DROP_AT:
+        telegram_dropped += 1
+        return
+    if _telegram_thread is None:
+        start_telegram_worker()
     try:
-        requests.post(url, json=data)
-    except Exception as e:
-        print(f"Telegram Error: {e}")
+        _telegram_queue.put_nowait(str(message))
+    except queue.Full:
+        telegram_dropped += 1
+        print(f"⚠️ Telegram queue full, dropped: {str(message)[:80]}")
+
+
+def start_telegram_worker():
+    global _telegram_thread
+    with _telegram_lock:
+        if _telegram_thread is None:
+            _telegram_thread = threading.Thread(target=_telegram_worker, name="telegram", daemon=True)
+            _telegram_thread.start()
+
+
+def _telegram_chunks(messages):
+    chunk = ""
+    for message in messages:
+        while len(message) > TELEGRAM_MAX_LEN:
+            if chunk:
+                yield chunk
+                chunk = ""
+            yield message[:TELEGRAM_MAX_LEN]
+            message = message[TELEGRAM_MAX_LEN:]
+        if chunk and len(chunk) + 2 + len(message) > TELEGRAM_MAX_LEN:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n\n{message}" if chunk else message
+    if chunk:
+        yield chunk
+
+
+def _telegram_post(text):
+    url = f"{telegram_api_url}/bot{telegram_token}/sendMessage"
+    data = {"chat_id": telegram_chat_id, "text": text}
+    for _ in range(3):
+        try:
+            with timed("parsibot_telegram_request_seconds"):
+                response = telegram_session.post(url, json=data, timeout=(3.05, 10))
+            if response.status_code != 429:
+                if response.status_code >= 400:
+                    inc("parsibot_telegram_errors_total", status=response.status_code)
+                return
+            inc("parsibot_telegram_errors_total", status=429)
+            # ⏳ Telegram просить почекати — поважаємо retry_after
+            retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            time.sleep(min(float(retry_after), 30))
+        except Exception as e:
+            print(f"Telegram Error: {e}")
+            return
+
+
+def _telegram_worker():
+    last_post = 0.0
+    running = True
+    while running:
+        message = _telegram_queue.get()
+        if message is None:
+            break
+        batch = [message]
+
+        # 🧲 Збираємо все, що прийшло у вікні склеювання (і поки чекаємо rate limit)
+        deadline = max(time.monotonic() + TELEGRAM_COALESCE_SEC, last_post + TELEGRAM_MIN_INTERVAL_SEC)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                message = _telegram_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if message is None:
+                running = False
+                break
+            batch.append(message)
+
+        for text in _telegram_chunks(batch):
+            wait = last_post + TELEGRAM_MIN_INTERVAL_SEC - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            _telegram_post(text)
+            last_post = time.monotonic()
+
+
+def flush_telegram(timeout=10):
+    global _telegram_thread
+    thread = _telegram_thread
+    if thread is None:
+        return
+    try:
+        _telegram_queue.put(None, timeout=timeout)
+    except queue.Full:
+        return
+    thread.join(timeout)
+    with _telegram_lock:
+        _telegram_thread = None
+
+
+atexit.register(flush_telegram)
 
 # ✅ І лише тепер: режим
 def announce_mode():
@@ -58,418 +298,1219 @@ def announce_mode():
     except:
         print("⚠️ Telegram не ініціалізовано")
 
-# 🔁 Викликаємо
-announce_mode()
 
+# 🔌 Єдиний підписаний клієнт Bybit: пул keep-alive з'єднань, таймаути, кешований HMAC
+
+BYBIT_DEFAULT_TIMEOUT = (3.05, 10)  # (connect, read) секунд
+BYBIT_TIMEOUTS = {
+    "/v5/market/tickers": (2, 3),
+    "/v5/order/create": (3.05, 5),
+    "/v5/order/cancel": (3.05, 5),
+    "/v5/position/trading-stop": (3.05, 5),
+    "/v5/account/wallet-balance": (3.05, 5),
+    "/v5/execution/list": (3.05, 5),
+    "/v5/order/realtime": (3.05, 5),
+}
+
+bybit_session = requests.Session()
+_bybit_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=32, max_retries=0)
+bybit_session.mount("https://", _bybit_adapter)
+bybit_session.mount("http://", _bybit_adapter)
+bybit_session.headers.update({"Content-Type": "application/json"})
+
+# Заголовки та HMAC-ключ готуються один раз, на запит лише timestamp + підпис
+_BYBIT_AUTH_HEADERS = {
+    "X-BAPI-API-KEY": api_key,
+    "X-BAPI-RECV-WINDOW": recv_window,
+}
+_bybit_hmac = hmac.new(bytes(api_secret, "utf-8"), digestmod=hashlib.sha256)
+
+
+def bybit_sign(timestamp, payload_str):
+    mac = _bybit_hmac.copy()
+    mac.update(f"{timestamp}{api_key}{recv_window}{payload_str}".encode("utf-8"))
+    return mac.hexdigest()
+
+
+# 🚦 Token bucket на групу endpoint-ів: ліміти Bybit per-UID, калібруються з X-Bapi-Limit*
+RATE_LIMIT_MAX_WAIT_SEC = float(os.environ.get("rate_limit_max_wait_sec", 5))
+RATE_LIMIT_RESERVE = float(os.environ.get("rate_limit_reserve", 0.3))  # частка bucket-а лише для ордерів
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+# group -> запитів/сек за замовчуванням (до першої відповіді з заголовками)
+RATE_LIMIT_GROUPS = {
+    "/v5/order/create": ("order_create", 10),
+    "/v5/order/create-batch": ("order_create_batch", 10),
+    "/v5/order/amend": ("order_amend", 10),
+    "/v5/order/cancel": ("order_cancel", 10),
+    "/v5/order/cancel-all": ("order_cancel_all", 10),
+    "/v5/position/trading-stop": ("trading_stop", 10),
+    "/v5/order/realtime": ("order_query", 50),
+    "/v5/order/history": ("order_history", 50),
+    "/v5/execution/list": ("execution", 50),
+    "/v5/account/wallet-balance": ("account", 50),
+    "/v5/position/closed-pnl": ("closed_pnl", 50),
+}
+RATE_LIMIT_IP = ("ip", 120)  # спільний IP-ліміт 600 запитів за 5 с; /v5/market/* рахуються лише тут
+RATE_LIMIT_HIGH_PRIORITY = {"order_create", "order_create_batch", "order_amend", "order_cancel", "order_cancel_all", "trading_stop"}
+
+_rate_buckets = {}
+_rate_cond = threading.Condition()
+
+
+def _rate_group(path):
+    if path in RATE_LIMIT_GROUPS:
+        return RATE_LIMIT_GROUPS[path]
+    if path.startswith("/v5/market/"):
+        return RATE_LIMIT_IP
+    return (path, 10)
+
+
+def _rate_bucket(group, default_limit):
+    bucket = _rate_buckets.get(group)
+    if bucket is None:
+        bucket = _rate_buckets[group] = {
+            "capacity": float(default_limit),
+            "rate": float(default_limit),
+            "tokens": float(default_limit),
+            "updated": time.monotonic(),
+            "blocked_until": 0.0,
+            "high_waiting": 0,
+        }
+    return bucket
+
+
+def _rate_refill(bucket, now):
+    elapsed = now - bucket["updated"]
+    if elapsed > 0:
+        bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + elapsed * bucket["rate"])
+        bucket["updated"] = now
+
+
+def _rate_take(group, default_limit, high, deadline):
+    with _rate_cond:
+        bucket = _rate_bucket(group, default_limit)
+        if high:
+            bucket["high_waiting"] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                _rate_refill(bucket, now)
+                floor = 0.0 if high else bucket["capacity"] * RATE_LIMIT_RESERVE
+                blocked = now < bucket["blocked_until"]
+                yielding = not high and bucket["high_waiting"] > 0
+                if not blocked and not yielding and bucket["tokens"] - 1 >= floor:
+                    bucket["tokens"] -= 1
+                    return
+                if now >= deadline:
+                    # Краще спробувати, ніж зірвати ордер: Bybit сам відповість 10006
+                    inc("parsibot_rate_limit_timeouts_total", group=group)
+                    bucket["tokens"] = max(bucket["tokens"] - 1, -bucket["capacity"])
+                    return
+                if blocked:
+                    wait = bucket["blocked_until"] - now
+                else:
+                    wait = (floor + 1 - bucket["tokens"]) / bucket["rate"] if bucket["rate"] > 0 else 0.05
+                _rate_cond.wait(min(max(wait, 0.001), deadline - now))
+        finally:
+            if high:
+                bucket["high_waiting"] -= 1
+                _rate_cond.notify_all()
+
+
+def rate_limit_acquire(path, priority=None):
+    """Блокує до появи токена в bucket-і endpoint-а і в спільному IP-bucket-і.
+    Ордери/скасування мають пріоритет: фонові запити не чіпають резерв і
+    пропускають вперед ордери, що вже чекають."""
+    group, default_limit = _rate_group(path)
+    if priority is None:
+        priority = PRIORITY_HIGH if group in RATE_LIMIT_HIGH_PRIORITY else PRIORITY_LOW
+    high = priority == PRIORITY_HIGH
+    started = time.monotonic()
+    deadline = started + RATE_LIMIT_MAX_WAIT_SEC
+
+    if group != RATE_LIMIT_IP[0]:
+        _rate_take(group, default_limit, high, deadline)
+    _rate_take(RATE_LIMIT_IP[0], RATE_LIMIT_IP[1], high, deadline)
+
+    waited = time.monotonic() - started
+    if waited > 0.001:
+        observe("parsibot_rate_limit_wait_seconds", waited, group=group)
+    return group
+
+
+def rate_limit_update(group, headers, limited=False):
+    """Калібрує bucket за X-Bapi-Limit / -Status / -Reset-Timestamp."""
+    limit = headers.get("X-Bapi-Limit")
+    remaining = headers.get("X-Bapi-Limit-Status")
+    reset_ms = headers.get("X-Bapi-Limit-Reset-Timestamp")
+    if group == RATE_LIMIT_IP[0] or (limit is None and not limited):
+        return  # заголовки описують UID-ліміт endpoint-а, а не спільний IP-ліміт
+
+    with _rate_cond:
+        bucket = _rate_bucket(group, RATE_LIMIT_IP[1])
+        now = time.monotonic()
+        _rate_refill(bucket, now)
+        try:
+            if limit is not None and float(limit) > 0:
+                bucket["capacity"] = bucket["rate"] = float(limit)
+            if remaining is not None:
+                bucket["tokens"] = min(bucket["tokens"], float(remaining))
+            reset_in = (int(reset_ms) / 1000 - time.time()) if reset_ms else 1.0
+        except (TypeError, ValueError):
+            return
+        if limited or (remaining is not None and float(remaining) <= 0):
+            bucket["tokens"] = min(bucket["tokens"], 0.0)
+            bucket["blocked_until"] = max(bucket["blocked_until"], now + min(max(reset_in, 0.0), RATE_LIMIT_MAX_WAIT_SEC))
+        set_gauge("parsibot_rate_limit_tokens", bucket["tokens"], group=group)
+        _rate_cond.notify_all()
+
+
+# 🕰 Час сервера Bybit: підпис іде з timestamp = локальний час + зсув, синхронізований з /v5/market/time
+TIME_SYNC_SEC = float(os.environ.get("time_sync_sec", 300))
+
+_server_time_offset_ms = 0.0
+
+
+def sync_server_time():
+    """Оцінює зсув годинника як різницю між часом сервера і серединою round-trip-а."""
+    global _server_time_offset_ms
+    sent = time.time() * 1000
+    data = bybit_request("GET", "/v5/market/time", signed=False)
+    received = time.time() * 1000
+    result = data.get("result") or {}
+    if result.get("timeNano"):
+        server_ms = int(result["timeNano"]) / 1e6
+    elif data.get("time"):
+        server_ms = float(data["time"])
+    else:
+        raise ValueError(f"Bybit time response without time: {data}")
+    _server_time_offset_ms = server_ms - (sent + received) / 2
+    set_gauge("parsibot_bybit_time_offset_ms", round(_server_time_offset_ms, 1))
+    return _server_time_offset_ms
+
+
+def time_sync_loop():
+    # Годинник хоста дрейфує — тримаємо зсув до серверного часу Bybit актуальним для recv_window
+    while True:
+        time.sleep(TIME_SYNC_SEC)
+        try:
+            sync_server_time()
+        except Exception as e:
+            print(f"⚠️ Server time sync error: {e}")
+
+
+def bybit_timestamp():
+    return str(int(time.time() * 1000 + _server_time_offset_ms))
+
+
+# 🧯 Circuit breaker на endpoint: після серії збоїв біржі запити швидко відхиляються,
+# через breaker_open_sec пропускається одна пробна спроба (half-open)
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("breaker_failure_threshold", 5))
+BREAKER_OPEN_SEC = float(os.environ.get("breaker_open_sec", 30))
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+_breakers = {}
+_breaker_lock = threading.Lock()
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def _set_breaker_state(path, breaker, state):
+    breaker["state"] = state
+    set_gauge("parsibot_bybit_circuit_state", BREAKER_STATES[state], endpoint=path)
+
+
+def breaker_allow(path):
+    with _breaker_lock:
+        breaker = _breakers.get(path)
+        if breaker is None or breaker["state"] == "closed":
+            return
+        if breaker["state"] == "open" and time.monotonic() - breaker["opened_at"] >= BREAKER_OPEN_SEC:
+            _set_breaker_state(path, breaker, "half_open")
+            breaker["probing"] = False
+        if breaker["state"] == "half_open" and not breaker["probing"]:
+            breaker["probing"] = True
+            return
+    inc("parsibot_bybit_circuit_rejected_total", endpoint=path)
+    raise CircuitOpenError(f"Circuit open for {path}")
+
+
+def breaker_record(path, ok):
+    with _breaker_lock:
+        breaker = _breakers.setdefault(path, {"state": "closed", "failures": 0, "opened_at": 0.0, "probing": False})
+        if ok:
+            breaker["failures"] = 0
+            if breaker["state"] != "closed":
+                _set_breaker_state(path, breaker, "closed")
+            return
+        breaker["failures"] += 1
+        if breaker["state"] == "half_open" or (
+                breaker["state"] == "closed" and breaker["failures"] >= BREAKER_FAILURE_THRESHOLD):
+            breaker["opened_at"] = time.monotonic()
+            breaker["probing"] = False
+            _set_breaker_state(path, breaker, "open")
+            inc("parsibot_bybit_circuit_trips_total", endpoint=path)
+            send_telegram_message(f"🧯 Bybit {path}: {breaker['failures']} збоїв поспіль — запити призупинено на {BREAKER_OPEN_SEC:.0f} с", TG_WARNING)
+
+
+# 🔁 Повтори: читання — завжди (з jittered backoff), запис — лише якщо повтор не може
+# задвоїти дію: створення ордерів має orderLinkId (біржа відхилить дубль 110072),
+# решта POST-ів ідемпотентні за змістом
+BYBIT_RETRIES = int(os.environ.get("bybit_retries", 2))
+BYBIT_RETRY_BASE_SEC = float(os.environ.get("bybit_retry_base_sec", 0.2))
+BYBIT_RETRY_MAX_SEC = float(os.environ.get("bybit_retry_max_sec", 2))
+BYBIT_RETRYABLE_CODES = {10000, 10016}  # server timeout / internal error — результат невідомий
+BYBIT_TIME_ERROR_CODE = 10002  # timestamp поза recv_window — запит не виконано
+BYBIT_DUPLICATE_LINK_CODE = 110072
+BYBIT_IDEMPOTENT_WRITES = {"/v5/order/amend", "/v5/order/cancel", "/v5/order/cancel-all", "/v5/position/trading-stop"}
+BYBIT_CREATE_PATHS = {"/v5/order/create", "/v5/order/create-batch"}
+
+
+def new_order_link_id():
+    return f"pb-{uuid.uuid4().hex}"
+
+
+def _with_order_link_ids(path, payload):
+    if path == "/v5/order/create" and not payload.get("orderLinkId"):
+        return dict(payload, orderLinkId=new_order_link_id())
+    if path == "/v5/order/create-batch":
+        return dict(payload, request=[
+            order if order.get("orderLinkId") else dict(order, orderLinkId=new_order_link_id())
+            for order in payload.get("request") or []
+        ])
+    return payload
+
+
+def _retry_delay(attempt):
+    return random.uniform(0, min(BYBIT_RETRY_MAX_SEC, BYBIT_RETRY_BASE_SEC * 2 ** attempt))
+
+
+def _find_order_by_link(symbol, order_link_id):
+    data = bybit_request("GET", "/v5/order/realtime", params={
+        "category": "linear", "symbol": symbol, "orderLinkId": order_link_id
+    })
+    orders = (data.get("result") or {}).get("list") or []
+    return orders[0] if orders else None
+
+
+def _resolve_duplicate_links(path, payload, data):
+    """Повтор створення після невизначеного збою отримав 110072 — отже перша спроба дійшла.
+    Підставляємо вже існуючі ордери, щоб виклик виглядав як звичайний успіх."""
+    if path == "/v5/order/create":
+        if data.get("retCode") != BYBIT_DUPLICATE_LINK_CODE:
+            return data
+        order = _find_order_by_link(payload["symbol"], payload["orderLinkId"])
+        if order is None:
+            return data
+        inc("parsibot_bybit_duplicates_resolved_total", endpoint=path)
+        return {"retCode": 0, "retMsg": "OK", "result": {"orderId": order["orderId"], "orderLinkId": order["orderLinkId"]},
+                "retExtInfo": {}, "time": data.get("time")}
+
+    items = (data.get("result") or {}).get("list") or []
+    infos = (data.get("retExtInfo") or {}).get("list") or []
+    for i, order in enumerate(payload.get("request") or []):
+        if i < len(infos) and i < len(items) and infos[i].get("code") == BYBIT_DUPLICATE_LINK_CODE:
+            existing = _find_order_by_link(order["symbol"], order["orderLinkId"])
+            if existing is not None:
+                items[i] = dict(items[i], orderId=existing["orderId"], orderLinkId=existing["orderLinkId"])
+                infos[i] = {"code": 0, "msg": "OK"}
+                inc("parsibot_bybit_duplicates_resolved_total", endpoint=path)
+    return data
+
+
+def bybit_request(method, path, params=None, payload=None, signed=True, timeout=None, priority=None):
+    if method == "GET":
+        query_string = urlencode(params or {})
+        url = f"{base_url}{path}?{query_string}" if query_string else f"{base_url}{path}"
+        body = None
+        sign_str = query_string
+    else:
+        payload = _with_order_link_ids(path, payload or {})
+        url = f"{base_url}{path}"
+        body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+        sign_str = body
+
+    symbol = (params or payload or {}).get("symbol", "")
+    # Повтор запису безпечний, лише якщо біржа гарантовано не виконала запит або дубль неможливий
+    retry_writes = method == "GET" or path in BYBIT_IDEMPOTENT_WRITES or path in BYBIT_CREATE_PATHS
+    ambiguous = False
+    for attempt in range(BYBIT_RETRIES + 1):
+        breaker_allow(path)
+        group = rate_limit_acquire(path, priority)
+
+        headers = None
+        if signed:
+            timestamp = bybit_timestamp()
+            headers = dict(_BYBIT_AUTH_HEADERS)
+            headers["X-BAPI-TIMESTAMP"] = timestamp
+            headers["X-BAPI-SIGN"] = bybit_sign(timestamp, sign_str)
+
+        last = attempt == BYBIT_RETRIES
+        started = time.perf_counter()
+        try:
+            response = bybit_session.request(
+                method,
+                url,
+                data=body.encode("utf-8") if body is not None else None,
+                headers=headers,
+                timeout=timeout or BYBIT_TIMEOUTS.get(path, BYBIT_DEFAULT_TIMEOUT)
+            )
+        except requests.RequestException as e:
+            inc("parsibot_bybit_errors_total", endpoint=path, kind="exception")
+            breaker_record(path, ok=False)
+            # ConnectTimeout — запит не відправлено; інші мережеві збої — результат невідомий
+            sent = not isinstance(e, requests.ConnectTimeout)
+            if last or (sent and not retry_writes):
+                raise
+            ambiguous = ambiguous or sent
+            inc("parsibot_bybit_retries_total", endpoint=path, reason="network")
+            time.sleep(_retry_delay(attempt))
+            continue
+        finally:
+            observe("parsibot_bybit_request_seconds", time.perf_counter() - started, endpoint=path, symbol=symbol)
+
+        if response.status_code >= 400:
+            inc("parsibot_bybit_errors_total", endpoint=path, kind=f"http_{response.status_code}")
+        try:
+            data = response.json() if response.text.strip() else None
+        except ValueError:
+            data = None  # HTML-сторінка помилки від балансувальника
+        if data is None:
+            rate_limit_update(group, response.headers, limited=response.status_code in (403, 429))
+            inc("parsibot_bybit_errors_total", endpoint=path, kind="empty_body")
+            server_error = response.status_code >= 500
+            breaker_record(path, ok=not server_error)
+            if last or not server_error or not retry_writes:
+                raise ValueError(f"Empty response body from {path}")
+            ambiguous = True
+            inc("parsibot_bybit_retries_total", endpoint=path, reason=f"http_{response.status_code}")
+            time.sleep(_retry_delay(attempt))
+            continue
+
+        ret_code = data.get("retCode")
+        limited = ret_code == 10006
+        rate_limit_update(group, response.headers, limited=limited)
+        if ret_code not in (0, None):
+            inc("parsibot_bybit_errors_total", endpoint=path, kind=f"ret_{ret_code}")
+        breaker_record(path, ok=ret_code not in BYBIT_RETRYABLE_CODES)
+
+        if ambiguous and path in BYBIT_CREATE_PATHS:
+            data = _resolve_duplicate_links(path, payload, data)
+        if last:
+            return data
+        if limited:
+            # 10006: запит відхилено без виконання, bucket уже заблоковано до reset
+            inc("parsibot_bybit_retries_total", endpoint=path, reason="rate_limited")
+            continue
+        if ret_code == BYBIT_TIME_ERROR_CODE and signed:
+            inc("parsibot_bybit_retries_total", endpoint=path, reason="timestamp")
+            try:
+                sync_server_time()
+            except Exception as e:
+                print(f"⚠️ Server time sync error: {e}")
+            continue
+        if ret_code in BYBIT_RETRYABLE_CODES and retry_writes:
+            ambiguous = True
+            inc("parsibot_bybit_retries_total", endpoint=path, reason=f"ret_{ret_code}")
+            time.sleep(_retry_delay(attempt))
+            continue
+        return data
+
+
+def bybit_get(path, params=None, signed=True, timeout=None, priority=None):
+    return bybit_request("GET", path, params=params, signed=signed, timeout=timeout, priority=priority)
+
+
+def bybit_post(path, payload, timeout=None, priority=None):
+    return bybit_request("POST", path, payload=payload, timeout=timeout, priority=priority)
+
+def _exec_time_str(exec_time_ms):
+    return datetime.utcfromtimestamp(int(exec_time_ms) / 1000).strftime("%Y-%m-%d %H:%M:%S")
 
-def generate_signature(query_string, secret):
-    return hmac.new(
-        bytes(secret, "utf-8"),
-        bytes(query_string, "utf-8"),
-        hashlib.sha256
-    ).hexdigest()
 
 def check_order_execution(order_id, symbol):
-    timestamp = str(int(time.time() * 1000))
     params = {
-        "apiKey": api_key,
+        "category": "linear",
         "symbol": symbol,
-        "orderId": order_id,
-        "timestamp": timestamp
+        "orderId": order_id
     }
-    query_string = urlencode(params)
-    sign = generate_signature(query_string, api_secret)
-    params["sign"] = sign
 
     try:
-        # 🔍 Основна перевірка: execution list
-        response = requests.get("https://api-testnet.bybit.com/v5/execution/list", params=params)
-        data = response.json()
+        # 🔍 Основна перевірка: execution list (VWAP по всіх частинах заповнення)
+        data = bybit_get("/v5/execution/list", params)
         if data["retCode"] == 0 and data["result"]["list"]:
-            exec_info = data["result"]["list"][0]
-            return {
-                "filled": True,
-                "entry_price": float(exec_info["price"]),
-                "entry_time": exec_info["execTime"]
-            }
+            executions = data["result"]["list"]
+            exec_qty = sum(float(e["execQty"]) for e in executions)
+            exec_value = sum(float(e["execQty"]) * float(e["execPrice"]) for e in executions)
+            if exec_qty > 0:
+                exec_time = min(int(e["execTime"]) for e in executions)
+                return {
+                    "filled": True,
+                    "entry_price": exec_value / exec_qty,
+                    "entry_time": _exec_time_str(exec_time),
+                    "entry_time_ms": exec_time
+                }
 
         # 🔄 Fallback: order realtime
-        response = requests.get("https://api-testnet.bybit.com/v5/order/realtime", params=params)
-        data = response.json()
+        data = bybit_get("/v5/order/realtime", params)
         if data["retCode"] == 0 and data["result"]["list"]:
             order = data["result"]["list"][0]
-            avg_price = float(order.get("avgPrice", 0))
-            if order.get("orderStatus") in ("Filled", "PartiallyFilled") and avg_price > 0:
+            avg_price = float(order.get("avgPrice") or 0)
+            if order.get("orderStatus") in ("Filled", "PartiallyFilled", "PartiallyFilledCanceled") and avg_price > 0:
                 return {
                     "filled": True,
                     "entry_price": avg_price,
-                    "entry_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                    "entry_time": _exec_time_str(order.get("updatedTime") or time.time() * 1000),
+                    "entry_time_ms": int(order["updatedTime"]) if order.get("updatedTime") else None
                 }
 
-        # 💡 Fallback #2: get_price or static default
-        fallback_price = get_price(symbol)
-        if fallback_price:
-            return {
-                "filled": True,
-                "entry_price": fallback_price,
-                "entry_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            }
-
-        # 🛑 Якщо нічого — підставляємо умовну ціну, щоб уникнути null у CSV
-        return {
-            "filled": True,
-            "entry_price": 105000.0,
-            "entry_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        }
-
     except Exception as e:
         print(f"❌ Execution check error: {e}")
-        return {
-            "filled": True,
-            "entry_price": 105000.0,
-            "entry_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        }
 
-        # 🔄 Fallback: order realtime
-        response = requests.get("https://api-testnet.bybit.com/v5/order/realtime", params=params)
-        data = response.json()
-        if data["retCode"] == 0 and data["result"]["list"]:
-            order = data["result"]["list"][0]
-            avg_price = float(order.get("avgPrice", 0))
-            if order.get("orderStatus") in ("Filled", "PartiallyFilled") and avg_price > 0:
-                return {
-                    "filled": True,
-                    "entry_price": avg_price,
-                    "entry_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-                }
+    # 🛑 Заповнення не підтверджене — не вигадуємо ціну
+    return {
+        "filled": False,
+        "entry_price": None,
+        "entry_time": None,
+        "entry_time_ms": None
+    }
 
-        # 💡 Fallback #2: використовуємо ціну з get_price
-        fallback_price = get_price(symbol)
-        if fallback_price:
+
+# ⚡ Приватний WebSocket (execution/order): реєстр заповнень по orderId
+
+FILL_TIMEOUT_SEC = float(os.environ.get("fill_timeout_sec", 5))
+FILL_REGISTRY_TTL_SEC = 900
+ORDER_FINAL_STATUSES = ("Filled", "PartiallyFilledCanceled", "Cancelled", "Rejected", "Deactivated")
+
+_private_ws = None
+_private_lock = threading.Lock()
+_fills = {}  # orderId -> {"qty", "value", "exec_time", "status", "avg_price", "event", "created"}
+_fills_lock = threading.Lock()
+
+
+def _fill_slot(order_id):
+    with _fills_lock:
+        slot = _fills.get(order_id)
+        if slot is None:
+            if len(_fills) >= 1000:
+                _prune_fills()
+            slot = {
+                "qty": 0.0,
+                "value": 0.0,
+                "exec_time": None,
+                "status": None,
+                "avg_price": None,
+                "event": threading.Event(),
+                "created": time.monotonic()
+            }
+            _fills[order_id] = slot
+        return slot
+
+
+def _prune_fills():
+    cutoff = time.monotonic() - FILL_REGISTRY_TTL_SEC
+    for order_id in [k for k, v in _fills.items() if v["created"] < cutoff]:
+        del _fills[order_id]
+
+
+def _on_execution(message):
+    for item in message.get("data", []):
+        order_id = item.get("orderId")
+        if not order_id or item.get("execType", "Trade") != "Trade":
+            continue
+        slot = _fill_slot(order_id)
+        qty = float(item.get("execQty") or 0)
+        with _fills_lock:
+            slot["qty"] += qty
+            slot["value"] += qty * float(item.get("execPrice") or 0)
+            if slot["exec_time"] is None and item.get("execTime"):
+                slot["exec_time"] = int(item["execTime"])
+        if item.get("leavesQty") is not None and float(item["leavesQty"]) == 0:
+            slot["event"].set()
+
+
+def _on_order(message):
+    for item in message.get("data", []):
+        order_id = item.get("orderId")
+        if not order_id:
+            continue
+        slot = _fill_slot(order_id)
+        status = item.get("orderStatus")
+        with _fills_lock:
+            slot["status"] = status
+            if float(item.get("avgPrice") or 0) > 0:
+                slot["avg_price"] = float(item["avgPrice"])
+            if slot["exec_time"] is None and status in ("Filled", "PartiallyFilledCanceled"):
+                slot["exec_time"] = int(item.get("updatedTime") or time.time() * 1000)
+        if status in ORDER_FINAL_STATUSES:
+            slot["event"].set()
+            # Виконався TP/SL/trailing або reduce-only — угоди символу перевіряються негайно
+            if status == "Filled" and (item.get("reduceOnly") or item.get("stopOrderType")) and item.get("symbol"):
+                wake_tracker(item["symbol"])
+
+
+def start_private_stream():
+    global _private_ws
+    if not ws_enabled:
+        return
+    try:
+        with _private_lock:
+            if _private_ws is not None:
+                return
+            from pybit.unified_trading import WebSocket
+            ws = WebSocket(
+                testnet=(env == "test"),
+                channel_type="private",
+                api_key=api_key,
+                api_secret=api_secret
+            )
+            ws.execution_stream(callback=_on_execution)
+            ws.order_stream(callback=_on_order)
+            ws.wallet_stream(callback=_on_wallet)
+            _private_ws = ws
+    except Exception as e:
+        print(f"❌ Private stream error: {e}")
+
+
+def wait_for_fill(order_id, symbol, timeout=FILL_TIMEOUT_SEC):
+    if _private_ws is not None:
+        slot = _fill_slot(order_id)
+        slot["event"].wait(timeout)
+        with _fills_lock:
+            qty, value = slot["qty"], slot["value"]
+            avg_price, exec_time = slot["avg_price"], slot["exec_time"]
+        entry_price = value / qty if qty > 0 else avg_price
+        if entry_price:
             return {
                 "filled": True,
-                "entry_price": fallback_price,
-                "entry_time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                "entry_price": entry_price,
+                "entry_time": _exec_time_str(exec_time or time.time() * 1000),
+                "entry_time_ms": int(exec_time) if exec_time else None  # лише біржовий execTime
             }
 
-        return {
-            "filled": False,
-            "entry_price": None,
-            "entry_time": None
-        }
+    # 🔄 Стрім недоступний або мовчить — одна REST-перевірка
+    return check_order_execution(order_id, symbol)
 
-    except Exception as e:
-        print(f"❌ Execution check error: {e}")
-        return {
-            "filled": False,
-            "entry_price": None,
-            "entry_time": None
-        }
+
+def is_tp_direction_valid(tp, price, side):
+    return tp > price if side == "Buy" else tp < price
+
+def is_sl_valid(sl, price, max_distance=MAX_SL_DISTANCE_PERC):
+    return abs(sl - price) / price <= max_distance
+
+
+# Чиста математика ризику — спільна для живого шляху і backtest.py
+
+def clamp_sl_price(price, side, max_distance=MAX_SL_DISTANCE_PERC):
+    return price * (1 - max_distance) if side == "Buy" else price * (1 + max_distance)
 
 
+def fallback_tp_price(price, side, pct=FALLBACK_TP_PCT):
+    return price * (1 + pct) if side == "Buy" else price * (1 - pct)
 
 
-def send_telegram_message(message):
-    url = f"https://api.telegram.org/bot{telegram_token}/sendMessage"
-    data = {"chat_id": telegram_chat_id, "text": message}
+def risk_qty(balance, price, sl_price, side, risk_percent=RISK_PERCENT):
+    """Qty, за якого хід до SL коштує risk_percent% балансу. Повертає (qty, stop_distance); qty=0 — SL не з того боку."""
+    stop_distance = price - sl_price if side == "Buy" else sl_price - price
+    if stop_distance <= 0:
+        return 0, stop_distance
+    return balance * risk_percent / 100 / stop_distance, stop_distance
+
+def cancel_all_close_orders(symbol):
     try:
-        requests.post(url, json=data)
+        # 🧹 Один запит замість list + N окремих cancel
+        data = bybit_post("/v5/order/cancel-all", {
+            "category": "linear",
+            "symbol": symbol
+        })
+
+        if debug_responses:
+            print(f"📦 /v5/order/cancel-all response:\n{json.dumps(data, indent=2)}")
+
+        if data.get("retCode") != 0:
+            send_telegram_message(f"❌ Не вдалось скасувати ордери через /cancel-all: {data}", TG_ERROR)
+            return
+
+        count = len((data.get("result") or {}).get("list") or [])
+        send_telegram_message(f"🧹 Скасовано {count} ордерів через /cancel-all для {symbol}")
+
     except Exception as e:
-        print(f"Telegram Error: {e}")
+        send_telegram_message(f"❌ cancel_all_close_orders error: {e}", TG_ERROR)
+        print(f"❌ cancel_all_close_orders error: {e}")
 
 
-def is_tp_direction_valid(tp, price, side):
-    return tp > price if side == "Buy" else tp < price
 
-def is_sl_valid(sl, price):
-    return abs(sl - price) / price <= MAX_SL_DISTANCE_PERC
+# 📡 Кеш тікерів: публічний WebSocket tickers.<symbol> + REST fallback з TTL
 
-def sign_request_post(api_key, api_secret, payload: dict, timestamp: str):
-    body_str = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-    sign_payload = f"{timestamp}{api_key}{body_str}"  # ❌ без recvWindow тут!
-    signature = hmac.new(
-        bytes(api_secret, "utf-8"),
-        bytes(sign_payload, "utf-8"),
-        hashlib.sha256
-    ).hexdigest()
-    return signature, body_str
+PRICE_STALE_SEC = float(os.environ.get("price_stale_sec", 10))
+PRICE_REST_TTL_SEC = float(os.environ.get("price_rest_ttl_sec", 1))
 
+_tickers = {}       # symbol -> (last, bid, ask, ts_ms, received_monotonic) зі стріму
+_rest_tickers = {}  # те саме, але з REST fallback
+_ticker_symbols = set()
+_public_ws = None
+_price_lock = threading.Lock()
 
-def sign_request(api_key, api_secret, query_string, timestamp):
-    message = str(timestamp) + api_key + query_string
-    return hmac.new(
-        bytes(api_secret, "utf-8"),
-        msg=bytes(message, "utf-8"),
-        digestmod=hashlib.sha256
-    ).hexdigest()
 
+def _parse_ticker(data, received):
+    bid = data.get("bid1Price")
+    ask = data.get("ask1Price")
+    return (
+        float(data["lastPrice"]),
+        float(bid) if bid else None,
+        float(ask) if ask else None,
+        int(data.get("ts") or time.time() * 1000),
+        received
+    )
 
-def cancel_all_close_orders(symbol):
+
+def _on_ticker(message):
+    data = message.get("data") or {}
+    symbol = data.get("symbol")
+    if not symbol or not data.get("lastPrice"):
+        return
     try:
-        timestamp = str(int(time.time() * 1000))
-        params = {
-            "api_key": api_key,
-            "timestamp": timestamp,
-            "symbol": symbol,
-            "category": "linear",
-            "openOnly": "1"
-        }
+        _tickers[symbol] = _parse_ticker(dict(data, ts=message.get("ts")), time.monotonic())
+        band = _track_bands.get(symbol)
+        if band and not band[0] < _tickers[symbol][0] < band[1]:
+            wake_tracker(symbol)  # ціна дійшла до TP/SL однієї з угод
+    except (TypeError, ValueError) as e:
+        print(f"⚠️ Ticker parse error {symbol}: {e}")
+
+
+def start_price_stream(symbols=None):
+    global _public_ws
+    if not ws_enabled:
+        return
+    try:
+        with _price_lock:
+            if _public_ws is None:
+                _public_ws = _public_websocket()
+        subscribe_tickers(symbols or tracked_symbols)
+        subscribe_orderbooks(symbols or tracked_symbols)
+    except Exception as e:
+        print(f"❌ Price stream error: {e}")
 
-        # 🔐 Підписуємо GET-запит
-        query_string = "&".join([f"{k}={params[k]}" for k in sorted(params)])
-        sign = hmac.new(
-            bytes(api_secret, "utf-8"),
-            msg=bytes(query_string, "utf-8"),
-            digestmod=hashlib.sha256
-        ).hexdigest()
-        params["sign"] = sign
 
-        # 🔗 Отримуємо список ордерів
-        response = requests.get(f"{base_url}/v5/order/list", params=params)
+def _public_websocket():
+    from pybit.unified_trading import WebSocket
 
-        if not response.text.strip():
-            raise ValueError("Empty response body from /order/list")
+    class PublicWebSocket(WebSocket):
+        # pybit сам зливає delta стакану в несортовані списки, робить deepcopy і віддає все як snapshot —
+        # кадри orderbook передаємо сирими, щоб _on_orderbook застосовував delta до своїх масивів
+        def _process_normal_message(self, message):
+            if "orderbook" in message.get("topic", ""):
+                self._get_callback(message["topic"])(message)
+            else:
+                super()._process_normal_message(message)
 
-        if "application/json" not in response.headers.get("Content-Type", ""):
-            send_telegram_message("❌ cancel_all_close_orders error: Non-JSON response")
-            print(response.text)
-            return
+    return PublicWebSocket(testnet=(env == "test"), channel_type="linear")
 
-        data = response.json()
-        print(f"📦 /v5/order/list response:\n{json.dumps(data, indent=2)}")
 
-        if data.get("retCode") != 0:
-            send_telegram_message(f"❌ Не вдалось отримати ордери через /list: {data}")
-            return
+def subscribe_tickers(symbols):
+    if _public_ws is None:
+        return
+    with _price_lock:
+        new_symbols = [s for s in symbols if s not in _ticker_symbols]
+        _ticker_symbols.update(new_symbols)
+    if new_symbols:
+        _public_ws.ticker_stream(symbol=new_symbols, callback=_on_ticker)
 
-        orders = data["result"].get("list", [])
-        count = 0
 
-        for order in orders:
-            order_id = order.get("orderId")
-            if order_id:
-                cancel_timestamp = str(int(time.time() * 1000))
-                payload = {
-                    "category": "linear",
-                    "orderId": order_id
-                }
+def get_ticker(symbol):
+    now = time.monotonic()
+    ticker = _tickers.get(symbol)
+    if ticker and now - ticker[4] <= PRICE_STALE_SEC:
+        return ticker
 
-                cancel_sign, cancel_body = sign_request_post(api_key, api_secret, payload, cancel_timestamp)
+    cached = _rest_tickers.get(symbol)
+    if cached and now - cached[4] <= PRICE_REST_TTL_SEC:
+        return cached
 
-                cancel_headers = {
-                    "X-BAPI-API-KEY": api_key,
-                    "X-BAPI-SIGN": cancel_sign,
-                    "X-BAPI-TIMESTAMP": cancel_timestamp,
-                    "X-BAPI-RECV-WINDOW": "5000",
-                    "Content-Type": "application/json"
-                }
+    # 🔄 Стрім застарів або символ ще не підписаний — йдемо в REST
+    data = bybit_get("/v5/market/tickers", {"category": "linear", "symbol": symbol}, signed=False)
 
-                cancel_response = requests.post(f"{base_url}/v5/order/cancel", data=cancel_body, headers=cancel_headers)
+    if debug_responses:
+        print(f"📉 get_price() response:\n{json.dumps(data, indent=2)}")
 
-                try:
-                    cancel_result = cancel_response.json()
-                    print(f"🧹 Canceled: {order_id} → {json.dumps(cancel_result, indent=2)}")
-                except Exception as decode_error:
-                    send_telegram_message(f"⚠️ Error decoding cancel response: {decode_error}\nText: {cancel_response.text}")
+    items = (data.get("result") or {}).get("list") or []
+    if not items or not items[0].get("lastPrice"):
+        return None
+    ticker = _parse_ticker(dict(items[0], ts=data.get("time")), time.monotonic())
+    _rest_tickers[symbol] = ticker
 
-                count += 1
+    if _public_ws is not None and symbol not in _ticker_symbols:
+        try:
+            subscribe_tickers([symbol])
+            subscribe_orderbooks([symbol])
+        except Exception as e:
+            print(f"⚠️ Ticker subscribe error {symbol}: {e}")
+    return ticker
 
-        send_telegram_message(f"🧹 Скасовано {count} ордерів через /list для {symbol}")
 
+def get_price(symbol):
+    try:
+        ticker = get_ticker(symbol)
+        return ticker[0] if ticker else None
     except Exception as e:
-        send_telegram_message(f"❌ cancel_all_close_orders error: {e}")
-        print(f"❌ cancel_all_close_orders error: {e}")
+        print(f"get_price() error: {e}")
+    return None
 
 
 
-def get_price(symbol):
+# 📚 Дзеркало стакану orderbook.50: snapshot + delta зі стріму в масивах array('d').
+# Обидві сторони впорядковані від кращої ціни (bids зберігаються з від'ємним ключем), тож
+# VWAP для qty — прохід по рівнях без алокацій і без REST.
+
+ORDERBOOK_DEPTH = 50
+ORDERBOOK_ENABLED = os.environ.get("orderbook_enabled", "True").lower() == "true"
+MAX_SLIPPAGE_PCT = float(os.environ.get("max_slippage_pct", 0.005))  # 0.005 = 0.5% від mid
+SIZING_MAX_ITERATIONS = 5
+
+_books = {}  # symbol -> {"a": (keys, sizes), "b": (keys, sizes), "u", "seq", "ts", "received", "lock"}
+_book_symbols = set()
+
+
+def _book_side(levels, sign):
+    keys, sizes = array("d"), array("d")
+    for price, size in sorted((sign * float(p), float(q)) for p, q in levels):
+        if size > 0:
+            keys.append(price)
+            sizes.append(size)
+    return keys, sizes
+
+
+def _apply_levels(side, levels, sign):
+    keys, sizes = side
+    for p, q in levels:
+        key, size = sign * float(p), float(q)
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            if size > 0:
+                sizes[i] = size
+            else:
+                del keys[i]
+                del sizes[i]
+        elif size > 0:
+            keys.insert(i, key)
+            sizes.insert(i, size)
+
+
+def _on_orderbook(message):
+    data = message.get("data") or {}
+    symbol = data.get("s")
+    if not symbol:
+        return
     try:
-        url = f"{base_url}/v5/market/tickers?category=linear&symbol={symbol}"
-        response = requests.get(url)
-        data = response.json()
+        book = _books.get(symbol)
+        # u == 1 — Bybit перезапустив сервіс і шле новий snapshot під виглядом delta
+        if message.get("type") == "snapshot" or book is None or data.get("u") == 1:
+            fresh = {"a": _book_side(data.get("a") or [], 1), "b": _book_side(data.get("b") or [], -1),
+                     "lock": book["lock"] if book else threading.Lock()}
+            book = _books.setdefault(symbol, fresh)
+            with book["lock"]:
+                book["a"], book["b"] = fresh["a"], fresh["b"]
+        else:
+            with book["lock"]:
+                _apply_levels(book["a"], data.get("a") or [], 1)
+                _apply_levels(book["b"], data.get("b") or [], -1)
+        book["u"] = data.get("u")
+        book["seq"] = data.get("seq")
+        book["ts"] = message.get("ts")
+        book["received"] = time.monotonic()
+    except (TypeError, ValueError) as e:
+        print(f"⚠️ Orderbook parse error {symbol}: {e}")
+
+
+def subscribe_orderbooks(symbols):
+    if _public_ws is None or not ORDERBOOK_ENABLED:
+        return
+    with _price_lock:
+        new_symbols = [s for s in symbols if s not in _book_symbols]
+        _book_symbols.update(new_symbols)
+    if new_symbols:
+        _public_ws.orderbook_stream(depth=ORDERBOOK_DEPTH, symbol=new_symbols, callback=_on_orderbook)
+
+
+def _fresh_book(symbol):
+    book = _books.get(symbol)
+    if book is None or time.monotonic() - book.get("received", 0) > PRICE_STALE_SEC:
+        return None
+    return book
 
-        if debug_responses:
-            print(f"📉 get_price() response:\n{json.dumps(data, indent=2)}")
 
-        if data.get("result") and "list" in data["result"] and data["result"]["list"]:
-            last_price = data["result"]["list"][0].get("lastPrice")
-            return float(last_price) if last_price else None
-    except Exception as e:
-        print(f"get_price() error: {e}")
+def book_mid(symbol):
+    book = _fresh_book(symbol)
+    if book is None:
+        return None
+    with book["lock"]:
+        if not book["a"][0] or not book["b"][0]:
+            return None
+        return (book["a"][0][0] - book["b"][0][0]) / 2
+
+
+def book_vwap(symbol, side, qty):
+    """Очікувана середня ціна маркет-ордера qty на стороні side (Buy б'є asks, Sell — bids).
+    None — стакану немає, він застарів або глибини 50 рівнів не вистачає."""
+    book = _fresh_book(symbol)
+    if book is None or qty <= 0:
+        return None
+    with book["lock"]:
+        keys, sizes = book["a"] if side == "Buy" else book["b"]
+        remaining = qty
+        cost = 0.0
+        for i in range(len(keys)):
+            take = sizes[i] if sizes[i] < remaining else remaining
+            cost += take * keys[i]
+            remaining -= take
+            if remaining <= 1e-12:
+                return abs(cost) / qty
+    return None
+
+
+def expected_slippage(symbol, side, qty):
+    """(vwap, частка прослизання від mid) або (None, None) без свіжого стакану."""
+    vwap = book_vwap(symbol, side, qty)
+    mid = book_mid(symbol)
+    if vwap is None or not mid:
+        return None, None
+    return vwap, (vwap - mid) / mid if side == "Buy" else (mid - vwap) / mid
+
+
+# 💰 Кеш стану рахунку: USDT equity + доступна маржа.
+# Сід при старті, оновлення з приватного wallet-стріму, періодичний REST reconcile.
+
+BALANCE_MAX_STALE_SEC = float(os.environ.get("balance_max_stale_sec", 120))
+BALANCE_RECONCILE_SEC = float(os.environ.get("balance_reconcile_sec", 60))
+
+_account = {"equity": None, "available": None, "updated": 0.0}
+_account_lock = threading.Lock()
+
+
+def _parse_wallet(accounts):
+    for account in accounts:
+        if account.get("accountType", "UNIFIED") != "UNIFIED":
+            continue
+        usdt_info = next((coin for coin in account.get("coin", []) if coin.get("coin") == "USDT"), None)
+        if not usdt_info:
+            continue
+        equity = float(usdt_info.get("equity") or 0)
+        available = account.get("totalAvailableBalance")
+        return equity, float(available) if available not in (None, "") else equity
     return None
 
 
+def _set_account(equity, available):
+    with _account_lock:
+        _account["equity"] = equity
+        _account["available"] = available
+        _account["updated"] = time.monotonic()
+
+
+def _on_wallet(message):
+    parsed = _parse_wallet(message.get("data", []))
+    if parsed:
+        _set_account(*parsed)
+
 
 def get_wallet_balance_uta():
     try:
-        timestamp = str(int(time.time() * 1000))
-        query_string = "accountType=UNIFIED"
-        headers = {
-            "X-BAPI-API-KEY": api_key,
-            "X-BAPI-TIMESTAMP": timestamp,
-            "X-BAPI-SIGN": sign_request(api_key, api_secret, query_string, timestamp),
-            "Content-Type": "application/json"
-        }
-
-        url = f"{base_url}/v5/account/wallet-balance?{query_string}"
-        response = requests.get(url, headers=headers)
-        result = response.json()
+        result = bybit_get("/v5/account/wallet-balance", {"accountType": "UNIFIED"})
 
-        send_telegram_message(f"💡 RAW BALANCE RESPONSE:\n{json.dumps(result, indent=2)}")
+        if debug_responses:
+            print(f"💡 RAW BALANCE RESPONSE:\n{json.dumps(result, indent=2)}")
 
         if "result" in result and "list" in result["result"]:
-            account_data = result["result"]["list"][0]
-            usdt_info = next((coin for coin in account_data["coin"] if coin["coin"] == "USDT"), None)
-            if usdt_info:
-                return float(usdt_info.get("equity", 0))
+            parsed = _parse_wallet(result["result"]["list"])
+            if parsed:
+                _set_account(*parsed)
+                return parsed[0]
 
-        raise ValueError("Unexpected balance format")
+        raise ValueError(f"Unexpected balance format: {result.get('retMsg')}")
 
     except Exception as e:
-        send_telegram_message(f"⚠️ Error getting wallet balance: {e}")
+        send_telegram_message(f"⚠️ Error getting wallet balance: {e}", TG_WARNING)
         return float(os.environ.get("manual_balance", 10))
 
 
+def get_account_state():
+    with _account_lock:
+        equity = _account["equity"]
+        available = _account["available"]
+        age = time.monotonic() - _account["updated"]
+
+    # 🛡 Захист від застарілих даних: лише тоді йдемо в REST
+    if equity is None or age > BALANCE_MAX_STALE_SEC:
+        balance = get_wallet_balance_uta()
+        with _account_lock:
+            if _account["equity"] is None:
+                return balance, balance
+            return _account["equity"], _account["available"]
+    return equity, available
+
+
+def reconcile_account():
+    # Страховка для wallet-стріму: REST-звірка ловить пропущені або загублені після реконекту оновлення
+    while True:
+        time.sleep(BALANCE_RECONCILE_SEC)
+        get_wallet_balance_uta()
+
+
+
+# 📐 Кеш метаданих інструментів (lotSizeFilter / priceFilter / min notional)
+# для точного округлення qty і цін — ордер має проходити з першої спроби
+
+INSTRUMENTS_REFRESH_SEC = float(os.environ.get("instruments_refresh_sec", 3600))
+INSTRUMENT_MISS_TTL_SEC = float(os.environ.get("instrument_miss_ttl_sec", 30))
+
+_instruments = {}  # symbol -> {"qty_step", "min_qty", "max_qty", "max_mkt_qty", "tick_size", "min_notional"}
+_instrument_misses = {}  # symbol -> monotonic час невдалого запиту (новий лістинг може з'явитись будь-коли)
+
+
+def _parse_instrument(item):
+    lot = item.get("lotSizeFilter") or {}
+    price_filter = item.get("priceFilter") or {}
+    return {
+        "qty_step": Decimal(lot.get("qtyStep") or "0.001"),
+        "min_qty": Decimal(lot.get("minOrderQty") or "0"),
+        "max_qty": Decimal(lot.get("maxOrderQty") or "0"),
+        "max_mkt_qty": Decimal(lot.get("maxMktOrderQty") or lot.get("maxOrderQty") or "0"),
+        "tick_size": Decimal(price_filter.get("tickSize") or "0.01"),
+        "min_notional": Decimal(lot.get("minNotionalValue") or "0")
+    }
+
+
+def load_instruments(symbol=None):
+    global _instruments
+    instruments = {}
+    params = {"category": "linear", "limit": 1000}
+    if symbol:
+        params["symbol"] = symbol
+
+    while True:
+        data = bybit_get("/v5/market/instruments-info", params, signed=False)
+        if data.get("retCode") != 0:
+            raise ValueError(f"instruments-info error: {data.get('retMsg')}")
+        result = data.get("result") or {}
+        for item in result.get("list") or []:
+            instruments[item["symbol"]] = _parse_instrument(item)
+        cursor = result.get("nextPageCursor")
+        if not cursor:
+            break
+        params["cursor"] = cursor
+
+    if symbol:
+        if symbol in instruments:
+            _instruments[symbol] = instruments[symbol]
+            _instrument_misses.pop(symbol, None)
+        else:
+            _instrument_misses[symbol] = time.monotonic()
+    else:
+        _instruments = instruments
+        _instrument_misses.clear()
+    return len(instruments)
+
+
+def refresh_instruments():
+    # Нові лістинги й змінені qtyStep/tickSize підтягуються раз на instruments_refresh_sec
+    while True:
+        time.sleep(INSTRUMENTS_REFRESH_SEC)
+        try:
+            count = load_instruments()
+            print(f"📐 Instruments loaded: {count}")
+        except Exception as e:
+            print(f"❌ Instruments load error: {e}")
+
+
+def get_instrument(symbol):
+    missed = _instrument_misses.get(symbol)
+    if missed is not None and time.monotonic() - missed < INSTRUMENT_MISS_TTL_SEC:
+        return None
+    if symbol not in _instruments:
+        try:
+            load_instruments(symbol)
+        except Exception as e:
+            print(f"⚠️ Instrument {symbol} unavailable: {e}")
+            return None
+    return _instruments.get(symbol)
+
+
+def _quantize(value, step, rounding):
+    return (Decimal(str(value)) / step).to_integral_value(rounding=rounding) * step
+
+
+def normalize_qty(symbol, qty, market=False):
+    info = get_instrument(symbol)
+    if not info:
+        return round(qty, 2)
+    qty = _quantize(qty, info["qty_step"], ROUND_DOWN)
+    max_qty = info["max_mkt_qty"] if market else info["max_qty"]
+    if max_qty and qty > max_qty:
+        qty = _quantize(max_qty, info["qty_step"], ROUND_DOWN)
+    if qty < info["min_qty"]:
+        return 0.0
+    return float(qty)
+
+
+def normalize_price(symbol, price):
+    info = get_instrument(symbol)
+    if not info:
+        return round(price, 2)
+    return float(_quantize(price, info["tick_size"], ROUND_HALF_UP))
+
+
+def min_order_qty(symbol, price):
+    info = get_instrument(symbol)
+    if not info:
+        return 0.0  # мінімум невідомий — не вигадуємо (живий шлях без метаданих сигнал відхиляє)
+    # Мінімум — більший з minOrderQty і minNotionalValue / ціна, вирівняний вгору по кроку
+    by_notional = _quantize(info["min_notional"] / Decimal(str(price)), info["qty_step"], ROUND_UP) if price else 0
+    return float(max(info["min_qty"], by_notional))
+
 
 def get_market_price(symbol):
     try:
-        url = f"{base_url}/v5/market/tickers?category=linear&symbol={symbol}"
-        response = requests.get(url)
-        result = response.json()
-        price = float(result["result"]["list"][0]["lastPrice"])
-        return price
+        ticker = get_ticker(symbol)
+        if ticker is None:
+            raise ValueError(f"No ticker for {symbol}")
+        return ticker[0]
     except Exception as e:
-        send_telegram_message(f"⚠️ Не вдалося отримати ціну: {e}")
+        send_telegram_message(f"⚠️ Не вдалося отримати ціну: {e}", TG_WARNING)
         return None
 
-def calculate_dynamic_qty(symbol, sl_price, side, risk_percent=0.2):
-    balance = get_wallet_balance_uta()
+def calculate_dynamic_qty(symbol, sl_price, side, risk_percent=RISK_PERCENT):
+    balance, available = get_account_state()
     market_price = get_market_price(symbol)
     if not market_price:
-        send_telegram_message("❌ Невдала спроба отримати ринкову ціну для qty.")
+        send_telegram_message("❌ Невдала спроба отримати ринкову ціну для qty.", TG_ERROR)
         return 0
 
-    risk_amount = balance * risk_percent / 100
-
-    if side == "Buy":
-        stop_distance = market_price - sl_price
-    else:
-        stop_distance = sl_price - market_price
-
-    if stop_distance <= 0:
-        send_telegram_message("⚠️ Stop loss відстань ≤ 0. Неможливо розрахувати qty.")
+    # Без lotSizeFilter не знаємо ні мінімуму, ні кроку — ордер «навмання» може бути в рази більшим за ризик
+    if get_instrument(symbol) is None:
+        send_telegram_message(f"❌ Немає метаданих інструменту {symbol} — сигнал ігнорується.", TG_ERROR)
         return 0
 
-    qty = risk_amount / stop_distance
+    qty, stop_distance = risk_qty(balance, market_price, sl_price, side, risk_percent)
+    if qty <= 0:
+        send_telegram_message("⚠️ Stop loss відстань ≤ 0. Неможливо розрахувати qty.", TG_WARNING)
+        return 0
 
-    # ✅ Мінімальний розмір контракту Bybit для SOL = 0.01, ставимо запас
-    if qty < 0.1:
-        qty = 0.1
+    # 📚 Ризик рахується від очікуваного VWAP зі стакану, а не від lastPrice: qty ↔ VWAP до збіжності
+    if _fresh_book(symbol) is not None:
+        for _ in range(SIZING_MAX_ITERATIONS):
+            vwap = book_vwap(symbol, side, qty)
+            if vwap is None:
+                break  # глибини не вистачає — відсіє перевірка прослизання
+            next_qty, stop_distance = risk_qty(balance, vwap, sl_price, side, risk_percent)
+            if next_qty <= 0:
+                send_telegram_message(f"⚠️ Очікуваний VWAP {vwap:.4f} вже за SL {sl_price}. Неможливо розрахувати qty.", TG_WARNING)
+                return 0
+            converged = abs(next_qty - qty) <= qty * 0.001
+            qty, market_price = next_qty, vwap
+            if converged:
+                break
+
+    # ✅ Мінімальний розмір і крок контракту — з метаданих інструменту
+    qty = normalize_qty(symbol, max(qty, min_order_qty(symbol, market_price)), market=True)
+    if qty <= 0:
+        send_telegram_message(f"⚠️ Qty нижче мінімуму інструменту {symbol}.", TG_WARNING)
+        return 0
 
-    # ✅ Максимальний захист по балансу
-    if qty * market_price > balance:
-        send_telegram_message(f"⚠️ Недостатньо балансу. Потрібно {qty * market_price:.2f} USDT, є тільки {balance:.2f}.")
+    # ✅ Максимальний захист по доступній маржі
+    if qty * market_price > available:
+        send_telegram_message(f"⚠️ Недостатньо балансу. Потрібно {qty * market_price:.2f} USDT, є тільки {available:.2f}.", TG_WARNING)
         return 0
 
-    send_telegram_message(f"💡 Qty розраховано: {qty:.4f} SOL, при ціні {market_price:.2f}, stop_distance={stop_distance:.4f}")
-    return round(qty, 2)
+    send_telegram_message(f"💡 Qty розраховано: {qty} {symbol}, при ціні {market_price:.2f}, stop_distance={stop_distance:.4f}", TG_DEBUG)
+    return qty
 
 
-def create_market_order(symbol, side, qty):
+def create_market_order(symbol, side, qty, order_link_id=None, tpsl=None):
     try:
-        timestamp = str(int(time.time() * 1000))
-        recv_window = "5000"
-
         payload = {
             "category": "linear",
             "symbol": symbol,
             "side": side,
             "orderType": "Market",
-            "qty": str(round(qty, 2)),
+            "qty": str(normalize_qty(symbol, qty, market=True)),
             "timeInForce": "ImmediateOrCancel",
             "tradeMode": 1,
             "positionIdx": 0,
             "orderFilter": "Order"
         }
-
-        body_str = json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
-        sign_payload = f"{timestamp}{api_key}{recv_window}{body_str}"
-        send_telegram_message(f"🧾 SIGN_PAYLOAD:\n{sign_payload}")
-
-        signature = hmac.new(
-            bytes(api_secret, "utf-8"),
-            msg=bytes(sign_payload, "utf-8"),
-            digestmod=hashlib.sha256
-        ).hexdigest()
-
-        headers = {
-            "X-BAPI-API-KEY": api_key,
-            "X-BAPI-SIGN": signature,
-            "X-BAPI-TIMESTAMP": timestamp,
-            "X-BAPI-RECV-WINDOW": recv_window,
-            "Content-Type": "application/json"
-        }
-
-        response = requests.post(
-            f"{base_url}/v5/order/create",
-            data=body_str.encode(),
-            headers=headers
-        )
-
-        status = response.status_code
+        if order_link_id:
+            payload["orderLinkId"] = order_link_id  # біржа відхилить повтор з тим самим id
+        if tpsl:
+            payload.update(tpsl)  # позиція відкривається вже із TP/SL
 
         try:
-            result = response.json()
-        except Exception as decode_error:
-            send_telegram_message(f"❌ JSON decode error: {decode_error}\nResponse: {response.text}")
+            result = bybit_post("/v5/order/create", payload)
+        except ValueError as decode_error:
+            send_telegram_message(f"❌ JSON decode error: {decode_error}", TG_ERROR)
             return None
 
-        log_msg = f"🧾 Market order response ({status}):\n{json.dumps(result, indent=2)}"
+        log_msg = f"🧾 Market order response:\n{json.dumps(result, indent=2)}"
         print(log_msg)
-        send_telegram_message(log_msg)
+        send_telegram_message(log_msg, TG_DEBUG)
 
         if result.get("retCode") == 0 and "orderId" in result.get("result", {}):
             return result
         else:
-            send_telegram_message(f"⚠️ Bybit order error: {result.get('retMsg')}")
+            send_telegram_message(f"⚠️ Bybit order error: {result.get('retMsg')}", TG_WARNING)
             return None
 
     except Exception as e:
-        send_telegram_message(f"❌ Market order error: {e}")
+        send_telegram_message(f"❌ Market order error: {e}", TG_ERROR)
+        return None
+
+def build_take_profit_request(symbol, side, qty, tp, price):
+    if not is_tp_direction_valid(tp, price, side):
+        send_telegram_message(f"🚫 TP {tp} некоректний: має бути {'вище' if side == 'Buy' else 'нижче'} за ціну {price} для {side}-позиції. Не створюю.", TG_WARNING)
         return None
+    return {
+        "symbol": symbol,
+        "side": "Sell" if side == "Buy" else "Buy",
+        "orderType": "Limit",
+        "qty": str(normalize_qty(symbol, qty)),
+        "price": str(normalize_price(symbol, tp)),
+        "timeInForce": "PostOnly",
+        "reduceOnly": True
+    }
+
+
+def build_stop_loss_request(symbol, side, qty, sl, price):
+    if not is_sl_valid(sl, price):
+        original_sl = sl
+        sl = normalize_price(symbol, clamp_sl_price(price, side))
+        send_telegram_message(f"⚠️ SL {original_sl} занадто далекий від ціни {price}. Автоматично скориговано до {sl}.", TG_WARNING)
+    order_data = {
+        "symbol": symbol,
+        "side": "Sell" if side == "Buy" else "Buy",
+        "orderType": "Market",
+        "qty": str(normalize_qty(symbol, qty)),
+        "triggerPrice": str(normalize_price(symbol, sl)),
+        "triggerDirection": 2 if side == "Buy" else 1,
+        "timeInForce": "GoodTillCancel",
+        "reduceOnly": True
+    }
+    return order_data, sl
+
 
 def create_take_profit_order(symbol, side, qty, tp):
     try:
         price = get_price(symbol)
         if price is None:
-            send_telegram_message("❌ Не вдалося отримати ціну для TP.")
+            send_telegram_message("❌ Не вдалося отримати ціну для TP.", TG_ERROR)
             return None
-        if not is_tp_direction_valid(tp, price, side):
-            send_telegram_message(f"🚫 TP {tp} некоректний: має бути {'вище' if side == 'Buy' else 'нижче'} за ціну {price} для {side}-позиції. Не створюю.")
+        order_data = build_take_profit_request(symbol, side, qty, tp, price)
+        if order_data is None:
             return None
-        tp_side = "Sell" if side == "Buy" else "Buy"
-        timestamp = str(int(time.time() * 1000))
-        order_data = {
-            "category": "linear",
-            "symbol": symbol,
-            "side": tp_side,
-            "orderType": "Limit",
-            "qty": str(qty),
-            "price": str(tp),
-            "timeInForce": "PostOnly",
-            "reduceOnly": True
-        }
-        body = json.dumps(order_data)
-        sign = sign_request(api_key, api_secret, body, timestamp)
-        headers = {
-            "X-BAPI-API-KEY": api_key,
-            "X-BAPI-SIGN": sign,
-            "X-BAPI-TIMESTAMP": timestamp,
-            "X-BAPI-RECV-WINDOW": "5000",
-            "Content-Type": "application/json"
-        }
-        response = requests.post(f"{base_url}/v5/order/create", data=body, headers=headers)
-        return response.json()
+        return bybit_post("/v5/order/create", {"category": "linear", **order_data})
     except Exception as e:
         print(f"TP error: {e}")
         return None
@@ -478,224 +1519,1028 @@ def create_stop_loss_order(symbol, side, qty, sl):
     try:
         price = get_price(symbol)
         if price is None:
-            send_telegram_message("❌ Не вдалося отримати ціну для SL.")
+            send_telegram_message("❌ Не вдалося отримати ціну для SL.", TG_ERROR)
             return None
-        if not is_sl_valid(sl, price):
-            original_sl = sl
-            sl = round(price * (1 - MAX_SL_DISTANCE_PERC), 2) if side == "Buy" else round(price * (1 + MAX_SL_DISTANCE_PERC), 2)
-            send_telegram_message(f"⚠️ SL {original_sl} занадто далекий від ціни {price}. Автоматично скориговано до {sl}.")
-        sl_side = "Sell" if side == "Buy" else "Buy"
-        trigger_direction = 2 if side == "Buy" else 1
-        timestamp = str(int(time.time() * 1000))
-        order_data = {
-            "category": "linear",
-            "symbol": symbol,
-            "side": sl_side,
-            "orderType": "Market",
-            "qty": str(qty),
-            "triggerPrice": str(sl),
-            "triggerDirection": trigger_direction,
-            "timeInForce": "GoodTillCancel",
-            "reduceOnly": True
-        }
-        body = json.dumps(order_data)
-        sign = sign_request(api_key, api_secret, body, timestamp)
-        headers = {
-            "X-BAPI-API-KEY": api_key,
-            "X-BAPI-SIGN": sign,
-            "X-BAPI-TIMESTAMP": timestamp,
-            "X-BAPI-RECV-WINDOW": "5000",
-            "Content-Type": "application/json"
-        }
-        response = requests.post(f"{base_url}/v5/order/create", data=body, headers=headers)
-        return response.json()
+        order_data, sl = build_stop_loss_request(symbol, side, qty, sl, price)
+        return bybit_post("/v5/order/create", {"category": "linear", **order_data})
     except Exception as e:
-        send_telegram_message(f"❌ Помилка при створенні SL: {e}")
+        send_telegram_message(f"❌ Помилка при створенні SL: {e}", TG_ERROR)
         return None
 def create_trailing_stop(symbol, side, callback_rate):
     try:
         position_idx = 0
-        timestamp = str(int(time.time() * 1000))
-        recv_window = "5000"
         order_data = {
             "category": "linear",
             "symbol": symbol,
             "trailingStop": str(callback_rate),
             "positionIdx": position_idx
         }
-        body = json.dumps(order_data)
-        sign = sign_request(api_key, api_secret, body, timestamp)
-        headers = {
-            "X-BAPI-API-KEY": api_key,
-            "X-BAPI-SIGN": sign,
-            "X-BAPI-TIMESTAMP": timestamp,
-            "X-BAPI-RECV-WINDOW": recv_window,
-            "Content-Type": "application/json"
-        }
-        url = f"{base_url}/v5/position/trading-stop"
-        response = requests.post(url, data=body, headers=headers)
-        res_data = response.json()
-        send_telegram_message(f"🧾 Trailing SL Order (response):\n{json.dumps(res_data, indent=2)}")
+        res_data = bybit_post("/v5/position/trading-stop", order_data)
+        send_telegram_message(f"🧾 Trailing SL Order (response):\n{json.dumps(res_data, indent=2)}", TG_DEBUG)
         return res_data
     except Exception as e:
         error_text = f"❌ Trailing SL error: {e}"
         print(error_text)
-        send_telegram_message(error_text)
+        send_telegram_message(error_text, TG_ERROR)
         return None
-def log_trade_to_csv(entry):
-    try:
-        fieldnames = [
-            "timestamp", "symbol", "side", "qty", "entry_price", "tp", "sl", "trailing",
-            "order_id", "result", "pnl", "exit_price", "exit_reason", "tp_hit", "sl_hit",
-            "runtime_sec", "sl_auto_adjusted", "tp_rejected", "drawdown_pct", "risk_reward",
-            "strategy_tag", "signal_source"
-        ]
 
-        # 🔐 Якщо файл не існує — створюємо і додаємо заголовки
-        file_exists = os.path.exists(CSV_LOG_PATH)
-        with open(CSV_LOG_PATH, mode="a", newline="", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
 
-            if not file_exists:
-                writer.writeheader()
+# 🛡 Атомарний захист: TP/SL прикріплені до маркет-ордера в одному /v5/order/create
+PROTECTION_MODE = os.environ.get("protection_mode", "separate").lower()  # separate | attached
+TPSL_MODE = os.environ.get("tpsl_mode", "Full")
+TP_TRIGGER_BY = os.environ.get("tp_trigger_by", "LastPrice")
+SL_TRIGGER_BY = os.environ.get("sl_trigger_by", "LastPrice")
+
+
+def build_attached_tpsl(symbol, side, tp, sl, price):
+    """Перевіряє TP/SL локально відносно кешованої ціни і повертає
+    (поля для /v5/order/create, tp, sl, tp_rejected)."""
+    tp_rejected = False
+    if not is_tp_direction_valid(tp, price, side):
+        tp_rejected = True
+        fallback_tp = normalize_price(symbol, fallback_tp_price(price, side))
+        send_telegram_message(f"⚠️ TP {tp} некоректний для {side} при ціні {price} — fallback TP @ {fallback_tp}", TG_WARNING)
+        tp = fallback_tp
+    if not is_sl_valid(sl, price):
+        original_sl = sl
+        sl = normalize_price(symbol, clamp_sl_price(price, side))
+        send_telegram_message(f"⚠️ SL {original_sl} занадто далекий від ціни {price}. Автоматично скориговано до {sl}.", TG_WARNING)
+
+    fields = {
+        "takeProfit": str(normalize_price(symbol, tp)),
+        "stopLoss": str(normalize_price(symbol, sl)),
+        "tpslMode": TPSL_MODE,
+        "tpTriggerBy": TP_TRIGGER_BY,
+        "slTriggerBy": SL_TRIGGER_BY
+    }
+    if TPSL_MODE == "Partial":
+        fields["tpOrderType"] = "Market"
+        fields["slOrderType"] = "Market"
+    return fields, tp, sl, tp_rejected
 
-            # ✅ Заповнюємо пропущені поля None
-            for field in fieldnames:
-                if field not in entry:
-                    entry[field] = None
 
-            writer.writerow(entry)
+# 🛡 Захисні ордери: TP + SL одним create-batch, trailing — паралельно
 
-        print(f"✅ CSV запис: {entry}")
-        send_telegram_message(f"✅ CSV запис: {entry['symbol']} {entry['side']} @ {entry['entry_price']}")
+_protect_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="protect")
 
-    except Exception as e:
-        print(f"❌ CSV log error: {e}")
-        send_telegram_message(f"❌ CSV log error: {e}")
 
-def log_trade_to_sheets(entry):
+def place_protective_orders(symbol, side, qty, tp, sl, use_trailing=False, callback=0.75, fallback_price=None):
+    results = {"tp": None, "sl": None, "trailing": None, "sl_price": sl}
+
+    trailing_future = None
+    if use_trailing:
+        trailing_future = _protect_pool.submit(create_trailing_stop, symbol, side, callback)
+
+    # Позиція вже відкрита — без свіжої ціни (breaker, стрім мовчить) рахуємо від ціни входу
+    price = get_price(symbol) or fallback_price
+    if price is None:
+        send_telegram_message("❌ Не вдалося отримати ціну для TP/SL.", TG_ERROR)
+    else:
+        legs = []
+        tp_order = build_take_profit_request(symbol, side, qty, tp, price)
+        if tp_order:
+            legs.append(("tp", tp_order))
+        sl_order, results["sl_price"] = build_stop_loss_request(symbol, side, qty, sl, price)
+        legs.append(("sl", sl_order))
+
+        try:
+            data = bybit_post("/v5/order/create-batch", {
+                "category": "linear",
+                "request": [order for _, order in legs]
+            })
+            items = (data.get("result") or {}).get("list") or []
+            infos = (data.get("retExtInfo") or {}).get("list") or []
+
+            # 🔎 Кожна нога батчу має свій код — обробляємо окремо
+            for i, (name, _) in enumerate(legs):
+                item = items[i] if i < len(items) else {}
+                info = infos[i] if i < len(infos) else {"code": data.get("retCode"), "msg": data.get("retMsg")}
+                if info.get("code") == 0 and item.get("orderId"):
+                    results[name] = {"retCode": 0, "retMsg": "OK", "result": item}
+                else:
+                    send_telegram_message(f"⚠️ {name.upper()} не створено в batch: {info.get('msg')}", TG_WARNING)
+        except Exception as e:
+            send_telegram_message(f"❌ create-batch error: {e}", TG_ERROR)
+
+        # 🔁 SL без якого позиція незахищена — одна окрема повторна спроба
+        if results["sl"] is None:
+            results["sl"] = create_stop_loss_order(symbol, side, qty, results["sl_price"])
+
+    if trailing_future is not None:
+        results["trailing"] = trailing_future.result()
+    return results
+
+
+# 🗄 Сховище угод: SQLite у WAL-режимі, індекси по order_id / symbol / timestamp.
+# trades.csv лишається форматом експорту (і одноразово імпортується при першому старті).
+
+TRADE_FIELDS = [
+    "timestamp", "symbol", "side", "qty", "entry_price", "tp", "sl", "trailing",
+    "order_id", "result", "pnl", "exit_price", "exit_reason", "tp_hit", "sl_hit",
+    "runtime_sec", "sl_auto_adjusted", "tp_rejected", "drawdown_pct", "risk_reward",
+    "strategy_tag", "signal_source", "order_type"
+]
+TRADE_REAL_FIELDS = {"qty", "entry_price", "tp", "sl", "pnl", "exit_price", "runtime_sec", "drawdown_pct", "risk_reward"}
+
+_TRADE_COLUMNS = TRADE_FIELDS + ["updated_at"]
+_TRADE_UPSERT_SQL = (
+    f"INSERT INTO trades ({', '.join(_TRADE_COLUMNS)}) VALUES ({', '.join('?' for _ in _TRADE_COLUMNS)}) "
+    f"ON CONFLICT(order_id) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in _TRADE_COLUMNS if c != "order_id")
+)
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_ready = False
+
+
+def get_trades_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(TRADES_DB_PATH, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        if not _db_ready:
+            init_trades_db(conn)
+    return conn
+
+
+def init_trades_db(conn):
+    global _db_ready
+    with _db_init_lock:
+        if _db_ready:
+            return
+        columns = ", ".join(f"{f} {'REAL' if f in TRADE_REAL_FIELDS else 'TEXT'}" for f in TRADE_FIELDS)
+        with conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS trades (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns}, updated_at REAL)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_trades_order_id ON trades(order_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_trades_symbol ON trades(symbol, timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_trades_timestamp ON trades(timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_trades_updated_at ON trades(updated_at)")
+            # Скільки closedSize кожного запису closed-pnl уже віддано закритим угодам
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS closed_pnl_used (record_id TEXT, trade_order_id TEXT, symbol TEXT, "
+                "size REAL, created_ms INTEGER, PRIMARY KEY (record_id, trade_order_id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_closed_pnl_used_symbol ON closed_pnl_used(symbol, created_ms)")
+
+        # 📥 Одноразовий імпорт історії з trades.csv
+        empty = conn.execute("SELECT 1 FROM trades LIMIT 1").fetchone() is None
+        if empty and os.path.exists(CSV_LOG_PATH):
+            with open(CSV_LOG_PATH, mode="r", encoding="utf-8") as f:
+                rows = [_trade_row(row) for row in csv.DictReader(f)]
+            with conn:
+                conn.executemany(_TRADE_UPSERT_SQL, rows)
+            print(f"📥 Імпортовано {len(rows)} угод з trades.csv у {TRADES_DB_PATH}")
+        _db_ready = True
+
+
+def _to_db(field, value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return str(value)
+    if field in TRADE_REAL_FIELDS:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+    return str(value)
+
+
+def _trade_row(entry):
+    return [_to_db(f, entry.get(f)) for f in TRADE_FIELDS] + [time.time()]
+
+
+def upsert_trade(entry):
+    conn = get_trades_db()
+    with conn:
+        conn.execute(_TRADE_UPSERT_SQL, _trade_row(entry))
+
+
+def update_trade(order_id, updates):
+    fields = [f for f in updates if f in TRADE_FIELDS and f != "order_id"]
+    if not fields:
+        return 0
+    conn = get_trades_db()
+    with conn:
+        cursor = conn.execute(
+            f"UPDATE trades SET {', '.join(f'{f} = ?' for f in fields)}, updated_at = ? WHERE order_id = ?",
+            [_to_db(f, updates[f]) for f in fields] + [time.time(), order_id]
+        )
+    return cursor.rowcount
+
+
+def query_trades(since=None, until=None, symbol=None, strategy_tag=None):
+    clauses, params = [], []
+    if since:
+        clauses.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        clauses.append("timestamp < ?")
+        params.append(until)
+    if symbol:
+        clauses.append("symbol = ?")
+        params.append(symbol)
+    if strategy_tag:
+        clauses.append("strategy_tag = ?")
+        params.append(strategy_tag)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return get_trades_db().execute(
+        f"SELECT {', '.join(TRADE_FIELDS)} FROM trades {where} ORDER BY timestamp, id", params
+    )
+
+
+def trades_version():
+    row = get_trades_db().execute("SELECT MAX(id), MAX(updated_at) FROM trades").fetchone()
+    return row[0] or 0, row[1] or 0.0
+
+
+def export_trades_csv(path=CSV_LOG_PATH, **filters):
+    with open(path, mode="w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(TRADE_FIELDS)
+        writer.writerows(query_trades(**filters))
+
+
+def log_trade_to_csv(entry):
     try:
+        upsert_trade(entry)
+        print(f"✅ Trade запис: {entry}")
+        send_telegram_message(f"✅ Trade запис: {entry['symbol']} {entry['side']} @ {entry['entry_price']}")
+
+    except Exception as e:
+        print(f"❌ Trade log error: {e}")
+        send_telegram_message(f"❌ Trade log error: {e}", TG_ERROR)
+
+# 📄 Google Sheets sink: авторизація один раз, кешований worksheet, буфер рядків,
+# append_rows пачками з фонового потоку + disk spool, щоб рядки не губились
+
+SHEETS_KEY = os.environ.get("sheets_key", "1fHKdlzDFLzAYz7k7Eku4edxYuxJeDWbojDLcfXx2iSg")
+SHEETS_WORKSHEET = os.environ.get("sheets_worksheet", "Logs")
+SHEETS_BATCH_SIZE = int(os.environ.get("sheets_batch_size", 20))
+SHEETS_FLUSH_SEC = float(os.environ.get("sheets_flush_sec", 5))
+SHEETS_MAX_RETRIES = 5
+SHEETS_SPOOL_PATH = os.path.join(DATA_DIR, "sheets_spool.jsonl")
+SHEETS_FIELDS = TRADE_FIELDS[:TRADE_FIELDS.index("signal_source") + 1]
+
+_sheets_worksheet = None
+_sheets_buffer = []
+_sheets_lock = threading.Lock()
+_sheets_flush_lock = threading.Lock()
+_sheets_wakeup = threading.Event()
+_sheets_thread = None
+
+
+def get_worksheet():
+    global _sheets_worksheet
+    if _sheets_worksheet is None:
+        # gspread / oauth2client важкі (~0.25 с імпорту) — вантажимо лише коли Sheets справді потрібні
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
         scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
         creds_dict = json.loads(os.environ["GOOGLE_SERVICE_JSON"])
         creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
         client = gspread.authorize(creds)
+        _sheets_worksheet = client.open_by_key(SHEETS_KEY).worksheet(SHEETS_WORKSHEET)
+    return _sheets_worksheet
 
-        sheet = client.open_by_key("1fHKdlzDFLzAYz7k7Eku4edxYuxJeDWbojDLcfXx2iSg").worksheet("Logs")
-
-
-        row = [
-            entry.get("timestamp"),
-            entry.get("symbol"),
-            entry.get("side"),
-            entry.get("qty"),
-            entry.get("entry_price"),
-            entry.get("tp"),
-            entry.get("sl"),
-            entry.get("trailing"),
-            entry.get("order_id"),
-            entry.get("result"),
-            entry.get("pnl"),
-            entry.get("exit_price"),
-            entry.get("exit_reason"),
-            entry.get("tp_hit"),
-            entry.get("sl_hit"),
-            entry.get("runtime_sec"),
-            entry.get("sl_auto_adjusted"),
-            entry.get("tp_rejected"),
-            entry.get("drawdown_pct"),
-            entry.get("risk_reward"),
-            entry.get("strategy_tag"),
-            entry.get("signal_source")
-        ]
-
-        sheet.append_row(row, value_input_option="USER_ENTERED")
-
-        print(f"📄 Google Sheet запис: {entry['symbol']} {entry['side']} @ {entry['entry_price']}")
-        send_telegram_message(f"📄 Google Sheet запис: {entry['symbol']} {entry['side']}")
 
-    except Exception as e:
-        print(f"❌ Google Sheets log error: {e}")
-        send_telegram_message(f"❌ Google Sheets log error: {e}")
-def check_order_status(order_id, symbol):
+def start_sheets_worker():
+    """Spool спільний для всіх воркерів, а в Sheets пише лише лідер (див. start_services)."""
+    global _sheets_thread
+    with _sheets_lock:
+        if _sheets_thread is not None:
+            return
+        _sheets_thread = threading.Thread(target=_sheets_worker, name="sheets", daemon=True)
+        _sheets_thread.start()
+
+
+def _sheets_worker():
+    while True:
+        _sheets_wakeup.wait(SHEETS_FLUSH_SEC)
+        _sheets_wakeup.clear()
+        flush_sheets()
+
+
+def _read_sheets_spool():
+    rows = []
+    if os.path.exists(SHEETS_SPOOL_PATH):
+        with open(SHEETS_SPOOL_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    continue
+    return rows
+
+
+def _rewrite_sheets_spool():
+    tmp_path = f"{SHEETS_SPOOL_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for row in _sheets_buffer:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, SHEETS_SPOOL_PATH)
+
+
+def flush_sheets(retries=SHEETS_MAX_RETRIES):
+    global _sheets_worksheet
+    with _sheets_flush_lock:
+        # ♻️ Spool — джерело правди: сюди дописують усі воркери, і тут лишаються рядки з попередніх запусків
+        with _sheets_lock, file_lock(SHEETS_SPOOL_PATH):
+            _sheets_buffer[:] = _read_sheets_spool()
+            rows = list(_sheets_buffer)
+        if not rows:
+            return True
+
+        for attempt in range(retries):
+            try:
+                with timed("parsibot_sheets_flush_seconds"):
+                    get_worksheet().append_rows(rows, value_input_option="USER_ENTERED")
+                inc("parsibot_sheets_rows_total", len(rows))
+                break
+            except Exception as e:
+                # 🔑 Протермінований токен / 401 — лінива переавторизація на наступній спробі
+                if getattr(getattr(e, "response", None), "status_code", None) == 401:
+                    _sheets_worksheet = None
+                print(f"❌ Google Sheets log error (спроба {attempt + 1}/{retries}): {e}")
+                if attempt == retries - 1:
+                    send_telegram_message(f"❌ Google Sheets log error: {e}. {len(rows)} рядків чекають у spool.", TG_ERROR)
+                    return False
+                time.sleep(min(2 ** attempt, 30) * (0.5 + random.random()))
+
+        with _sheets_lock, file_lock(SHEETS_SPOOL_PATH):
+            _sheets_buffer[:] = _read_sheets_spool()[len(rows):]
+            _rewrite_sheets_spool()
+
+        print(f"📄 Google Sheet: записано {len(rows)} рядків")
+        send_telegram_message(f"📄 Google Sheet: записано {len(rows)} рядків", TG_DEBUG)
+        return True
+
+
+def log_trade_to_sheets(entry):
+    if not os.environ.get("GOOGLE_SERVICE_JSON"):
+        return
     try:
-        timestamp = str(int(time.time() * 1000))
-        params = {
-            "category": "linear",
-            "orderId": order_id,
-            "symbol": symbol,
-            "api_key": api_key,
-            "timestamp": timestamp
+        row = [entry.get(field) for field in SHEETS_FIELDS]
+        with _sheets_lock, file_lock(SHEETS_SPOOL_PATH):
+            with open(SHEETS_SPOOL_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            if _sheets_thread is None:
+                return  # не лідер: рядок забере sheets-воркер лідера
+            _sheets_buffer.append(row)
+            pending = len(_sheets_buffer)
+
+        if pending >= SHEETS_BATCH_SIZE:
+            _sheets_wakeup.set()
+
+    except Exception as e:
+        print(f"❌ Google Sheets spool error: {e}")
+        send_telegram_message(f"❌ Google Sheets spool error: {e}", TG_ERROR)
+
+
+atexit.register(lambda: _sheets_thread is not None and flush_sheets(retries=1))
+
+
+# 📚 Закриття угод — з /v5/position/closed-pnl: одна вибірка на символ (а не запит на кожен трейд).
+# Bybit віддає closed-pnl вікнами до 7 днів; завершені вікна незмінні й кешуються, тож угода,
+# старша за тиждень, коштує один запит поточного вікна плюс разове завантаження історії.
+
+CLOSED_PNL_PAGE_LIMIT = 100
+CLOSED_PNL_MAX_PAGES = 20
+CLOSED_PNL_WINDOW_MS = 7 * 24 * 3600 * 1000
+CLOSED_PNL_SETTLE_MS = 5 * 60 * 1000  # вікно вважається завершеним із запасом на затримку запису
+CLOSED_PNL_MAX_LOOKBACK_MS = 730 * 24 * 3600 * 1000  # Bybit зберігає closed-pnl два роки
+
+_closed_pnl_windows = {}  # (symbol, window_start) -> записи завершеного вікна
+
+
+def _fetch_closed_pnl_window(symbol, start_ms, end_ms):
+    records = []
+    params = {
+        "category": "linear",
+        "symbol": symbol,
+        "startTime": start_ms,
+        "endTime": end_ms,
+        "limit": CLOSED_PNL_PAGE_LIMIT
+    }
+    for _ in range(CLOSED_PNL_MAX_PAGES):
+        data = bybit_get("/v5/position/closed-pnl", params)
+        if data.get("retCode") != 0:
+            raise ValueError(f"closed-pnl {symbol}: {data.get('retMsg')}")
+        result = data.get("result") or {}
+        records.extend(result.get("list") or [])
+        cursor = result.get("nextPageCursor")
+        if not cursor:
+            break
+        params["cursor"] = cursor
+    return records
+
+
+def fetch_closed_pnl(symbol, since_ms):
+    """Записи closed-pnl символу від since_ms до зараз, за часом створення (годинник біржі)."""
+    now_ms = int(bybit_timestamp())
+    since_ms = max(int(since_ms), now_ms - CLOSED_PNL_MAX_LOOKBACK_MS)
+    records = []
+    window_start = since_ms - since_ms % CLOSED_PNL_WINDOW_MS
+    while window_start <= now_ms:
+        window_end = window_start + CLOSED_PNL_WINDOW_MS - 1
+        key = (symbol, window_start)
+        if key in _closed_pnl_windows:
+            records.extend(_closed_pnl_windows[key])
+        else:
+            window = _fetch_closed_pnl_window(symbol, window_start, min(window_end, now_ms))
+            if window_end < now_ms - CLOSED_PNL_SETTLE_MS:
+                _closed_pnl_windows[key] = window
+            records.extend(window)
+        window_start += CLOSED_PNL_WINDOW_MS
+    return sorted(records, key=lambda r: (int(r.get("createdTime") or 0), r.get("orderId", "")))
+
+
+def prune_closed_pnl_cache(symbols_since):
+    """Лишає в кеші тільки вікна, які ще потрібні відкритим угодам ({symbol: since_ms})."""
+    for symbol, window_start in list(_closed_pnl_windows):
+        since_ms = symbols_since.get(symbol)
+        if since_ms is None or window_start + CLOSED_PNL_WINDOW_MS <= since_ms:
+            del _closed_pnl_windows[(symbol, window_start)]
+
+
+def closed_pnl_record_id(record):
+    return record.get("orderId") or f"{record.get('createdTime')}:{record.get('side')}:{record.get('closedSize')}"
+
+
+def load_closed_pnl_used(symbol, since_ms, open_order_ids=()):
+    """{record_id: обсяг}, уже розподілений між закритими угодами. Рядки угод, що ще в реєстрі
+    (крах між записом розподілу і remove_open_trade), не враховуються — їх розподіл порахується заново."""
+    used = {}
+    rows = get_trades_db().execute(
+        "SELECT record_id, trade_order_id, size FROM closed_pnl_used WHERE symbol = ? AND created_ms >= ?",
+        (symbol, int(since_ms))
+    )
+    for record_id, trade_order_id, size in rows:
+        if trade_order_id not in open_order_ids:
+            used[record_id] = used.get(record_id, 0.0) + size
+    return used
+
+
+def save_closed_pnl_used(symbol, order_id, allocations):
+    conn = get_trades_db()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO closed_pnl_used (record_id, trade_order_id, symbol, size, created_ms) VALUES (?, ?, ?, ?, ?)",
+            [(record_id, order_id, symbol, size, created_ms) for record_id, size, created_ms in allocations]
+        )
+
+
+def match_closed_trades(trades, records, used=None):
+    """FIFO-розподіл закритого обсягу між угодами символу (one-way режим: позиція одна на символ).
+    Запис закриває угоду протилежної сторони, відкриту раніше за нього; used — обсяг записів,
+    уже відданий угодам, закритим у попередніх циклах. Повертає {order_id: status_info}."""
+    used = used or {}
+    remaining = [float(r.get("closedSize") or 0) - used.get(closed_pnl_record_id(r), 0.0) for r in records]
+    closed = {}
+    for trade in sorted(trades, key=lambda t: _trade_opened_ms(t) or 0):
+        opened_ms = _trade_opened_ms(trade) or 0
+        qty = float(trade.get("qty") or 0)
+        if qty <= 0:
+            continue
+        need, pnl, exit_value, last, allocations = qty, 0.0, 0.0, None, []
+        for i, record in enumerate(records):
+            if remaining[i] <= 1e-12 or record.get("side") == trade["side"]:
+                continue
+            if int(record.get("createdTime") or 0) < opened_ms:
+                continue
+            take = min(need, remaining[i])
+            share = take / float(record["closedSize"])
+            pnl += float(record.get("closedPnl") or 0) * share
+            exit_value += take * float(record.get("avgExitPrice") or 0)
+            remaining[i] -= take
+            need -= take
+            last = record
+            allocations.append((closed_pnl_record_id(record), take, int(record.get("createdTime") or 0)))
+            if need <= qty * 1e-9:
+                break
+        if last is None or need > qty * 1e-9:
+            continue  # позиція ще (частково) відкрита
+        closed[trade["order_id"]] = {
+            "exit_price": exit_value / qty,
+            "pnl": pnl,  # closedPnl — реалізований результат за вирахуванням комісій
+            "order_type": last.get("orderType", "Unknown"),
+            "runtime_sec": round((int(last.get("updatedTime") or last.get("createdTime") or 0) - opened_ms) / 1000),
+            "allocations": allocations
         }
+    return closed
+
+
+# 🧵 Асинхронне виконання сигналів: webhook лише ставить у чергу (202),
+# воркери виконують строго по черзі в межах символу і паралельно між символами
+
+SIGNAL_WORKERS = int(os.environ.get("signal_workers", 4))
+JOBS_MAX = 1000
+
+_signal_pool = ThreadPoolExecutor(max_workers=SIGNAL_WORKERS, thread_name_prefix="signal")
+_jobs = OrderedDict()   # job_id -> статус задачі
+_symbol_queues = {}     # symbol -> deque[(job, data)]
+_active_symbols = set()
+_jobs_lock = threading.Lock()
+
+
+# 🔁 Ідемпотентність: TradingView повторює повільні webhook-и — повтор не має відкрити другу позицію.
+# Ключ — order_link_id або sha256 payload-а (з часом бару, без пароля); TTL-кеш у пам'яті + JSONL-дзеркало.
+IDEMPOTENCY_TTL_SEC = float(os.environ.get("idempotency_ttl_sec", 3600))
+# Без bar_time/time однаковий payload може бути новим сигналом — ловимо лише ретраї TradingView
+IDEMPOTENCY_UNTIMED_TTL_SEC = float(os.environ.get("idempotency_untimed_ttl_sec", 60))
+# queued/running без оновлення довше за lease — воркер упав; повтор забирає ключ (orderLinkId той самий)
+IDEMPOTENCY_LEASE_SEC = float(os.environ.get("idempotency_lease_sec", 300))
+IDEMPOTENCY_PATH = os.path.join(DATA_DIR, "idempotency.jsonl")
+ORDER_LINK_ID_MAX = 36
+
+_idempotency = OrderedDict()  # key -> {"key", "job_id", "created", "expires", "leased", "status", "http_status", "result"}
+_idempotency_loaded = False
+_idempotency_position = (None, 0)  # (inode, offset) дочитаного дзеркала
+_idempotency_lock = threading.Lock()
+
+
+def idempotency_key(data):
+    order_link_id = str(data.get("order_link_id") or "").strip()
+    if order_link_id:
+        return f"olid:{order_link_id}"
+    fields = {k: v for k, v in data.items() if k != "password"}
+    fields["bar_time"] = data.get("bar_time") or data.get("time") or ""
+    canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'), default=str)
+    return "sha256:" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def idempotency_ttl(data):
+    if str(data.get("order_link_id") or "").strip() or data.get("bar_time") or data.get("time"):
+        return IDEMPOTENCY_TTL_SEC
+    return IDEMPOTENCY_UNTIMED_TTL_SEC
+
+
+def _signal_expires(record):
+    return record.get("expires", record["created"] + IDEMPOTENCY_TTL_SEC)
+
+
+def _signal_abandoned(record, now):
+    if record["status"] not in ("queued", "running"):
+        return False
+    if now - record.get("leased", record["created"]) <= IDEMPOTENCY_LEASE_SEC:
+        return False
+    with _jobs_lock:
+        job = _jobs.get(record["job_id"])
+        # Задача цього воркера ще чекає в черзі символу — вона жива
+        return job is None or job["status"] not in ("queued", "running")
+
+
+def order_link_id_for(key):
+    """orderLinkId для Bybit: до 36 символів [A-Za-z0-9_-]; інакше — похідний від ключа хеш."""
+    if key.startswith("olid:"):
+        raw = key[5:]
+        if len(raw) <= ORDER_LINK_ID_MAX and all(c.isascii() and (c.isalnum() or c in "-_") for c in raw):
+            return raw
+    return "pb-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:ORDER_LINK_ID_MAX - 3]
+
+
+def _prune_idempotency(now=None):
+    now = now or time.time()
+    while _idempotency:
+        key, record = next(iter(_idempotency.items()))
+        if _signal_expires(record) > now:
+            break
+        del _idempotency[key]
+
+
+def load_idempotency():
+    global _idempotency_loaded, _idempotency_position
+    with _idempotency_lock, file_lock(IDEMPOTENCY_PATH):
+        _idempotency.clear()
+        _idempotency_position = (None, 0)
+        _read_idempotency_tail()
+        _prune_idempotency()
+        # Переписуємо дзеркало лише живими записами — файл не росте між рестартами
+        tmp_path = f"{IDEMPOTENCY_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in _idempotency.values():
+                f.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False, default=str) + "\n")
+        os.replace(tmp_path, IDEMPOTENCY_PATH)
+        _idempotency_position = (os.stat(IDEMPOTENCY_PATH).st_ino, os.path.getsize(IDEMPOTENCY_PATH))
+        _idempotency_loaded = True
+
+
+def _read_idempotency_tail():
+    """Дочитує записи інших воркерів з місця, де зупинились. Під _idempotency_lock + file_lock."""
+    global _idempotency_position
+    try:
+        stat = os.stat(IDEMPOTENCY_PATH)
+    except FileNotFoundError:
+        return
+    inode, offset = _idempotency_position
+    if inode != stat.st_ino or stat.st_size < offset:
+        offset = 0  # файл переписано іншим воркером — читаємо заново (записи ідемпотентні)
+    if stat.st_size == offset and inode == stat.st_ino:
+        return
+    with open(IDEMPOTENCY_PATH, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # недописаний рядок — дочитаємо наступного разу
+            offset += len(line)
+            try:
+                record = json.loads(line)
+                _idempotency[record["key"]] = record
+                _idempotency.move_to_end(record["key"])
+            except (ValueError, KeyError):
+                continue  # обірваний запис після краху — пропускаємо
+    _idempotency_position = (stat.st_ino, offset)
+
+
+def _ensure_idempotency_loaded():
+    if not _idempotency_loaded:
+        load_idempotency()
+
+
+def _remember_signal(record):
+    """Викликається під _idempotency_lock + file_lock."""
+    global _idempotency_position
+    _idempotency[record["key"]] = record
+    _idempotency.move_to_end(record["key"])
+    try:
+        line = (json.dumps(record, separators=(',', ':'), ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        with open(IDEMPOTENCY_PATH, "ab") as f:
+            f.write(line)
+        inode, offset = _idempotency_position
+        _idempotency_position = (inode, offset + len(line))
+    except OSError as e:
+        print(f"❌ idempotency mirror error: {e}")
+
+
+def _claim_signal(key, job_id, ttl=IDEMPOTENCY_TTL_SEC):
+    """Повертає попередній запис для дубліката або None, якщо ключ щойно зайнято цією задачею."""
+    _ensure_idempotency_loaded()
+    with _idempotency_lock, file_lock(IDEMPOTENCY_PATH):
+        _read_idempotency_tail()
+        now = time.time()
+        _prune_idempotency(now)
+        record = _idempotency.get(key)
+        # Короткий TTL може стояти за довшим у черзі pruning-у — перевіряємо і тут
+        if record is not None and _signal_expires(record) > now and not _signal_abandoned(record, now):
+            return dict(record)
+        _remember_signal({
+            "key": key,
+            "job_id": job_id,
+            "created": now,
+            "expires": now + ttl,
+            "leased": now,
+            "status": "queued",
+            "http_status": None,
+            "result": None
+        })
+        return None
 
-        # Підпис
-        query_string = "&".join([f"{k}={params[k]}" for k in sorted(params)])
-        sign = hmac.new(
-            bytes(api_secret, "utf-8"),
-            msg=bytes(query_string, "utf-8"),
-            digestmod=hashlib.sha256
-        ).hexdigest()
 
-        params["sign"] = sign
+def _settle_signal(key, job_id, status, http_status, result):
+    with _idempotency_lock, file_lock(IDEMPOTENCY_PATH):
+        _read_idempotency_tail()
+        record = _idempotency.get(key)
+        if record is None or record["job_id"] != job_id:
+            return  # ключ уже перезайнято після простроченого lease
+        _remember_signal(dict(record, status=status, http_status=http_status, result=result, leased=time.time()))
 
-        # API запит
-        url = f"{base_url}/v5/order/history"
-        response = requests.get(url, params=params)
-        data = response.json()
 
-        if debug_responses:
-            print(f"🔍 Order status response:\n{json.dumps(data, indent=2)}")
+def find_signal_job(job_id):
+    """Статус задачі з дзеркала: задачу міг прийняти інший воркер."""
+    _ensure_idempotency_loaded()
+    with _idempotency_lock, file_lock(IDEMPOTENCY_PATH):
+        _read_idempotency_tail()
+        for record in reversed(_idempotency.values()):
+            if record["job_id"] == job_id:
+                return {
+                    "job_id": job_id,
+                    "created_at": datetime.utcfromtimestamp(record["created"]).strftime("%Y-%m-%d %H:%M:%S"),
+                    "status": record["status"],
+                    "http_status": record["http_status"],
+                    "result": record["result"]
+                }
+    return None
+
+
+# 🎙 Рекордер webhook-трафіку: кожен прийнятий payload + час надходження + результат.
+# Запис — з фонового потоку; файл — append-only послідовність gzip-членів (читається gzip.open),
+# ротація за розміром, паролі/ключі замасковано. Програвання — replay.py.
+WEBHOOK_RECORD_DIR = os.environ.get("webhook_record_dir", "")
+WEBHOOK_RECORD_MAX_BYTES = int(float(os.environ.get("webhook_record_max_mb", 50)) * 1024 * 1024)
+WEBHOOK_RECORD_KEEP = int(os.environ.get("webhook_record_keep", 20))
+WEBHOOK_RECORD_BATCH = 500
+WEBHOOK_RECORD_FLUSH_SEC = 1.0
+REDACTED_KEYS = {"password", "api_key", "api_secret", "secret", "token", "passphrase"}
+
+_record_queue = queue.Queue(maxsize=10000)
+_record_thread = None
+_record_lock = threading.Lock()
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: "***" if str(k).lower() in REDACTED_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    return value
+
+
+def record_webhook(payload, received_at, job_id, status, http_status=None, result=None):
+    if not WEBHOOK_RECORD_DIR:
+        return
+    if _record_thread is None:
+        start_recorder()
+    record = {
+        "received_at": received_at,
+        "symbol": payload.get("symbol", default_symbol),
+        "job_id": job_id,
+        "status": status,
+        "http_status": http_status,
+        "latency_ms": round((time.time() - received_at) * 1000, 1),
+        "result": result,
+        "payload": redact(payload)
+    }
+    try:
+        _record_queue.put_nowait(record)
+    except queue.Full:
+        inc("parsibot_webhook_record_dropped_total")
+
+
+def start_recorder():
+    global _record_thread
+    with _record_lock:
+        if _record_thread is None:
+            os.makedirs(WEBHOOK_RECORD_DIR, exist_ok=True)
+            _record_thread = threading.Thread(target=_record_worker, name="recorder", daemon=True)
+            _record_thread.start()
+
+
+def _record_worker():
+    while True:
+        batch = [_record_queue.get()]
+        deadline = time.monotonic() + WEBHOOK_RECORD_FLUSH_SEC
+        while len(batch) < WEBHOOK_RECORD_BATCH:
+            try:
+                batch.append(_record_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            _write_records(batch)
+        except Exception as e:
+            inc("parsibot_webhook_record_dropped_total", len(batch))
+            print(f"❌ Webhook recorder error: {e}")
+
+
+def _record_path():
+    return os.path.join(WEBHOOK_RECORD_DIR, "webhooks.jsonl.gz")
 
-        if data.get("retCode") != 0 or not data["result"]["list"]:
-            return None
 
-        order = data["result"]["list"][0]
-        status = order.get("orderStatus")
-        exit_price = float(order.get("avgPrice", 0))
-        pnl = float(order.get("cumExecValue", 0))
-        order_type = order.get("orderType", "Unknown")
+def _write_records(records):
+    data = "".join(json.dumps(r, separators=(',', ':'), ensure_ascii=False, default=str) + "\n" for r in records)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # окремий gzip-член на пачку
+    member = compressor.compress(data.encode("utf-8")) + compressor.flush()
+    path = _record_path()
+    with file_lock(path):
+        with open(path, "ab") as f:
+            f.write(member)
+        if os.path.getsize(path) >= WEBHOOK_RECORD_MAX_BYTES:
+            _rotate_records(path)
 
-        # Час у мілісекундах
-        create_time_ms = int(order.get("createdTime", 0))
-        update_time_ms = int(order.get("updatedTime", 0))
-        runtime_sec = round((update_time_ms - create_time_ms) / 1000)
 
+def _rotate_records(path):
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    os.replace(path, os.path.join(WEBHOOK_RECORD_DIR, f"webhooks-{stamp}-{os.getpid()}.jsonl.gz"))
+    rotated = sorted(f for f in os.listdir(WEBHOOK_RECORD_DIR) if f.startswith("webhooks-") and f.endswith(".jsonl.gz"))
+    for name in rotated[:-WEBHOOK_RECORD_KEEP] if WEBHOOK_RECORD_KEEP > 0 else []:
+        os.remove(os.path.join(WEBHOOK_RECORD_DIR, name))
+
+
+def flush_recorder():
+    batch = []
+    while True:
+        try:
+            batch.append(_record_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        _write_records(batch)
+
+
+atexit.register(lambda: _record_thread is not None and flush_recorder())
+
+
+def validate_signal(data):
+    if data.get("side") not in ("Buy", "Sell"):
+        return "Invalid side"
+    for field in ("tp", "sl"):
+        try:
+            float(data.get(field))
+        except (TypeError, ValueError):
+            return f"Invalid {field}"
+    try:
+        float(data.get("callback", 0.75))
+    except (TypeError, ValueError):
+        return "Invalid callback"
+    if "max_slippage_pct" in data:
+        # 🛡️ Сигнал може лише звузити допуск прослизання, не розширити
+        try:
+            max_slippage = float(data["max_slippage_pct"])
+        except (TypeError, ValueError):
+            return "Invalid max_slippage_pct"
+        if not 0 < max_slippage <= MAX_SLIPPAGE_PCT:
+            return f"max_slippage_pct must be in (0, {MAX_SLIPPAGE_PCT}]"
+    return None
+
+
+def submit_signal(data, received_at=None):
+    """Ставить сигнал у чергу. Повертає (job, duplicate): для повтору — знімок оригінальної задачі."""
+    symbol = data.get("symbol", default_symbol)
+    received_at = received_at or time.time()
+    raw = data
+    key = idempotency_key(data)
+    job_id = uuid.uuid4().hex
+    original = _claim_signal(key, job_id, idempotency_ttl(data))
+    if original is not None:
+        inc("parsibot_webhook_duplicates_total", symbol=symbol)
+        with _jobs_lock:
+            job = _jobs.get(original["job_id"])
+            if job is not None:
+                return dict(job), True
         return {
-            "status": status,
-            "exit_price": exit_price,
-            "pnl": pnl,
-            "order_type": order_type,
-            "runtime_sec": runtime_sec
-        }
+            "job_id": original["job_id"],
+            "symbol": symbol,
+            "side": data.get("side"),
+            "status": original["status"],
+            "http_status": original["http_status"],
+            "result": original["result"]
+        }, True
+
+    data = dict(data, order_link_id=order_link_id_for(key))
+    job = {
+        "job_id": job_id,
+        "idempotency_key": key,
+        "symbol": symbol,
+        "side": data.get("side"),
+        "status": "queued",
+        "created_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "started_at": None,
+        "finished_at": None,
+        "http_status": None,
+        "result": None,
+        "received": time.monotonic(),
+        "received_at": received_at
+    }
+    with _jobs_lock:
+        _jobs[job["job_id"]] = job
+        while len(_jobs) > JOBS_MAX:
+            oldest_id, oldest = next(iter(_jobs.items()))
+            if oldest["status"] in ("queued", "running"):
+                break
+            del _jobs[oldest_id]
 
-    except Exception as e:
-        print(f"❌ check_order_status error: {e}")
-        return None
+        _symbol_queues.setdefault(symbol, deque()).append((job, data, raw))
+        if symbol in _active_symbols:
+            return job, False
+        _active_symbols.add(symbol)
 
+    _signal_pool.submit(_drain_symbol, symbol)
+    return job, False
 
 
-        
+def _drain_symbol(symbol):
+    while True:
+        with _jobs_lock:
+            pending = _symbol_queues.get(symbol)
+            if not pending:
+                _symbol_queues.pop(symbol, None)
+                _active_symbols.discard(symbol)
+                return
+            job, data, raw = pending.popleft()
+            job["status"] = "running"
+            job["started_at"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        _settle_signal(job["idempotency_key"], job["job_id"], "running", None, None)  # продовжує lease
+
+        try:
+            result, http_status = execute_signal(data, received=job["received"])
+        except Exception as e:
+            result, http_status = {"error": str(e)}, 500
+        inc("parsibot_signals_total", symbol=symbol, status=http_status)
+        observe("parsibot_signal_seconds", time.monotonic() - job["received"], symbol=symbol)
+
+        with _jobs_lock:
+            job["status"] = "done" if http_status < 400 else "failed"
+            job["http_status"] = http_status
+            job["result"] = result
+            job["finished_at"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        _settle_signal(job["idempotency_key"], job["job_id"], job["status"], http_status, result)
+        record_webhook(raw, job["received_at"], job["job_id"], job["status"], http_status, result)
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+# Назовні — лише стан задачі; ключ ідемпотентності й monotonic-час лишаються всередині
+JOB_PUBLIC_FIELDS = ("job_id", "symbol", "side", "status", "http_status", "result", "created_at", "started_at", "finished_at")
 
 
-@app.route("/webhook", methods=["POST"])
+def public_job(job):
+    return {field: job.get(field) for field in JOB_PUBLIC_FIELDS}
+
+
+@bp.route("/webhook", methods=["POST"])
 def webhook():
+    with timed("parsibot_webhook_seconds"):
+        return _webhook()
+
+
+def _webhook():
     try:
+        received_at = time.time()
         data = request.get_json(force=True)
-        send_telegram_message(f"📥 Запит отримано: {data}")
+        send_telegram_message(f"📥 Запит отримано: {redact(data)}", TG_DEBUG)
 
         if not data or data.get("password") != webhook_password:
             return {"error": "Unauthorized"}, 401
 
+        error = validate_signal(data)
+        if error:
+            return {"error": error}, 400
+
+        job, duplicate = submit_signal(data, received_at)
+        if duplicate:
+            # Повтор від TradingView: біржу не чіпаємо, віддаємо результат оригіналу
+            record_webhook(data, received_at, job["job_id"], "duplicate", 200, job.get("result"))
+            send_telegram_message(f"🔁 Дублікат сигналу {job['symbol']} {job['side']} — job {job['job_id']}", TG_INFO)
+            return {
+                "success": True,
+                "duplicate": True,
+                "job_id": job["job_id"],
+                "status": job["status"],
+                "http_status": job.get("http_status"),
+                "result": job.get("result")
+            }, 200
+        return {"success": True, "job_id": job["job_id"], "status": job["status"]}, 202
+
+    except Exception as e:
+        send_telegram_message(f"🔥 Webhook error: {e}", TG_ERROR)
+        return {"error": str(e)}, 500
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics():
+    set_gauge("parsibot_telegram_queue_size", _telegram_queue.qsize())
+    set_gauge("parsibot_telegram_dropped", telegram_dropped)
+    set_gauge("parsibot_sheets_pending_rows", len(_sheets_buffer))
+    try:
+        refresh_open_trades()  # фоловер сам не пише в реєстр — підтягуємо зміни лідера й інших воркерів
+    except Exception as e:
+        print(f"⚠️ open trades refresh error: {e}")
+    set_gauge("parsibot_open_trades", len(_open_trades))
+    with _jobs_lock:
+        set_gauge("parsibot_jobs_pending", sum(len(q) for q in _symbol_queues.values()))
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job(job_id) or find_signal_job(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    return public_job(job), 200
+
+
+def execute_signal(data, received=None):
+    received = received or time.monotonic()
+    try:
         # Основні параметри
         side = data.get("side")
         symbol = data.get("symbol", default_symbol)
         sl_price = float(data.get("sl"))
 
-        qty = calculate_dynamic_qty(symbol, sl_price, side)
+        with timed("parsibot_stage_seconds", stage="size", symbol=symbol):
+            qty = calculate_dynamic_qty(symbol, sl_price, side)
 
         if qty <= 0:
-            send_telegram_message("❌ Qty <= 0 — сигнал ігнорується.")
+            send_telegram_message("❌ Qty <= 0 — сигнал ігнорується.", TG_ERROR)
             return {"error": "Invalid qty"}, 400
 
+        max_slippage = float(data.get("max_slippage_pct", MAX_SLIPPAGE_PCT))
+        if _fresh_book(symbol) is not None:
+            expected_price, slippage = expected_slippage(symbol, side, qty)
+            if slippage is None or slippage > max_slippage:
+                inc("parsibot_slippage_rejected_total", symbol=symbol)
+                reason = "глибини стакану не вистачає" if slippage is None else f"очікуване прослизання {slippage:.4%}"
+                send_telegram_message(f"🚫 {symbol} {side} {qty}: {reason} (ліміт {max_slippage:.4%}) — сигнал відхилено.", TG_WARNING)
+                return {"error": "Slippage too high", "expected_price": expected_price, "expected_slippage": slippage}, 400
+            set_gauge("parsibot_expected_slippage_ratio", slippage, symbol=symbol)
+
         entry_price = get_market_price(symbol)  # можна залишити для логів або TP/SL
         tp = float(data.get("tp"))
         sl = float(data.get("sl"))
@@ -706,54 +2551,71 @@ def webhook():
         strategy_tag = data.get("strategy_tag", "tv_default")
         order_link_id = data.get("order_link_id", "")
         signal_source = data.get("signal_source", "TradingView")
+        protection_mode = str(data.get("protection_mode", PROTECTION_MODE)).lower()
 
 
         # Закриваємо відкриті ордери
-        cancel_all_close_orders(symbol)
+        with timed("parsibot_stage_seconds", stage="cancel", symbol=symbol):
+            cancel_all_close_orders(symbol)
 
         # Поточна ціна та маркет-ордер
         entry_price = get_price(symbol)
-        market_result = create_market_order(symbol, side, qty)
+        actual_sl = sl
+        fallback_tp_set = False
+        tpsl = None
+        execution = None
+        if protection_mode == "attached":
+            if entry_price is None:
+                send_telegram_message("❌ Не вдалося отримати ціну для TP/SL.", TG_ERROR)
+                return {"error": "No price"}, 400
+            tpsl, tp, actual_sl, fallback_tp_set = build_attached_tpsl(symbol, side, tp, sl, entry_price)
+
+        # Нижня межа часу відкриття на годиннику біржі — якщо execTime заповнення не прийде
+        order_sent_ms = int(bybit_timestamp())
+        with timed("parsibot_stage_seconds", stage="market_order", symbol=symbol):
+            market_result = create_market_order(symbol, side, qty, order_link_id, tpsl)
 
         if not market_result or market_result.get("retCode") != 0:
-            send_telegram_message(f"❌ Market ордер не створено: {market_result}")
+            send_telegram_message(f"❌ Market ордер не створено: {market_result}", TG_ERROR)
             return {"error": "Market order failed"}, 400
 
         # Завжди використовуємо реальний orderId з Bybit
         order_id = market_result["result"].get("orderId", "")
-        order_link_id = order_link_id or ""  # можеш зберігати окремо, якщо хочеш
-
 
-        # SL перевірка
-        price = get_price(symbol)
-        actual_sl = sl
-        if not is_sl_valid(sl, price):
-            actual_sl = round(price * (1 - MAX_SL_DISTANCE_PERC), 2) if side == "Buy" else round(price * (1 + MAX_SL_DISTANCE_PERC), 2)
-
-        # Створення TP
-        tp_result = create_take_profit_order(symbol, side, qty, tp)
+        if protection_mode == "attached":
+            # TP/SL вже на позиції — лишається тільки trailing одним trading-stop
+            trailing_result = None
+            if use_trailing:
+                with timed("parsibot_stage_seconds", stage="protect", symbol=symbol):
+                    trailing_result = create_trailing_stop(symbol, side, callback)
+        else:
+            if entry_price is None:
+                # Ціни до ордера не було (breaker відкритий) — TP/SL рахуємо від avgPrice заповнення
+                with timed("parsibot_stage_seconds", stage="fill_wait", symbol=symbol):
+                    execution = wait_for_fill(order_id, symbol)
+                entry_price = execution["entry_price"]
+
+            # Створення TP + SL (batch) і trailing паралельно; SL, задалекий від ціни, підтягується там же
+            with timed("parsibot_stage_seconds", stage="protect", symbol=symbol):
+                protection = place_protective_orders(symbol, side, qty, tp, sl, use_trailing, callback, entry_price)
+            tp_result = protection["tp"]
+            trailing_result = protection["trailing"]
+            actual_sl = protection["sl_price"]
+
+            if tp_result is None and entry_price is not None:
+                fallback_tp_set = True
+                fallback_tp = normalize_price(symbol, fallback_tp_price(entry_price, side))
+                with timed("parsibot_stage_seconds", stage="fallback_tp", symbol=symbol):
+                    tp_result = create_take_profit_order(symbol, side, qty, fallback_tp)
+                tp = fallback_tp
+                send_telegram_message(f"⚠️ TP не створено — fallback TP виставлено @ {tp}", TG_WARNING)
 
-        fallback_tp_pct = 0.02
-        fallback_tp_set = False
-        if tp_result is None:
-            fallback_tp_set = True
-            fallback_tp = round(entry_price * (1 + fallback_tp_pct), 2) if side == "Buy" else round(entry_price * (1 - fallback_tp_pct), 2)
-            tp_result = create_take_profit_order(symbol, side, qty, fallback_tp)
-            tp = fallback_tp
-            send_telegram_message(f"⚠️ TP не створено — fallback TP виставлено @ {tp}")
-
-        # Створення SL
-        sl_result = create_stop_loss_order(symbol, side, qty, actual_sl)
-
-        # Trailing Stop
-        trailing_result = None
         if use_trailing:
-            trailing_result = create_trailing_stop(symbol, side, callback)
             if debug_responses and trailing_result:
-                send_telegram_message(f"🧾 Trailing SL Order:\n{json.dumps(trailing_result, indent=2)}")
+                send_telegram_message(f"🧾 Trailing SL Order:\n{json.dumps(trailing_result, indent=2)}", TG_DEBUG)
 
         if debug_responses:
-            send_telegram_message(f"🧾 Market Order:\n{json.dumps(market_result, indent=2)}")
+            send_telegram_message(f"🧾 Market Order:\n{json.dumps(market_result, indent=2)}", TG_DEBUG)
 
         send_telegram_message(f"✅ Ордер виконано. Пара: {symbol}, Сторона: {side}, TP: {tp}, SL: {actual_sl}")
 
@@ -775,200 +2637,1003 @@ def webhook():
             "tp_hit": None,
             "sl_hit": None,
             "runtime_sec": None,
-            "sl_auto_adjusted": not is_sl_valid(sl, entry_price),
+            "sl_auto_adjusted": actual_sl != sl,
             "tp_rejected": fallback_tp_set,
             "drawdown_pct": None,
-            "risk_reward": round(abs(tp - entry_price) / abs(sl - entry_price), 2) if tp and sl else None,
+            "risk_reward": None,
             "strategy_tag": strategy_tag,
             "signal_source": signal_source
         }
-        import time
-        time.sleep(1.5)
-
-        # 🔍 Оновлення статусу через check_order_execution
-        execution = check_order_execution(order_id, symbol)
+        # 🔍 Чекаємо реального заповнення з приватного стріму (з таймаутом)
+        if execution is None:
+            with timed("parsibot_stage_seconds", stage="fill_wait", symbol=symbol):
+                execution = wait_for_fill(order_id, symbol)
+        if execution["filled"]:
+            observe("parsibot_signal_to_fill_seconds", time.monotonic() - received, symbol=symbol)
         entry["entry_price"] = execution["entry_price"] or entry["entry_price"]
+        if tp and sl and entry["entry_price"] and sl != entry["entry_price"]:
+            entry["risk_reward"] = round(abs(tp - entry["entry_price"]) / abs(sl - entry["entry_price"]), 2)
         entry["timestamp"] = execution["entry_time"] or entry["timestamp"]
         entry["result"] = "filled" if execution["filled"] else "pending"
         print("📍 Execution check result:", execution)
-        send_telegram_message(f"📍 Execution result:\n{json.dumps(execution, indent=2)}")
+        send_telegram_message(f"📍 Execution result:\n{json.dumps(execution, indent=2)}", TG_DEBUG)
 
 
 
         # Запис у лог
-        log_trade_to_csv(entry)
-        log_trade_to_sheets(entry)
+        with timed("parsibot_stage_seconds", stage="store", symbol=symbol):
+            log_trade_to_csv(entry)
+            log_trade_to_sheets(entry)
 
         # Зберігаємо трейд
-        save_open_trade({
-            "symbol": symbol,
-            "order_id": order_id,
-            "entry_price": entry_price,
-            "side": side,
-            "qty": qty,
-            "tp": tp,
-            "sl": actual_sl
-        })
-
-        return {"success": True}, 200
+        with timed("parsibot_stage_seconds", stage="open_trade", symbol=symbol):
+            save_open_trade({
+                "timestamp": entry["timestamp"],
+                "opened_ms": execution.get("entry_time_ms") or order_sent_ms,
+                "symbol": symbol,
+                "order_id": order_id,
+                "entry_price": entry["entry_price"],
+                "side": side,
+                "qty": qty,
+                "tp": tp,
+                "sl": actual_sl,
+                "strategy_tag": strategy_tag
+            })
+
+        return {"success": True, "order_id": order_id}, 200
 
     except Exception as e:
-        send_telegram_message(f"🔥 Webhook error: {e}")
+        send_telegram_message(f"🔥 Webhook error: {e}", TG_ERROR)
         return {"error": str(e)}, 500
 
 
 
 
         
-@app.route("/export-today-csv", methods=["GET"])
-def export_today_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
+# 📤 Потоковий експорт: фільтри from/to/symbol/strategy_tag по індексах,
+# рядки віддаються генератором (опційно gzip), ETag/Last-Modified для дешевих повторних запитів
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EXPORT_CHUNK_ROWS = 500
+
 
+def _parse_time_param(value):
+    if not value:
+        return None
+    if value.replace(".", "", 1).isdigit():
+        ts = float(value)
+        if ts > 1e11:  # мілісекунди
+            ts /= 1000
+        return datetime.utcfromtimestamp(ts).strftime(TIMESTAMP_FORMAT)
+    for fmt in (TIMESTAMP_FORMAT, "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).strftime(TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid time: {value}")
+
+
+def _iter_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(TRADE_FIELDS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def _iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = gzip-обгортка
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_trades_response(filename, window_start=None, **filters):
+    """window_start — unix-час, з якого рухоме вікно віддає інший набір рядків (для Last-Modified)."""
+    max_id, max_updated = trades_version()
+    etag = hashlib.sha1(json.dumps([max_id, max_updated, sorted((k, v) for k, v in filters.items() if v)]).encode()).hexdigest()[:20]
+    changed = max(max_updated or 0, window_start or 0)
+    last_modified = int(changed) if changed else None
+    use_gzip = request.args.get("gzip") in ("1", "true") or (
+        request.args.get("gzip") is None and "gzip" in request.headers.get("Accept-Encoding", "")
+    )
+    if use_gzip:
+        etag += "-gz"
+
+    # ⚡ Нічого не змінилось — 304 без жодного запиту по даних
+    if request.if_none_match.contains(etag) or (
+        not request.if_none_match and last_modified and request.if_modified_since
+        and request.if_modified_since.timestamp() >= last_modified
+    ):
+        response = Response(status=304)
+    else:
+        chunks = _iter_csv(query_trades(**filters))
+        response = Response(_iter_gzip(chunks) if use_gzip else chunks, mimetype="text/csv")
+        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+
+    response.set_etag(etag)
+    if last_modified:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@bp.route("/export", methods=["GET"])
+def export_trades():
     try:
-        with open(CSV_LOG_PATH, mode="r", encoding="utf-8") as csvfile:
-            reader = csv.DictReader(csvfile)
-            writer.writerow(reader.fieldnames)
-            for row in reader:
-                try:
-                    ts = datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S")
-                    if (datetime.utcnow() - ts).total_seconds() <= 86400:
-                        writer.writerow([row[field] for field in reader.fieldnames])
-                except Exception as parse_error:
-                    continue  # Пропускаємо рядки з некоректним timestamp
+        filters = {
+            "since": _parse_time_param(request.args.get("from")),
+            "until": _parse_time_param(request.args.get("to")),
+            "symbol": request.args.get("symbol"),
+            "strategy_tag": request.args.get("strategy_tag")
+        }
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    try:
+        return export_trades_response("trades.csv", **filters)
     except Exception as e:
         return {"error": f"CSV export error: {e}"}, 500
 
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode()),
-        mimetype="text/csv",
-        as_attachment=True,
-        download_name=f"trades_last_24h.csv"
-    )
 
-# ✅ Додано автоматичний трекер відкритих трейдів
+EXPORT_WINDOW_BUCKET_SEC = int(os.environ.get("export_window_bucket_sec", 300))
 
-import threading
-import json
 
-OPEN_TRADES_PATH = "open_trades.json"
+@bp.route("/export-today-csv", methods=["GET"])
+def export_today_csv():
+    try:
+        # Початок вікна округлено до кошика: ETag стабільний між опитуваннями дашборда, тож повтор — 304
+        now = int(time.time())
+        window_start = now - now % EXPORT_WINDOW_BUCKET_SEC
+        since = datetime.utcfromtimestamp(window_start - 86400).strftime(TIMESTAMP_FORMAT)
+        return export_trades_response("trades_last_24h.csv", window_start=window_start, since=since)
+    except Exception as e:
+        return {"error": f"CSV export error: {e}"}, 500
+
+# 📊 Аналітика угод: win rate, expectancy, profit factor, max drawdown, runtime, причини виходу.
+# Агрегати для кожного рівня групування (symbol×strategy_tag, symbol, strategy_tag, усе) тримаються
+# в пам'яті й оновлюються при закритті угоди — /stats не читає історію. Повний перерахунок —
+# NumPy по колонках із SQLite (при старті, зміні лідера, фільтрі за часом або ?recompute=1).
+
+STATS_GROUPINGS = {
+    "symbol,strategy_tag": (True, True),
+    "symbol": (True, False),
+    "strategy_tag": (False, True),
+    "none": (False, False),
+}
+STATS_ALL = "*"
+
+_stats = None           # (symbol | "*", strategy_tag | "*") -> агрегат
+_stats_version = None   # trades_version() на момент останнього перерахунку
+_stats_lock = threading.Lock()
+
+
+def _empty_aggregate():
+    return {
+        "trades": 0, "wins": 0, "losses": 0,
+        "gross_profit": 0.0, "gross_loss": 0.0, "pnl": 0.0,
+        "runtime_sum": 0.0, "runtime_n": 0,
+        "equity": 0.0, "peak": 0.0, "max_drawdown": 0.0,
+        "exit_reasons": {}
+    }
+
+
+def _stats_keys(symbol, strategy_tag):
+    return [(symbol if by_symbol else STATS_ALL, strategy_tag if by_tag else STATS_ALL)
+            for by_symbol, by_tag in STATS_GROUPINGS.values()]
+
+
+def _add_to_aggregate(agg, pnl, runtime_sec, exit_reason):
+    agg["trades"] += 1
+    if pnl > 0:
+        agg["wins"] += 1
+        agg["gross_profit"] += pnl
+    elif pnl < 0:
+        agg["losses"] += 1
+        agg["gross_loss"] -= pnl
+    agg["pnl"] += pnl
+    if runtime_sec is not None:
+        agg["runtime_sum"] += runtime_sec
+        agg["runtime_n"] += 1
+    agg["equity"] += pnl
+    agg["peak"] = max(agg["peak"], agg["equity"])
+    agg["max_drawdown"] = max(agg["max_drawdown"], agg["peak"] - agg["equity"])
+    reason = exit_reason or "unknown"
+    agg["exit_reasons"][reason] = agg["exit_reasons"].get(reason, 0) + 1
+
+
+def _summarize_aggregate(agg):
+    trades = agg["trades"]
+    return {
+        "trades": trades,
+        "wins": agg["wins"],
+        "losses": agg["losses"],
+        "win_rate": round(agg["wins"] / trades, 4) if trades else None,
+        "expectancy": round(agg["pnl"] / trades, 4) if trades else None,
+        "profit_factor": round(agg["gross_profit"] / agg["gross_loss"], 4) if agg["gross_loss"] else None,
+        "total_pnl": round(agg["pnl"], 4),
+        "max_drawdown": round(agg["max_drawdown"], 4),
+        "avg_runtime_sec": round(agg["runtime_sum"] / agg["runtime_n"], 1) if agg["runtime_n"] else None,
+        "exit_reasons": dict(agg["exit_reasons"])
+    }
+
+
+def _closed_trade_columns(since=None, until=None):
+    import numpy as np
+
+    clauses, params = ["pnl IS NOT NULL"], []
+    if since:
+        clauses.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        clauses.append("timestamp < ?")
+        params.append(until)
+    # Порядок закриття (updated_at) — для кривої equity і drawdown
+    rows = get_trades_db().execute(
+        f"SELECT symbol, COALESCE(strategy_tag, 'tv_default'), pnl, runtime_sec, COALESCE(exit_reason, 'unknown') "
+        f"FROM trades WHERE {' AND '.join(clauses)} ORDER BY updated_at, id", params
+    ).fetchall()
+    if not rows:
+        return None
+    symbols, tags, pnl, runtime, reasons = zip(*rows)
+    return {
+        "symbol": np.array(symbols, dtype=object),
+        "strategy_tag": np.array(tags, dtype=object),
+        "pnl": np.array([float(v) if isinstance(v, (int, float)) else np.nan for v in pnl], dtype=np.float64),
+        "runtime": np.array([float(v) if isinstance(v, (int, float)) else np.nan for v in runtime], dtype=np.float64),
+        "exit_reason": np.array(reasons, dtype=object)
+    }
+
+
+def compute_stats(since=None, until=None):
+    """Повний векторизований перерахунок агрегатів (усі рівні групування)."""
+    import numpy as np
+
+    aggregates = {}
+    cols = _closed_trade_columns(since, until)
+    if cols is None:
+        return aggregates
+    valid = ~np.isnan(cols["pnl"])
+    cols = {name: column[valid] for name, column in cols.items()}
+    pnl, runtime = cols["pnl"], cols["runtime"]
+    has_runtime = ~np.isnan(runtime)
+    runtime = np.where(has_runtime, runtime, 0.0)
+
+    for by_symbol, by_tag in STATS_GROUPINGS.values():
+        sym = cols["symbol"] if by_symbol else np.full(len(pnl), STATS_ALL, dtype=object)
+        tag = cols["strategy_tag"] if by_tag else np.full(len(pnl), STATS_ALL, dtype=object)
+        keys, inverse = np.unique(np.char.add(np.char.add(sym.astype(str), "\x1f"), tag.astype(str)), return_inverse=True)
+        n = len(keys)
+
+        trades = np.bincount(inverse, minlength=n)
+        wins = np.bincount(inverse, weights=pnl > 0, minlength=n)
+        losses = np.bincount(inverse, weights=pnl < 0, minlength=n)
+        gross_profit = np.bincount(inverse, weights=np.where(pnl > 0, pnl, 0.0), minlength=n)
+        gross_loss = np.bincount(inverse, weights=np.where(pnl < 0, -pnl, 0.0), minlength=n)
+        total = np.bincount(inverse, weights=pnl, minlength=n)
+        runtime_sum = np.bincount(inverse, weights=runtime, minlength=n)
+        runtime_n = np.bincount(inverse, weights=has_runtime, minlength=n)
+
+        # Equity і drawdown у межах групи: стабільне сортування зберігає порядок закриття
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.concatenate(([0], np.cumsum(trades)))
+        reason_keys, reason_counts = np.unique(
+            np.char.add(np.char.add(inverse.astype(str), "\x1f"), cols["exit_reason"].astype(str)), return_counts=True
+        )
+
+        for g, key in enumerate(keys):
+            equity = np.cumsum(pnl[order[bounds[g]:bounds[g + 1]]])
+            peak = np.maximum.accumulate(np.maximum(equity, 0.0))
+            symbol_key, tag_key = key.split("\x1f", 1)
+            aggregates[(symbol_key, tag_key)] = {
+                "trades": int(trades[g]), "wins": int(wins[g]), "losses": int(losses[g]),
+                "gross_profit": float(gross_profit[g]), "gross_loss": float(gross_loss[g]), "pnl": float(total[g]),
+                "runtime_sum": float(runtime_sum[g]), "runtime_n": int(runtime_n[g]),
+                "equity": float(equity[-1]), "peak": float(peak[-1]),
+                "max_drawdown": float((peak - equity).max()),
+                "exit_reasons": {}
+            }
+        for reason_key, count in zip(reason_keys, reason_counts):
+            g, reason = reason_key.split("\x1f", 1)
+            symbol_key, tag_key = keys[int(g)].split("\x1f", 1)
+            aggregates[(symbol_key, tag_key)]["exit_reasons"][reason] = int(count)
+    return aggregates
+
+
+def rebuild_stats():
+    global _stats, _stats_version
+    version = trades_version()
+    aggregates = compute_stats()
+    with _stats_lock:
+        _stats = aggregates
+        _stats_version = version
+    return aggregates
+
+
+def record_closed_trade(symbol, strategy_tag, pnl, runtime_sec, exit_reason):
+    """O(1)-оновлення агрегатів лідером при закритті угоди."""
+    global _stats_version
+    with _stats_lock:
+        if _stats is None:
+            return  # ще не перераховано — угода потрапить у повний перерахунок
+        for key in _stats_keys(symbol, strategy_tag or "tv_default"):
+            _add_to_aggregate(_stats.setdefault(key, _empty_aggregate()), float(pnl), runtime_sec, exit_reason)
+        _stats_version = trades_version()
+
+
+def get_stats(group_by="symbol,strategy_tag", symbol=None, strategy_tag=None, since=None, until=None, recompute=False):
+    if since or until:
+        aggregates = compute_stats(since, until)
+    else:
+        # Лідер веде агрегати сам; інші воркери перераховують, лише якщо сховище змінилось
+        if recompute or _stats is None or (not is_leader() and trades_version() != _stats_version):
+            rebuild_stats()
+        with _stats_lock:
+            aggregates = {key: dict(agg, exit_reasons=dict(agg["exit_reasons"])) for key, agg in _stats.items()}
+
+    # Фільтр по виміру, за яким не групуємо, — це той самий рівень агрегатів з конкретним ключем
+    by_symbol, by_tag = STATS_GROUPINGS[group_by]
+    by_symbol, by_tag = by_symbol or bool(symbol), by_tag or bool(strategy_tag)
+    groups = []
+    for (symbol_key, tag_key), agg in sorted(aggregates.items()):
+        if (symbol_key != STATS_ALL) != by_symbol or (tag_key != STATS_ALL) != by_tag:
+            continue
+        if symbol and symbol_key != symbol or strategy_tag and tag_key != strategy_tag:
+            continue
+        group = {}
+        if by_symbol:
+            group["symbol"] = symbol_key
+        if by_tag:
+            group["strategy_tag"] = tag_key
+        group.update(_summarize_aggregate(agg))
+        groups.append(group)
+
+    # Загальний підсумок — агрегат саме відфільтрованої множини угод (з її власною кривою drawdown)
+    total = aggregates.get((symbol or STATS_ALL, strategy_tag or STATS_ALL))
+    return {
+        "group_by": group_by,
+        "groups": groups,
+        "total": _summarize_aggregate(total or _empty_aggregate())
+    }
+
+
+@bp.route("/stats", methods=["GET"])
+def stats():
+    group_by = request.args.get("group_by", "symbol,strategy_tag")
+    if group_by not in STATS_GROUPINGS:
+        return {"error": f"group_by має бути одним із: {', '.join(STATS_GROUPINGS)}"}, 400
+    try:
+        since = _parse_time_param(request.args.get("from"))
+        until = _parse_time_param(request.args.get("to"))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    try:
+        return get_stats(
+            group_by,
+            symbol=request.args.get("symbol"),
+            strategy_tag=request.args.get("strategy_tag"),
+            since=since,
+            until=until,
+            recompute=request.args.get("recompute") in ("1", "true")
+        ), 200
+    except Exception as e:
+        return {"error": f"Stats error: {e}"}, 500
+
+# ✅ Додано автоматичний трекер відкритих трейдів
+
+OPEN_TRADES_PATH = os.path.join(DATA_DIR, "open_trades.json")            # компактний snapshot
+OPEN_TRADES_JOURNAL_PATH = os.path.join(DATA_DIR, "open_trades.journal")  # append-only журнал змін
+JOURNAL_COMPACT_EVERY = 500
+JOURNAL_COMPACT_SEC = 300
+
+# 🧾 Реєстр відкритих трейдів: живе в пам'яті під локом, зміни — дрібні append у журнал,
+# періодично журнал згортається в snapshot. При старті: snapshot + replay журналу.
+
+_open_trades = {}  # order_id -> trade
+_open_trades_lock = threading.RLock()
+_open_trades_loaded = False
+_open_trades_seen = None     # сигнатура файлів, до якої реєстр у пам'яті вже дочитано
+_open_trades_version = 0     # росте з кожною зміною реєстру — трекер так бачить, що треба синхронізуватись
+_journal_position = (None, None, 0)  # (snapshot stat, inode журналу, offset дочитаного)
+_journal_entries = 0
+_journal_compacted_at = time.monotonic()
+
+
+def _apply_journal_record(trades, record):
+    op = record.get("op")
+    if op == "add":
+        trades[record["trade"]["order_id"]] = record["trade"]
+    elif op == "remove":
+        trades.pop(record["order_id"], None)
+    elif op == "update" and record["order_id"] in trades:
+        trades[record["order_id"]].update(record["fields"])
+
+
+def _open_trades_signature():
+    signature = []
+    for path in (OPEN_TRADES_PATH, OPEN_TRADES_JOURNAL_PATH):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def load_open_trades():
+    global _open_trades_seen
+    with _open_trades_lock, file_lock(OPEN_TRADES_JOURNAL_PATH):
+        _open_trades_seen = _open_trades_signature()
+        _load_open_trades_unlocked()
+
+
+def _load_open_trades_unlocked():
+    global _open_trades_loaded, _open_trades_version, _journal_entries, _journal_position
+    trades = {}
+    snapshot = _open_trades_signature()[0]
+    if snapshot is not None:
+        with open(OPEN_TRADES_PATH, "r", encoding="utf-8") as f:
+            for trade in json.load(f):
+                trades[trade["order_id"]] = trade
+
+    _open_trades.clear()
+    _open_trades.update(trades)
+    _journal_position = (snapshot, None, 0)
+    _journal_entries = 0
+    _read_journal_tail()
+    _open_trades_version += 1
+    _open_trades_loaded = True
+
+
+def _read_journal_tail():
+    """Застосовує лише нові рядки журналу. Під _open_trades_lock + file_lock.
+    Після компакції іншим воркером (новий snapshot / обрізаний журнал) — повне перечитування."""
+    global _open_trades_version, _journal_entries, _journal_position
+    snapshot, inode, offset = _journal_position
+    try:
+        st = os.stat(OPEN_TRADES_JOURNAL_PATH)
+    except FileNotFoundError:
+        st = None
+    if snapshot != _open_trades_signature()[0] or (
+        st is None and offset or st is not None and (inode not in (None, st.st_ino) or st.st_size < offset)
+    ):
+        _load_open_trades_unlocked()
+        return True
+    if st is None or st.st_size == offset:
+        return False
+
+    changed = False
+    with open(OPEN_TRADES_JOURNAL_PATH, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # недописаний рядок — дочитаємо наступного разу
+            offset += len(line)
+            try:
+                _apply_journal_record(_open_trades, json.loads(line))
+                _journal_entries += 1
+                changed = True
+            except (ValueError, KeyError):
+                continue  # обірваний запис після краху — пропускаємо
+    _journal_position = (snapshot, st.st_ino, offset)
+    if changed:
+        _open_trades_version += 1
+    return changed
+
+
+def refresh_open_trades():
+    """Дочитує зміни інших воркерів, якщо файли змінились. True — реєстр у пам'яті оновився."""
+    global _open_trades_seen
+    if _open_trades_loaded and _open_trades_signature() == _open_trades_seen:
+        return False
+    with _open_trades_lock, file_lock(OPEN_TRADES_JOURNAL_PATH):
+        _open_trades_seen = _open_trades_signature()
+        if not _open_trades_loaded:
+            _load_open_trades_unlocked()
+            return True
+        return _read_journal_tail()
+
+
+def _ensure_open_trades_loaded():
+    refresh_open_trades()
+
+
+def _append_journal(record):
+    """Дочитує чужі записи, застосовує record до реєстру і дописує його в журнал. Під _open_trades_lock."""
+    global _open_trades_version, _journal_entries, _journal_position
+    line = (json.dumps(record, separators=(',', ':'), ensure_ascii=False) + "\n").encode("utf-8")
+    with file_lock(OPEN_TRADES_JOURNAL_PATH):
+        _read_journal_tail()
+        _apply_journal_record(_open_trades, record)
+        with open(OPEN_TRADES_JOURNAL_PATH, "ab") as f:
+            f.write(line)
+            f.flush()
+            inode = os.fstat(f.fileno()).st_ino
+        snapshot, _, offset = _journal_position
+        _journal_position = (snapshot, inode, offset + len(line))
+    _journal_entries += 1
+    _open_trades_version += 1
+
+
+def compact_open_trades():
+    global _journal_entries, _journal_compacted_at, _journal_position, _open_trades_seen
+    with _open_trades_lock, file_lock(OPEN_TRADES_JOURNAL_PATH):
+        # Дочитуємо журнал: його могли доповнити інші воркери
+        _read_journal_tail()
+        tmp_path = f"{OPEN_TRADES_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(_open_trades.values()), f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, OPEN_TRADES_PATH)
+        # Журнал обрізаємо лише після атомарної заміни snapshot
+        open(OPEN_TRADES_JOURNAL_PATH, "w", encoding="utf-8").close()
+        _open_trades_seen = _open_trades_signature()
+        _journal_position = (_open_trades_seen[0], _open_trades_seen[1][0], 0)
+        _journal_entries = 0
+        _journal_compacted_at = time.monotonic()
+
+
+def maybe_compact_open_trades():
+    if _journal_entries >= JOURNAL_COMPACT_EVERY or (
+        _journal_entries and time.monotonic() - _journal_compacted_at >= JOURNAL_COMPACT_SEC
+    ):
+        compact_open_trades()
 
-# 🧾 Зберігати трейд у окремий JSON-файл
 
 def save_open_trade(entry):
     try:
-        if os.path.exists(OPEN_TRADES_PATH):
-            with open(OPEN_TRADES_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        else:
-            data = []
-        data.append(entry)
-        with open(OPEN_TRADES_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        entry.setdefault("timestamp", datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+        with _open_trades_lock:
+            _ensure_open_trades_loaded()
+            _append_journal({"op": "add", "trade": entry})
+        wake_tracker()
     except Exception as e:
-        print(f"❌ open_trades.json save error: {e}")
+        print(f"❌ open trades save error: {e}")
+
 
-# 🔁 Оновити trades.csv
+def remove_open_trade(order_id):
+    try:
+        with _open_trades_lock:
+            _ensure_open_trades_loaded()
+            if order_id in _open_trades:
+                _append_journal({"op": "remove", "order_id": order_id})
+    except Exception as e:
+        print(f"❌ open trades remove error: {e}")
+
+
+def get_open_trades():
+    with _open_trades_lock:
+        _ensure_open_trades_loaded()
+        return [dict(trade) for trade in _open_trades.values()]
+
+# 🔁 Оновити угоду в сховищі (constant-time UPDATE по індексу order_id)
 
 def update_csv_trade(order_id, updates):
     try:
-        rows = []
-        updated = False
-        with open(CSV_LOG_PATH, mode="r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            fieldnames = reader.fieldnames
-            for row in reader:
-                if row["order_id"] == order_id:
-                    row.update(updates)
-                    updated = True
-                rows.append(row)
-        if updated:
-            with open(CSV_LOG_PATH, mode="w", newline="", encoding="utf-8") as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(rows)
-            print(f"✅ CSV оновлено для {order_id}: {updates}")
+        if update_trade(order_id, updates):
+            print(f"✅ Trade оновлено для {order_id}: {updates}")
     except Exception as e:
-        print(f"❌ CSV update error: {e}")
+        print(f"❌ Trade update error: {e}")
 
 # 🔁 Background-перевірка відкритих трейдів
 
-def track_open_trades():
-    while True:
+def _trade_opened_ms(trade):
+    """Час відкриття угоди на годиннику біржі (мс) — у ньому ж createdTime записів closed-pnl."""
+    if trade.get("opened_ms"):
+        return int(trade["opened_ms"])
+    if not trade.get("timestamp"):
+        return None
+    # Угоди без opened_ms (збережені до його появи): timestamp вважаємо локальним часом хоста
+    opened = datetime.strptime(trade["timestamp"], "%Y-%m-%d %H:%M:%S")
+    return int((opened - datetime(1970, 1, 1)).total_seconds() * 1000) + _server_time_offset_ms
+
+
+def reconcile_open_trades(trades):
+    # 🧺 Групуємо трейди за символом: вартість циклу ~ кількість символів.
+    # FIFO іде по всіх відкритих угодах символу, щоб обсяг не дістався не тій угоді
+    by_symbol = {}
+    for trade in get_open_trades():
+        by_symbol.setdefault(trade["symbol"], []).append(trade)
+    symbols = {trade["symbol"] for trade in trades}
+
+    closed = 0
+    now_ms = int(bybit_timestamp())
+    for symbol in symbols:
+        symbol_trades = by_symbol.get(symbol, [])
+        since_ms = min((_trade_opened_ms(t) or now_ms - CLOSED_PNL_WINDOW_MS for t in symbol_trades), default=now_ms)
         try:
-            if not os.path.exists(OPEN_TRADES_PATH):
-                time.sleep(30)
-                continue
+            records = fetch_closed_pnl(symbol, since_ms - 60000)
+        except Exception as e:
+            print(f"❌ closed-pnl error {symbol}: {e}")
+            continue
+
+        # Запит уже зроблено — закриваємо всі знайдені угоди символу, не лише ті, чий час настав
+        used = load_closed_pnl_used(symbol, since_ms - 60000, {t["order_id"] for t in symbol_trades})
+        matches = match_closed_trades(symbol_trades, records, used)
+        for trade in symbol_trades:
+            if trade["order_id"] in matches:
+                close_trade(trade, matches[trade["order_id"]])
+                closed += 1
+
+    prune_closed_pnl_cache({
+        symbol: min((_trade_opened_ms(t) or now_ms for t in symbol_trades), default=now_ms) - 60000
+        for symbol, symbol_trades in by_symbol.items()
+    })
+    return closed
+
+
+def close_trade(trade, status_info):
+    order_id = trade["order_id"]
+    symbol = trade["symbol"]
+    side = trade["side"]
+    entry_price = float(trade["entry_price"])
+    tp = float(trade["tp"])
+    sl = float(trade["sl"])
+
+    exit_price = status_info["exit_price"]
+    pnl = round(status_info["pnl"], 2)
+    order_type = status_info["order_type"]
+    runtime_sec = status_info["runtime_sec"]
+
+    # 🎯 Тип виходу: фактична ціна маркет-SL може бути гіршою за тригер, тож порівнюємо з напрямком
+    direction = 1 if side == "Buy" else -1
+    tolerance = entry_price * 1e-4
+    tp_hit = bool(tp) and (exit_price - tp) * direction >= -tolerance
+    sl_hit = bool(sl) and not tp_hit and (exit_price - sl) * direction <= tolerance
+    exit_reason = "tp_hit" if tp_hit else "sl_hit" if sl_hit else "manual_or_market"
+
+    # Спершу фіксуємо розподіл: наступний цикл не віддасть ті самі записи іншій угоді
+    save_closed_pnl_used(symbol, order_id, status_info.get("allocations") or [])
+    update_csv_trade(order_id, {
+        "exit_price": exit_price,
+        "exit_reason": exit_reason,
+        "tp_hit": tp_hit,
+        "sl_hit": sl_hit,
+        "runtime_sec": runtime_sec,
+        "pnl": pnl,
+        "order_type": order_type,
+        "result": "closed"
+    })
+    remove_open_trade(order_id)
+
+    strategy_tag = trade.get("strategy_tag")
+    if strategy_tag is None:
+        row = get_trades_db().execute("SELECT strategy_tag FROM trades WHERE order_id = ?", (order_id,)).fetchone()
+        strategy_tag = row[0] if row else None
+    record_closed_trade(symbol, strategy_tag, pnl, runtime_sec, exit_reason)
+
+    send_telegram_message(
+        f"✅ Trade closed: {symbol}\n"
+        f"🔁 {side} @ {entry_price} → {exit_price}\n"
+        f"💰 PnL: {pnl} | ⏱ {runtime_sec}s | 🎯 {exit_reason.upper()}"
+    )
 
-            with open(OPEN_TRADES_PATH, "r", encoding="utf-8") as f:
-                trades = json.load(f)
-
-            remaining = []
-
-            for trade in trades:
-                order_id = trade["order_id"]
-                symbol = trade["symbol"]
-                side = trade["side"]
-                entry_price = float(trade["entry_price"])
-                tp = float(trade["tp"])
-                sl = float(trade["sl"])
-                ts = datetime.strptime(trade["timestamp"], "%Y-%m-%d %H:%M:%S")
-                qty = float(trade["qty"])
-
-                # ⏱ Перевірка часу
-                runtime = (datetime.utcnow() - ts).total_seconds()
-                if runtime < 30:
-                    remaining.append(trade)
-                    continue
 
-                # ✅ Запит до Bybit API
-                status_info = check_order_status(order_id, symbol)
-                if not status_info or status_info["status"] != "Filled":
-                    remaining.append(trade)
-                    continue
+# ⏰ Адаптивний планувальник: купа (due, seq, order_id) замість повного проходу раз на 30 с.
+# Інтервал залежить від відстані кешованої ціни до TP/SL, тихі угоди перевіряються дедалі рідше,
+# а події стріму (закриваючий ордер виконано, ціна вийшла за найближчий TP/SL) будять трекер одразу.
+
+TRACK_MIN_SEC = float(os.environ.get("track_min_sec", 2))
+TRACK_MAX_SEC = float(os.environ.get("track_max_sec", 120))
+TRACK_SEC_PER_PCT = float(os.environ.get("track_sec_per_pct", 10))  # 1% до TP/SL -> перевірка раз на 10 с
+TRACK_FALLBACK_SEC = 30  # немає кешованої ціни або TP/SL
+TRACK_BACKOFF_MAX = 8
+TRACK_BATCH_WINDOW_SEC = 1.0  # угоди того ж символу, чий час майже настав, ідуть в той самий запит
+TRACK_RELOAD_SEC = 1.0
+
+_track_heap = []
+_track_seq = 0
+_track_due = {}        # order_id -> актуальний due (старі записи в купі ігноруються)
+_tracked = {}          # order_id -> trade
+_track_quiet = {}      # order_id -> перевірок поспіль без закриття
+_track_by_symbol = {}  # symbol -> {order_id}
+_track_bands = {}      # symbol -> (low, high): між найближчими TP/SL нічого не закривається
+_track_cond = threading.Condition()
+_track_wake_symbols = set()
+_track_dirty = False
+
+
+def cached_price(symbol):
+    # Лише кеш: стрім або останній REST-тікер, без мережі
+    ticker = _tickers.get(symbol) or _rest_tickers.get(symbol)
+    return ticker[0] if ticker else None
+
+
+def wake_tracker(symbol=None):
+    """symbol — перевірити його угоди зараз; None — у реєстрі з'явились нові угоди."""
+    global _track_dirty
+    with _track_cond:
+        if symbol is None:
+            _track_dirty = True
+        else:
+            _track_wake_symbols.add(symbol)
+            _track_bands.pop(symbol, None)
+        _track_cond.notify()
+
 
-                exit_price = status_info["exit_price"]
-                pnl = round(status_info["pnl"], 2)
-                order_type = status_info["order_type"]
-                runtime_sec = status_info["runtime_sec"]
-
-                # 🎯 Тип виходу
-                tp_hit = tp and abs(exit_price - tp) < 1e-4
-                sl_hit = sl and abs(exit_price - sl) < 1e-4
-                exit_reason = "tp_hit" if tp_hit else "sl_hit" if sl_hit else "manual_or_market"
-
-                update_csv_trade(order_id, {
-                    "exit_price": exit_price,
-                    "exit_reason": exit_reason,
-                    "tp_hit": tp_hit,
-                    "sl_hit": sl_hit,
-                    "runtime_sec": runtime_sec,
-                    "pnl": pnl,
-                    "order_type": order_type,
-                    "result": "closed"
-                })
-
-                send_telegram_message(
-                    f"✅ Trade closed: {symbol}\n"
-                    f"🔁 {side} @ {entry_price} → {exit_price}\n"
-                    f"💰 PnL: {pnl} | ⏱ {runtime_sec}s | 🎯 {exit_reason.upper()}"
-                )
-
-            with open(OPEN_TRADES_PATH, "w", encoding="utf-8") as f:
-                json.dump(remaining, f, indent=2)
+def _check_interval(trade, price, quiet):
+    levels = [float(trade[k]) for k in ("tp", "sl") if trade.get(k)]
+    if not price or not levels:
+        interval = TRACK_FALLBACK_SEC
+    else:
+        distance_pct = min(abs(price - level) for level in levels) / price * 100
+        interval = distance_pct * TRACK_SEC_PER_PCT
+    interval *= min(2 ** quiet, TRACK_BACKOFF_MAX)
+    return min(max(interval, TRACK_MIN_SEC), TRACK_MAX_SEC)
+
+
+def _schedule_trade(order_id, due):
+    global _track_seq
+    _track_seq += 1
+    _track_due[order_id] = due
+    heapq.heappush(_track_heap, (due, _track_seq, order_id))
+
+
+def _untrack_trade(order_id):
+    trade = _tracked.pop(order_id, None)
+    _track_due.pop(order_id, None)
+    _track_quiet.pop(order_id, None)
+    if trade is not None:
+        ids = _track_by_symbol.get(trade["symbol"])
+        if ids is not None:
+            ids.discard(order_id)
+            if not ids:
+                del _track_by_symbol[trade["symbol"]]
+                _track_bands.pop(trade["symbol"], None)
+
+
+def _update_band(symbol):
+    price = cached_price(symbol)
+    if not price:
+        _track_bands.pop(symbol, None)
+        return
+    low, high = 0.0, float("inf")
+    for order_id in _track_by_symbol.get(symbol, ()):
+        trade = _tracked[order_id]
+        for level in (trade.get("tp"), trade.get("sl")):
+            if not level:
+                continue
+            level = float(level)
+            if level <= price:
+                low = max(low, level)
+            else:
+                high = min(high, level)
+    _track_bands[symbol] = (low, high)
+
+
+def _sync_tracked_trades(now):
+    trades = {trade["order_id"]: trade for trade in get_open_trades()}
+    for order_id in [oid for oid in _tracked if oid not in trades]:
+        _untrack_trade(order_id)
+    touched = set()
+    for order_id, trade in trades.items():
+        if order_id in _tracked:
+            _tracked[order_id] = trade
+            continue
+        _tracked[order_id] = trade
+        _track_by_symbol.setdefault(trade["symbol"], set()).add(order_id)
+        # Нова угода не закриється, поки ціна не дійде до TP/SL — перша перевірка теж за відстанню
+        _schedule_trade(order_id, now + _check_interval(trade, cached_price(trade["symbol"]), 0))
+        touched.add(trade["symbol"])
+    for symbol in touched:
+        _update_band(symbol)
+    set_gauge("parsibot_tracked_trades", len(_tracked))
+
+
+def _pop_due_trades(now):
+    due = []
+    while _track_heap and _track_heap[0][0] <= now:
+        when, _, order_id = heapq.heappop(_track_heap)
+        if _track_due.get(order_id) == when:
+            del _track_due[order_id]
+            due.append(order_id)
+    # 🧺 Запит order/history йде на символ — підхоплюємо угоди цих символів, яким скоро в чергу
+    symbols = {_tracked[order_id]["symbol"] for order_id in due}
+    for symbol in symbols:
+        for order_id in _track_by_symbol.get(symbol, ()):
+            when = _track_due.get(order_id)
+            if when is not None and when <= now + TRACK_BATCH_WINDOW_SEC:
+                del _track_due[order_id]
+                due.append(order_id)
+    if len(_track_heap) > 2 * len(_track_due) + 64:
+        _track_heap[:] = [entry for entry in _track_heap if _track_due.get(entry[2]) == entry[0]]
+        heapq.heapify(_track_heap)
+    return due
+
+
+def track_open_trades():
+    global _track_dirty
+    version = None
+    next_reload = 0.0
+    while True:
+        try:
+            now = time.monotonic()
+            with _track_cond:
+                woken = set(_track_wake_symbols)
+                _track_wake_symbols.clear()
+                dirty, _track_dirty = _track_dirty, False
+
+            # Нові трейди могли відкрити інші воркери — дочитуємо хвіст журналу, коли файли змінились
+            if dirty or now >= next_reload:
+                refresh_open_trades()
+                if dirty or version != _open_trades_version:
+                    version = _open_trades_version
+                    _sync_tracked_trades(now)
+                next_reload = now + TRACK_RELOAD_SEC
+
+            if woken:
+                inc("parsibot_tracker_wakeups_total", value=len(woken))
+                for symbol in woken:
+                    for order_id in _track_by_symbol.get(symbol, ()):
+                        _track_quiet[order_id] = 0
+                        _schedule_trade(order_id, now)
+
+            due = _pop_due_trades(now)
+            if due:
+                inc("parsibot_tracker_checks_total", value=len(due))
+                try:
+                    reconcile_open_trades([_tracked[order_id] for order_id in due])
+                except Exception as e:
+                    print(f"❌ Track reconcile error: {e}")  # угоди лишаються в розкладі
+                checked_symbols = {_tracked[order_id]["symbol"] for order_id in due}
+                with _open_trades_lock:
+                    gone = [order_id for symbol in checked_symbols for order_id in _track_by_symbol.get(symbol, ())
+                            if order_id not in _open_trades]
+                for order_id in gone:
+                    _untrack_trade(order_id)
+                now = time.monotonic()
+                for order_id in due:
+                    if order_id not in _tracked:
+                        continue
+                    trade = _tracked[order_id]
+                    quiet = _track_quiet.get(order_id, 0)
+                    _schedule_trade(order_id, now + _check_interval(trade, cached_price(trade["symbol"]), quiet))
+                    _track_quiet[order_id] = quiet + 1
+                for symbol in checked_symbols:
+                    _update_band(symbol)
+                set_gauge("parsibot_tracked_trades", len(_tracked))
+
+            maybe_compact_open_trades()
 
         except Exception as e:
             print(f"❌ Track error: {e}")
-        time.sleep(30)
 
+        with _track_cond:
+            if not _track_wake_symbols and not _track_dirty:
+                timeout = next_reload - time.monotonic()
+                if _track_heap:
+                    timeout = min(timeout, _track_heap[0][0] - time.monotonic())
+                _track_cond.wait(max(timeout, 0.01))
+
+
+# 👑 Лідер: трекер, Sheets і анонс працюють в одному процесі на весь деплой.
+# Вибір — неблокуючий flock на tracker.lock; лок звільняється ОС разом із процесом,
+# тож після падіння лідера його місце займає інший воркер.
+
+TRACKER_LOCK_PATH = os.path.join(DATA_DIR, "tracker.lock")
+LEADER_RETRY_SEC = float(os.environ.get("leader_retry_sec", 15))
+
+_leader_file = None
+
+
+def try_acquire_leadership():
+    global _leader_file
+    if _leader_file is not None:
+        return True
+    if fcntl is None:
+        _leader_file = True
+        return True
+    lock_file = open(TRACKER_LOCK_PATH, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    lock_file.truncate(0)
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    _leader_file = lock_file
+    return True
+
+
+def is_leader():
+    return _leader_file is not None
+
+
+def _leader_loop():
+    while not try_acquire_leadership():
+        time.sleep(LEADER_RETRY_SEC)
+    set_gauge("parsibot_leader", 1)
+    print(f"👑 Tracker leader: pid {os.getpid()}")
+    announce_mode()
+    try:
+        rebuild_stats()  # закриття попереднього лідера — в агрегати
+    except Exception as e:
+        print(f"⚠️ Stats rebuild error: {e}")
+    if os.environ.get("GOOGLE_SERVICE_JSON"):
+        start_sheets_worker()
+    track_open_trades()
+
+
+# 🔥 Прогрів: кеш інструментів, баланс, БД і стріми — паралельно, а не послідовно
+
+def warmup(symbols=None):
+    tasks = {
+        "server_time": sync_server_time,
+        "instruments": load_instruments,
+        "balance": get_wallet_balance_uta,
+        "trades_db": get_trades_db,
+        "price_stream": lambda: start_price_stream(symbols),
+        "private_stream": start_private_stream,
+    }
+    started = time.perf_counter()
+    errors = {}
+    with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="warmup") as pool:
+        futures = {name: pool.submit(task) for name, task in tasks.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[name] = str(e)
+                print(f"⚠️ Warmup {name} error: {e}")
+    observe("parsibot_warmup_seconds", time.perf_counter() - started)
+    print(f"🔥 Warmup завершено за {time.perf_counter() - started:.2f} с")
+    return errors
+
+
+_services_lock = threading.Lock()
+_services_pid = None
+
+
+def start_services(wait_warmup=False):
+    """Фонові потоки цього воркера. Ідемпотентно в межах процесу (після fork — запускається заново)."""
+    global _services_pid
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        _services_pid = os.getpid()
+
+    if wait_warmup:
+        warmup()
+    else:
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+    threading.Thread(target=refresh_instruments, name="instruments", daemon=True).start()
+    threading.Thread(target=reconcile_account, name="account", daemon=True).start()
+    threading.Thread(target=time_sync_loop, name="time-sync", daemon=True).start()
+    threading.Thread(target=_leader_loop, name="leader", daemon=True).start()
+
+
+# 🏭 Фабрика застосунку: імпорт bot.py нічого не запускає
+# gunicorn -w 4 "bot:create_app()"   (без --preload: кожен воркер стартує свої потоки сам)
+
+def create_app(start=True, wait_warmup=False):
+    missing = [name for name in REQUIRED_ENV if not os.environ.get(name)]
+    if missing:
+        raise RuntimeError(f"Не задано змінні оточення: {', '.join(missing)}")
 
-# 🧠 Запуск моніторингу в окремому потоці
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    if start:
+        start_services(wait_warmup)
+    return app
 
-threading.Thread(target=track_open_trades, daemon=True).start()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=10000)
+    create_app().run(host="0.0.0.0", port=10000)
 
 
 
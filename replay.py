@@ -0,0 +1,174 @@
+"""Програвання записаного webhook-трафіку (webhook_record_dir) проти будь-якого інстансу бота.
+
+python replay.py /var/data/webhooks --url http://127.0.0.1:10000 --speed 1      # реальний темп
+python replay.py webhooks.jsonl.gz --url http://staging:10000 --speed 10         # у 10 разів швидше
+python replay.py /var/data/webhooks --url http://127.0.0.1:10000 --speed max --fresh-ids
+
+Сигнали одного символу йдуть строго в порядку надходження (окремий потік на символ,
+наступний запит — після відповіді на попередній), різні символи — паралельно.
+Пароль у записах замасковано — передається через --password або змінну webhook_password.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+def iter_record_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(f for f in os.listdir(path) if f.startswith("webhooks") and f.endswith((".jsonl", ".jsonl.gz")))
+            # Ротовані файли (webhooks-<час>-<pid>) — старші за поточний webhooks.jsonl.gz
+            names.sort(key=lambda name: (not name.startswith("webhooks-"), name))
+            files.extend(os.path.join(path, name) for name in names)
+        else:
+            files.append(path)
+    return files
+
+
+def load_records(paths, symbols=None, since=None, until=None):
+    records = []
+    for path in iter_record_files(paths):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    payload = record.get("payload", record)
+                    received_at = record.get("received_at")
+                    if not isinstance(payload, dict) or received_at is None:
+                        continue
+                    if symbols and payload.get("symbol") not in symbols:
+                        continue
+                    if since and received_at < since or until and received_at >= until:
+                        continue
+                    records.append((float(received_at), payload))
+            except (EOFError, OSError) as e:
+                print(f"⚠️ {path}: обірваний кінець файлу ({e}) — беремо прочитане", file=sys.stderr)
+    records.sort(key=lambda item: item[0])
+    return records
+
+
+def prepare_payload(payload, password, run_id):
+    payload = dict(payload)
+    payload["password"] = password
+    if run_id:
+        # Нові id, щоб не впертись у дедуплікацію попереднього прогону; дублікати з запису лишаються дублікатами
+        original = payload.get("order_link_id") or hashlib.sha256(
+            json.dumps({k: v for k, v in payload.items() if k != "password"}, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        payload["order_link_id"] = f"rp{run_id}-" + hashlib.sha256(str(original).encode()).hexdigest()[:24]
+    return payload
+
+
+def replay(records, url, password, speed=1.0, fresh_ids=False, timeout=30):
+    run_id = hashlib.sha256(str(time.time_ns()).encode()).hexdigest()[:6] if fresh_ids else None
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=64))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=64))
+
+    queues = {}
+    results = []
+    results_lock = threading.Lock()
+    threads = []
+
+    def sender(symbol_queue):
+        while True:
+            item = symbol_queue.get()
+            if item is None:
+                return
+            scheduled, payload = item
+            started = time.perf_counter()
+            try:
+                response = session.post(f"{url}/webhook", json=payload, timeout=timeout)
+                status = response.status_code
+            except requests.RequestException:
+                status = "error"
+            with results_lock:
+                results.append((status, time.perf_counter() - started, max(0.0, started - scheduled)))
+
+    t0 = records[0][0] if records else 0
+    start = time.perf_counter()
+    for received_at, payload in records:
+        scheduled = start + (received_at - t0) / speed if speed else start
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        symbol = payload.get("symbol", "")
+        if symbol not in queues:
+            queues[symbol] = queue.Queue()
+            thread = threading.Thread(target=sender, args=(queues[symbol],), daemon=True)
+            thread.start()
+            threads.append(thread)
+        queues[symbol].put((max(scheduled, start), prepare_payload(payload, password, run_id)))
+
+    for symbol_queue in queues.values():
+        symbol_queue.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay записаного webhook-трафіку ParsiBot")
+    parser.add_argument("paths", nargs="+", help="файли webhooks*.jsonl[.gz] або тека рекордера")
+    parser.add_argument("--url", default="http://127.0.0.1:10000")
+    parser.add_argument("--password", default=os.environ.get("webhook_password", ""))
+    parser.add_argument("--speed", default="1", help="множник темпу (1, 10, ...) або max")
+    parser.add_argument("--symbols", help="лише ці символи, через кому")
+    parser.add_argument("--since", type=float, help="unix-час початку вибірки")
+    parser.add_argument("--until", type=float, help="unix-час кінця вибірки")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--fresh-ids", action="store_true", help="нові order_link_id, щоб обійти дедуплікацію")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+    symbols = set(args.symbols.split(",")) if args.symbols else None
+    records = load_records(args.paths, symbols, args.since, args.until)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit("Немає записів для програвання")
+
+    span = records[-1][0] - records[0][0]
+    print(f"▶️ {len(records)} сигналів за {span:.1f} с запису, темп: {args.speed}", file=sys.stderr)
+    results, elapsed = replay(records, args.url.rstrip("/"), args.password, speed, args.fresh_ids)
+
+    latencies = sorted(r[1] * 1000 for r in results)
+    lags = sorted(r[2] * 1000 for r in results)
+    report = {
+        "sent": len(results),
+        "elapsed_sec": round(elapsed, 3),
+        "rate_per_sec": round(len(results) / elapsed, 2) if elapsed else None,
+        "statuses": dict(Counter(str(r[0]) for r in results)),
+        "ack_ms": {
+            "p50": round(latencies[len(latencies) // 2], 2),
+            "p99": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 2),
+            "mean": round(statistics.fmean(latencies), 2)
+        },
+        "schedule_lag_ms_p99": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))], 2)
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"📊 Надіслано {report['sent']} за {report['elapsed_sec']} с ({report['rate_per_sec']}/с), статуси: {report['statuses']}")
+        print(f"⚡ ACK p50={report['ack_ms']['p50']} ms p99={report['ack_ms']['p99']} ms, відставання від графіка p99={report['schedule_lag_ms_p99']} ms")
+    return 0 if all(str(r[0]).startswith("2") for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
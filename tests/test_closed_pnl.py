@@ -0,0 +1,100 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("data_dir", tempfile.mkdtemp(prefix="parsibot-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import bot  # noqa: E402
+
+
+def _trade(order_id, timestamp, side="Buy", qty=1.0, symbol="BTCUSDT"):
+    return {
+        "order_id": order_id, "symbol": symbol, "side": side, "qty": qty,
+        "entry_price": 100.0, "tp": 110.0, "sl": 90.0, "timestamp": timestamp
+    }
+
+
+def _record(order_id, created_ms, side="Sell", size=1.0, exit_price=110.0, pnl=10.0):
+    return {
+        "orderId": order_id, "side": side, "closedSize": str(size), "avgExitPrice": str(exit_price),
+        "closedPnl": str(pnl), "orderType": "Market", "createdTime": str(created_ms), "updatedTime": str(created_ms)
+    }
+
+
+@pytest.fixture
+def exchange(monkeypatch):
+    for trade in bot.get_open_trades():
+        bot.remove_open_trade(trade["order_id"])
+    with bot.get_trades_db() as conn:
+        conn.execute("DELETE FROM closed_pnl_used")
+    records = []
+    closed = []
+    monkeypatch.setattr(bot, "fetch_closed_pnl", lambda symbol, since_ms: list(records))
+    monkeypatch.setattr(bot, "record_closed_trade", lambda *args: closed.append(args))
+    monkeypatch.setattr(bot, "send_telegram_message", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bot, "_server_time_offset_ms", 0)
+    return records, closed
+
+
+def test_closed_pnl_record_is_not_reused_in_a_later_cycle(exchange):
+    records, closed = exchange
+    a = _trade("A", "2026-01-01 00:00:00")
+    b = _trade("B", "2026-01-01 00:00:01")
+    bot.save_open_trade(dict(a))
+    bot.save_open_trade(dict(b))
+    records.append(_record("close-1", bot._trade_opened_ms(b) + 5000))
+
+    assert bot.reconcile_open_trades([a]) == 1
+    assert [t["order_id"] for t in bot.get_open_trades()] == ["B"]
+
+    # Другий цикл: запис уже віддано A — B на біржі ще відкрита
+    assert bot.reconcile_open_trades([b]) == 0
+    assert [t["order_id"] for t in bot.get_open_trades()] == ["B"]
+    assert len(closed) == 1
+
+    # Новий запис закриває B
+    records.append(_record("close-2", bot._trade_opened_ms(b) + 9000))
+    assert bot.reconcile_open_trades([b]) == 1
+    assert bot.get_open_trades() == []
+    assert len(closed) == 2
+
+
+def test_allocation_of_a_trade_still_open_is_recomputed(exchange):
+    records, closed = exchange
+    a = _trade("A", "2026-01-01 00:00:00")
+    bot.save_open_trade(dict(a))
+    record = _record("close-1", bot._trade_opened_ms(a) + 5000)
+    records.append(record)
+    # Крах після запису розподілу, але до remove_open_trade
+    bot.save_closed_pnl_used("BTCUSDT", "A", [("close-1", 1.0, int(record["createdTime"]))])
+
+    assert bot.reconcile_open_trades([a]) == 1
+    assert bot.get_open_trades() == []
+
+
+def test_exchange_open_time_is_not_shifted_by_clock_offset(exchange, monkeypatch):
+    records, closed = exchange
+    monkeypatch.setattr(bot, "_server_time_offset_ms", 2000)  # годинник хоста відстає на 2 с
+    trade = dict(_trade("A", "2026-01-01 00:00:00"), opened_ms=1767225600000)  # execTime біржі
+    bot.save_open_trade(dict(trade))
+    records.append(_record("close-1", trade["opened_ms"] + 500))  # SL спрацював за пів секунди
+
+    assert bot.reconcile_open_trades([trade]) == 1
+    assert len(closed) == 1
+
+
+def test_local_open_time_is_moved_to_the_exchange_clock(exchange, monkeypatch):
+    records, closed = exchange
+    monkeypatch.setattr(bot, "_server_time_offset_ms", 2000)
+    trade = _trade("A", "2026-01-01 00:00:00")  # без opened_ms: локальний час хоста
+    bot.save_open_trade(dict(trade))
+    local_ms = 1767225600000
+    records.append(_record("before-open", local_ms + 1000, pnl=-5.0))  # на біржі — ще до відкриття
+
+    assert bot.reconcile_open_trades([trade]) == 0
+    records.append(_record("close-1", local_ms + 2500))
+    assert bot.reconcile_open_trades([trade]) == 1
+    assert closed[0][2] == 10.0